@@ -0,0 +1,88 @@
+from common.log import logUtils as log
+from helpers import memoryCache
+from objects import glob
+import json
+
+# Rows are reloaded from db at least every 5 minutes, even if we missed an invalidation message
+SIZE = 4096
+TTL = 300
+
+class beatmapCache:
+	"""
+	Rows of the beatmaps table, cached in this process' memory by md5 (and beatmap_id -> md5),
+	so hot beatmaps don't hit MySQL on every getscores/submit/pp request.
+
+	Every LETS process has its own cache, so whoever changes a beatmap row must call invalidate(),
+	which publishes a message on lets:beatmap_updates that tells every process to drop it.
+	"""
+	def __init__(self):
+		self.rows = memoryCache.memoryCache(SIZE, TTL)
+		self.ids = memoryCache.memoryCache(SIZE, TTL)
+
+	def get(self, fileMd5):
+		"""
+		Get a cached beatmap row
+
+		:param fileMd5: beatmap md5
+		:return: row dictionary, or None if cache miss
+		"""
+		row = self.rows.get(fileMd5)
+		log.debug("beatmapCache {}".format("miss" if row is None else "hit"))
+		return row
+
+	def getByID(self, beatmapID):
+		"""
+		Get a cached beatmap row
+
+		:param beatmapID: beatmap id
+		:return: row dictionary, or None if cache miss
+		"""
+		fileMd5 = self.ids.get(beatmapID)
+		if fileMd5 is None:
+			log.debug("beatmapCache miss")
+			return None
+		return self.get(fileMd5)
+
+	def set(self, row):
+		"""
+		Cache a beatmap row
+
+		:param row: row dictionary (SELECT * FROM beatmaps)
+		:return:
+		"""
+		self.rows.set(row["beatmap_md5"], row)
+		self.ids.set(row["beatmap_id"], row["beatmap_md5"])
+
+	def delete(self, fileMd5s = (), beatmapIDs = ()):
+		"""
+		Remove some beatmaps from this process' cache
+
+		:param fileMd5s: beatmaps md5
+		:param beatmapIDs: beatmaps id
+		:return:
+		"""
+		fileMd5s = list(fileMd5s)
+		for beatmapID in beatmapIDs:
+			fileMd5 = self.ids.get(beatmapID)
+			if fileMd5 is not None:
+				fileMd5s.append(fileMd5)
+		self.ids.delete(*beatmapIDs)
+		self.rows.delete(*fileMd5s)
+
+	def invalidate(self, fileMd5s = (), beatmapIDs = ()):
+		"""
+		Remove some beatmaps from the cache of every LETS process
+
+		:param fileMd5s: beatmaps md5
+		:param beatmapIDs: beatmaps id
+		:return:
+		"""
+		fileMd5s, beatmapIDs = [x for x in fileMd5s if x], [x for x in beatmapIDs if x]
+		if not fileMd5s and not beatmapIDs:
+			return
+		self.delete(fileMd5s, beatmapIDs)
+		glob.redis.publish("lets:beatmap_updates", json.dumps({
+			"invalidate": True,
+			"beatmap_md5": fileMd5s,
+			"beatmap_id": beatmapIDs
+		}))
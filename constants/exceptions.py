@@ -52,6 +52,9 @@ class noAPIDataError(Exception):
 class scoreNotFoundError(Exception):
 	pass
 
+class leaderboardRebuildLockedError(Exception):
+	pass
+
 class ppCalcException(Exception):
 	def __init__(self, exception):
 		self.exception = exception
\ No newline at end of file
@@ -0,0 +1,96 @@
+from common.constants import mods as PlayMods
+from common.log import logUtils as log
+from objects import glob
+import json
+
+# Mods that don't change a beatmap's difficulty attributes
+IGNORED_MODS = PlayMods.NOFAIL | PlayMods.SUDDENDEATH | PlayMods.PERFECT
+
+# Unused difficulty attributes are removed after 30 days
+EXPIRE = 2592000
+
+class difficultyCache:
+	"""
+	Difficulty attributes (stars, strains, ...) of a beatmap for a game mode and mods combination.
+	They never change for a given .osu file, so they're computed once by the pp calculator
+	and reused by every other score set on the same beatmap/mods.
+
+	Different calculators (pp pools) can return different attributes for the same beatmap,
+	so each one has its own entries.
+
+	Stored in a redis hash per beatmap md5 (ripple:difficulty_attributes:md5), field pool:mode:mods
+	"""
+	@staticmethod
+	def normalizeMods(mods):
+		"""
+		Remove mods that don't affect difficulty, so equivalent mods combinations share the same cache entry
+
+		:param mods: mods bitwise number
+		:return: normalized mods bitwise number
+		"""
+		mods &= ~IGNORED_MODS
+		if mods & PlayMods.NIGHTCORE:
+			# NC is DT with a different pitch
+			mods = (mods & ~PlayMods.NIGHTCORE) | PlayMods.DOUBLETIME
+		return mods
+
+	def field(self, pool, gameMode, mods):
+		"""
+		Hash field of a calculator, game mode and mods combination
+
+		:param pool: name of the pp pool that calculated the attributes
+		:param gameMode: game mode number
+		:param mods: mods bitwise number
+		:return: hash field
+		"""
+		return "{}:{}:{}".format(pool, gameMode, self.normalizeMods(mods))
+
+	def get(self, fileMd5, pool, gameMode, mods):
+		"""
+		Get cached difficulty attributes
+
+		:param fileMd5: beatmap md5
+		:param pool: name of the pp pool that calculated the attributes
+		:param gameMode: game mode number
+		:param mods: mods bitwise number
+		:return: attributes dictionary, or None if cache miss
+		"""
+		data = glob.redis.hget(
+			"ripple:difficulty_attributes:{}".format(fileMd5),
+			self.field(pool, gameMode, mods)
+		)
+		if data is None:
+			log.debug("difficultyCache miss")
+			return None
+		log.debug("difficultyCache hit")
+		return json.loads(data.decode("utf-8"))
+
+	def set(self, fileMd5, pool, gameMode, mods, attributes):
+		"""
+		Cache difficulty attributes
+
+		:param fileMd5: beatmap md5
+		:param pool: name of the pp pool that calculated the attributes
+		:param gameMode: game mode number
+		:param mods: mods bitwise number
+		:param attributes: attributes dictionary
+		:return:
+		"""
+		key = "ripple:difficulty_attributes:{}".format(fileMd5)
+		pipe = glob.redis.pipeline()
+		pipe.hset(key, self.field(pool, gameMode, mods), json.dumps(attributes))
+		pipe.expire(key, EXPIRE)
+		pipe.execute()
+		log.debug("difficultyCache set")
+
+	def delete(self, *fileMd5s):
+		"""
+		Remove every cached difficulty attributes of some beatmaps
+
+		:param fileMd5s: beatmaps md5
+		:return:
+		"""
+		if not fileMd5s:
+			return
+		glob.redis.delete(*["ripple:difficulty_attributes:{}".format(x) for x in fileMd5s])
+		log.debug("difficultyCache deleted {} beatmaps".format(len(fileMd5s)))
@@ -24,6 +24,7 @@ class DiscordWebhook:
         :keyword filename: file name
         :keyword embeds: list of embedded rich content
         :keyword proxies: dict of proxies
+        :keyword timeout: requests timeout in seconds (None to wait forever)
         """
         self.url = url
         self.content = kwargs.get('content')
@@ -33,6 +34,7 @@ class DiscordWebhook:
         self.files = kwargs.get('files', dict())
         self.embeds = kwargs.get('embeds', [])
         self.proxies = kwargs.get('proxies', None)
+        self.timeout = kwargs.get('timeout', None)
 
     def add_file(self, file, filename):
         """
@@ -102,10 +104,10 @@ class DiscordWebhook:
         responses = []
         for i, url in enumerate(webhook_urls):
             if bool(self.files) is False:
-                response = requests.post(url, json=self.json, proxies=self.proxies)
+                response = requests.post(url, json=self.json, proxies=self.proxies, timeout=self.timeout)
             else:
                 self.files['payload_json'] = (None, json.dumps(self.json))
-                response = requests.post(url, files=self.files, proxies=self.proxies)
+                response = requests.post(url, files=self.files, proxies=self.proxies, timeout=self.timeout)
             if response.status_code in [200, 204]:
                 logger.debug("[{index}/{length}] Webhook executed".format(index=i, length=urls_len))
             else:
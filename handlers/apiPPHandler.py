@@ -13,13 +13,27 @@ from common.web import requestsManager
 from constants import exceptions
 from helpers import osuapiHelper
 from objects import glob
-from pp import rippoppai, relaxoppai
+from pp import calculatorPool, rippoppai, relaxoppai
 from common.sentry import sentry
 
 MODULE_NAME = "api/pp"
+
+# Max number of calculations in a single POST request
+MAX_BATCH_SIZE = 100
+# Max number of different beatmaps (osu!api requests and calculator runs) in a single POST request
+MAX_BATCH_BEATMAPS = 10
+# Max number of different accuracies of the same beatmap/mods in a single POST request
+MAX_BATCH_ACCURACIES = 10
+
 class handler(requestsManager.asyncRequestHandler):
 	"""
 	Handler for /api/v1/pp
+
+	GET ?b=beatmap_id&m=mods&g=game_mode&a=acc calculates pp for a single beatmap.
+	POST {"requests": [{"b": beatmap_id, "m": mods, "g": game_mode, "a": acc}, ...]} calculates pp for many
+	(beatmap, mods, acc) at once. Each beatmap/mods combination is calculated only once.
+	The endpoint is public, so a batch can't have more than MAX_BATCH_BEATMAPS different beatmaps
+	and MAX_BATCH_ACCURACIES different accuracies for each beatmap/mods.
 	"""
 	@tornado.web.asynchronous
 	@tornado.gen.engine
@@ -32,142 +46,23 @@ class handler(requestsManager.asyncRequestHandler):
 			if not requestsManager.checkArguments(self.request.arguments, ["b"]):
 				raise exceptions.invalidArgumentsException(MODULE_NAME)
 
-			# Get beatmap ID and make sure it's a valid number
-			beatmapID = self.get_argument("b")
-			if not beatmapID.isdigit():
-				raise exceptions.invalidArgumentsException(MODULE_NAME)
-
-			# Get mods
-			if "m" in self.request.arguments:
-				modsEnum = self.get_argument("m")
-				if not modsEnum.isdigit():
-					raise exceptions.invalidArgumentsException(MODULE_NAME)
-				modsEnum = int(modsEnum)
-			else:
-				modsEnum = 0
-
-			# Get game mode
-			if "g" in self.request.arguments:
-				gameMode = self.get_argument("g")
-				if not gameMode.isdigit():
-					raise exceptions.invalidArgumentsException(MODULE_NAME)
-				gameMode = int(gameMode)
-			else:
-				gameMode = 0
-
-			# Get acc
-			if "a" in self.request.arguments:
-				accuracy = self.get_argument("a")
-				try:
-					accuracy = float(accuracy)
-				except ValueError:
-					raise exceptions.invalidArgumentsException(MODULE_NAME)
-			else:
-				accuracy = None
-
-			# Print message
-			log.info("Requested pp for beatmap {}".format(beatmapID))
-
-			# Get beatmap md5 from osuapi
-			# TODO: Move this to beatmap object
-			osuapiData = osuapiHelper.osuApiRequest("get_beatmaps", "b={}".format(beatmapID))
-			if int(beatmapID) > 100000000:
-				raise exceptions.ppCustomBeatmap(MODULE_NAME)
-			if osuapiData is None or "file_md5" not in osuapiData or "beatmapset_id" not in osuapiData:
-				raise exceptions.invalidBeatmapException(MODULE_NAME)
-			beatmapMd5 = osuapiData["file_md5"]
-			beatmapSetID = osuapiData["beatmapset_id"]
-
-			# Create beatmap object
-			bmap = beatmap.beatmap(beatmapMd5, beatmapSetID)
-
-			# Check beatmap length
-			if bmap.hitLength > 2000:
-				raise exceptions.beatmapTooLongException(MODULE_NAME)
-
-			returnPP = []
-			if gameMode == gameModes.STD and bmap.starsStd == 0:
-				# Mode Specific beatmap, auto detect game mode
-				if bmap.starsTaiko > 0:
-					gameMode = gameModes.TAIKO
-				if bmap.starsCtb > 0:
-					gameMode = gameModes.CTB
-				if bmap.starsMania > 0:
-					gameMode = gameModes.MANIA
-
-			# Calculate pp
-			if gameMode in (gameModes.STD, gameModes.TAIKO):
-				# Std pp
-				if accuracy is None and modsEnum == 0:
-					# Generic acc/nomod
-					# Get cached pp values
-					cachedPP = bmap.getCachedTillerinoPP()
-					if (modsEnum&mods.RELAX):
-						cachedPP = [0,0,0,0]
-
-					if cachedPP != [0,0,0,0]:
-						log.debug("Got cached pp.")
-						returnPP = cachedPP
-					else:
-						log.debug("Cached pp not found. Calculating pp with oppai...")
-						# Cached pp not found, calculate them
-						if gameMode == gameModes.STD and (modsEnum&mods.RELAX):
-							oppai = relaxoppai.oppai(bmap, mods=modsEnum, tillerino=True)
-						else:
-							oppai = rippoppai.oppai(bmap, mods=modsEnum, tillerino=True)
-						returnPP = oppai.pp
-						bmap.starsStd = oppai.stars
-
-						if not (modsEnum&mods.RELAX):
-							# Cache values in DB
-							log.debug("Saving cached pp...")
-							if type(returnPP) == list and len(returnPP) == 4:
-								bmap.saveCachedTillerinoPP(returnPP)
-				else:
-					# Specific accuracy/mods, calculate pp
-					# Create oppai instance
-					log.debug("Specific request ({}%/{}). Calculating pp with oppai...".format(accuracy, modsEnum))
-					if gameMode == gameModes.STD and (modsEnum&mods.RELAX):
-						oppai = relaxoppai.oppai(bmap, mods=modsEnum, tillerino=True)
-					else:
-						oppai = rippoppai.oppai(bmap, mods=modsEnum, tillerino=True)
-					bmap.starsStd = oppai.stars
-					if accuracy is not None:
-						returnPP = calculatePPFromAcc(oppai, accuracy)
-					else:
-						returnPP = oppai.pp
-			else:
-				raise exceptions.unsupportedGameModeException()
-
-			# Data to return
-			data = {
-				"song_name": bmap.songName,
-				"pp": [x for x in returnPP] if type(returnPP) is list else returnPP,
-				"length": bmap.hitLength,
-				"stars": bmap.starsStd,
-				"ar": bmap.AR,
-				"bpm": bmap.bpm,
-			}
+			data = ppRequest().calculate(
+				self.get_argument("b"),
+				self.get_argument("m", "0"),
+				self.get_argument("g", "0"),
+				self.get_argument("a", None)
+			)
 
 			# Set status code and message
 			statusCode = 200
 			data["message"] = "ok"
-		except exceptions.invalidArgumentsException:
+		except (
+			exceptions.invalidArgumentsException, exceptions.ppCustomBeatmap, exceptions.invalidBeatmapException,
+			exceptions.beatmapTooLongException, exceptions.unsupportedGameModeException
+		) as e:
 			# Set error and message
 			statusCode = 400
-			data["message"] = "missing required arguments"
-		except exceptions.ppCustomBeatmap:
-			statusCode = 400
-			data["message"] = "Custom map does not supported pp calculating yet"
-		except exceptions.invalidBeatmapException:
-			statusCode = 400
-			data["message"] = "beatmap not found"
-		except exceptions.beatmapTooLongException:
-			statusCode = 400
-			data["message"] = "requested beatmap is too long"
-		except exceptions.unsupportedGameModeException:
-			statusCode = 400
-			data["message"] = "Unsupported gamemode"
+			data["message"] = errorMessage(e)
 		finally:
 			# Add status code to data
 			data["status"] = statusCode
@@ -181,7 +76,278 @@ class handler(requestsManager.asyncRequestHandler):
 			self.set_header("Content-Type", "application/json")
 			self.set_status(statusCode)
 
-def calculatePPFromAcc(ppcalc, acc):
-	ppcalc.acc = acc
-	ppcalc.calculatePP()
-	return ppcalc.pp
+	@tornado.web.asynchronous
+	@tornado.gen.engine
+	@sentry.captureTornado
+	def asyncPost(self):
+		statusCode = 400
+		data = {"message": "unknown error"}
+		try:
+			try:
+				requests_ = json.loads(self.request.body.decode("utf-8"))["requests"]
+			except (ValueError, KeyError, TypeError):
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+			if type(requests_) is not list or len(requests_) > MAX_BATCH_SIZE:
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+
+			# Calculate every request, sharing beatmaps and pp matrixes
+			log.info("Requested pp for {} beatmaps".format(len(requests_)))
+			calculator = ppRequest()
+			calculator.plan(requests_)
+			if len({str(x.get("b")) for x in requests_ if type(x) is dict}) > MAX_BATCH_BEATMAPS or \
+				any(len(x) > MAX_BATCH_ACCURACIES for x in calculator.plannedAccs.values()):
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+			results = []
+			for x in requests_:
+				try:
+					if type(x) is not dict or "b" not in x:
+						raise exceptions.invalidArgumentsException(MODULE_NAME)
+					result = calculator.calculate(str(x["b"]), str(x.get("m", 0)), str(x.get("g", 0)), x.get("a"))
+					result["status"] = 200
+				except (
+					exceptions.invalidArgumentsException, exceptions.ppCustomBeatmap, exceptions.invalidBeatmapException,
+					exceptions.beatmapTooLongException, exceptions.unsupportedGameModeException
+				) as e:
+					result = {"status": 400, "message": errorMessage(e)}
+				results.append(result)
+			data["results"] = results
+
+			# Set status code and message
+			statusCode = 200
+			data["message"] = "ok"
+		except exceptions.invalidArgumentsException:
+			statusCode = 400
+			data["message"] = "invalid request body, {{\"requests\": [...]}} with at most {} items, {} different beatmaps " \
+				"and {} different accuracies per beatmap/mods expected".format(MAX_BATCH_SIZE, MAX_BATCH_BEATMAPS, MAX_BATCH_ACCURACIES)
+		finally:
+			data["status"] = statusCode
+			self.write(json.dumps(data))
+			self.set_header("Content-Type", "application/json")
+			self.set_status(statusCode)
+
+
+def errorMessage(e):
+	"""
+	Get the API error message of an exception
+
+	e -- exception raised by ppRequest.calculate
+	return -- error message
+	"""
+	if isinstance(e, exceptions.invalidArgumentsException):
+		return "missing required arguments"
+	if isinstance(e, exceptions.ppCustomBeatmap):
+		return "Custom map does not supported pp calculating yet"
+	if isinstance(e, exceptions.invalidBeatmapException):
+		return "beatmap not found"
+	if isinstance(e, exceptions.beatmapTooLongException):
+		return "requested beatmap is too long"
+	if isinstance(e, exceptions.unsupportedGameModeException):
+		return "Unsupported gamemode"
+	return "unknown error"
+
+
+class ppRequest:
+	"""
+	pp calculations for one API request.
+	Beatmaps and pp matrix rows are kept for the whole request, so
+	a batch with the same beatmap/mods many times calculates it only once.
+	"""
+	def __init__(self):
+		self.beatmaps = {}
+		self.matrix = {}
+		self.accPP = {}
+		self.plannedAccs = {}
+
+	def plan(self, requests_):
+		"""
+		Remember every specific accuracy requested for each beatmap/mods in a batch,
+		so they're all calculated in one go the first time that beatmap/mods is needed
+
+		requests_ -- list of request dictionaries
+		"""
+		for x in requests_:
+			if type(x) is not dict or x.get("a") is None:
+				continue
+			try:
+				self.plannedAccs.setdefault((str(x.get("b")), str(x.get("m", 0))), set()).add(float(x["a"]))
+			except (ValueError, TypeError):
+				pass
+
+	def getBeatmap(self, beatmapID):
+		"""
+		Get a beatmap object from its id
+
+		beatmapID -- beatmap id
+		return -- beatmap object
+		"""
+		if beatmapID in self.beatmaps:
+			return self.beatmaps[beatmapID]
+
+		# Get beatmap md5 from osuapi
+		# TODO: Move this to beatmap object
+		osuapiData = osuapiHelper.osuApiRequest("get_beatmaps", "b={}".format(beatmapID))
+		if int(beatmapID) > 100000000:
+			raise exceptions.ppCustomBeatmap(MODULE_NAME)
+		if osuapiData is None or "file_md5" not in osuapiData or "beatmapset_id" not in osuapiData:
+			raise exceptions.invalidBeatmapException(MODULE_NAME)
+
+		# Create beatmap object
+		bmap = beatmap.beatmap(osuapiData["file_md5"], osuapiData["beatmapset_id"])
+
+		# Check beatmap length
+		if bmap.hitLength > 2000:
+			raise exceptions.beatmapTooLongException(MODULE_NAME)
+		self.beatmaps[beatmapID] = bmap
+		return bmap
+
+	def getMatrix(self, bmap, gameMode, modsEnum):
+		"""
+		Get pp for 100%, 99%, 98% and 95% acc, from cache or calculating them with oppai
+
+		bmap -- beatmap object
+		gameMode -- game mode
+		modsEnum -- mods
+		return -- (pp list, stars)
+		"""
+		key = (bmap.fileMD5, gameMode, glob.ppMatrixCache.normalizeMods(modsEnum))
+		if key in self.matrix:
+			return self.matrix[key]
+
+		if modsEnum == 0:
+			# Nomod pp are stored in the beatmaps table too
+			cachedPP = bmap.getCachedTillerinoPP()
+			cached = {"pp": cachedPP, "stars": bmap.starsStd} if cachedPP != [0,0,0,0] else None
+		else:
+			cached = glob.ppMatrixCache.get(bmap.fileMD5, gameMode, modsEnum)
+		if cached is not None:
+			log.debug("Got cached pp.")
+			self.matrix[key] = (cached["pp"], cached["stars"])
+			return self.matrix[key]
+
+		pooled = self.poolPP(bmap, gameMode, modsEnum, rippoppai.TILLERINO_ACCS)
+		if pooled is not None:
+			returnPP, stars = pooled
+		else:
+			log.debug("Cached pp not found. Calculating pp with oppai...")
+			if gameMode == gameModes.STD and (modsEnum&mods.RELAX):
+				oppai = relaxoppai.oppai(bmap, mods=modsEnum, tillerino=True)
+			else:
+				oppai = rippoppai.oppai(bmap, mods=modsEnum, tillerino=True)
+			returnPP, stars = oppai.pp, oppai.stars
+
+		# Cache values, unless oppai failed
+		if type(returnPP) == list and len(returnPP) == 4:
+			log.debug("Saving cached pp...")
+			if modsEnum == 0:
+				bmap.saveCachedTillerinoPP(returnPP)
+			else:
+				glob.ppMatrixCache.set(bmap.fileMD5, gameMode, modsEnum, returnPP, stars)
+		self.matrix[key] = (returnPP, stars)
+		return self.matrix[key]
+
+	def poolPP(self, bmap, gameMode, modsEnum, accs):
+		"""
+		Calculate pp for many accuracies with a single request to the persistent pp calculators,
+		instead of one oppai process per accuracy
+
+		bmap -- beatmap object
+		gameMode -- game mode
+		modsEnum -- mods
+		accs -- list of accuracies
+		return -- (pp list, stars), or None if the pool is disabled or unavailable (use oppai)
+		"""
+		poolName = "relax" if gameMode == gameModes.STD and (modsEnum&mods.RELAX) else "performance"
+		try:
+			return calculatorPool.accuracyPP(poolName, bmap, gameMode, modsEnum, accs)
+		except calculatorPool.CalculatorPoolError as e:
+			log.warning("pp pool {} ~> {}, using oppai".format(poolName, e))
+			return None
+
+	def getAccPP(self, bmap, gameMode, modsEnum, accuracy, planKey):
+		"""
+		Get pp for a specific accuracy, calculating it together with the other
+		accuracies planned for the same beatmap/mods
+
+		bmap -- beatmap object
+		gameMode -- game mode
+		modsEnum -- mods
+		accuracy -- accuracy
+		planKey -- (beatmap id, mods) key of plannedAccs
+		return -- (pp, stars)
+		"""
+		key = (bmap.fileMD5, gameMode, modsEnum)
+		if (key, accuracy) in self.accPP:
+			return self.accPP[(key, accuracy)]
+
+		accs = sorted(set([accuracy]) | self.plannedAccs.pop(planKey, set()))
+		pooled = self.poolPP(bmap, gameMode, modsEnum, accs)
+		if pooled is not None:
+			ppList, stars = pooled
+		else:
+			log.debug("Specific request ({}%/{}). Calculating pp with oppai...".format(accs, modsEnum))
+			if gameMode == gameModes.STD and (modsEnum&mods.RELAX):
+				oppai = relaxoppai.oppai(bmap, mods=modsEnum, accs=accs)
+			else:
+				oppai = rippoppai.oppai(bmap, mods=modsEnum, accs=accs)
+			ppList = oppai.pp if type(oppai.pp) is list else [oppai.pp] * len(accs)
+			stars = oppai.stars
+		for acc, pp in zip(accs, ppList):
+			self.accPP[(key, acc)] = (pp, stars)
+		return self.accPP[(key, accuracy)]
+
+	def calculate(self, beatmapID, modsEnum, gameMode, accuracy):
+		"""
+		Calculate pp for a beatmap
+
+		beatmapID -- beatmap id (string)
+		modsEnum -- mods (string)
+		gameMode -- game mode (string)
+		accuracy -- accuracy (string or number), or None for 100%, 99%, 98% and 95%
+		return -- response data dictionary
+		"""
+		# Get beatmap ID, mods and game mode, and make sure they're valid numbers
+		if not beatmapID.isdigit() or not modsEnum.isdigit() or not gameMode.isdigit():
+			raise exceptions.invalidArgumentsException(MODULE_NAME)
+		planKey = (beatmapID, modsEnum)
+		modsEnum = int(modsEnum)
+		gameMode = int(gameMode)
+
+		# Get acc
+		if accuracy is not None:
+			try:
+				accuracy = float(accuracy)
+			except ValueError:
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+
+		# Print message
+		log.info("Requested pp for beatmap {}".format(beatmapID))
+		bmap = self.getBeatmap(beatmapID)
+
+		if gameMode == gameModes.STD and bmap.starsStd == 0:
+			# Mode Specific beatmap, auto detect game mode
+			if bmap.starsTaiko > 0:
+				gameMode = gameModes.TAIKO
+			if bmap.starsCtb > 0:
+				gameMode = gameModes.CTB
+			if bmap.starsMania > 0:
+				gameMode = gameModes.MANIA
+
+		# Calculate pp
+		if gameMode not in (gameModes.STD, gameModes.TAIKO):
+			raise exceptions.unsupportedGameModeException()
+		if accuracy is None:
+			# Generic acc
+			returnPP, stars = self.getMatrix(bmap, gameMode, modsEnum)
+		else:
+			# Specific accuracy, calculate pp
+			returnPP, stars = self.getAccPP(bmap, gameMode, modsEnum, accuracy, planKey)
+
+		# Data to return
+		return {
+			"song_name": bmap.songName,
+			"pp": [x for x in returnPP] if type(returnPP) is list else returnPP,
+			"length": bmap.hitLength,
+			"stars": stars,
+			"ar": bmap.AR,
+			"bpm": bmap.bpm,
+		}
@@ -0,0 +1,80 @@
+import hmac
+import json
+
+import tornado.gen
+import tornado.web
+
+from common.log import logUtils as log
+from common.web import requestsManager
+from constants import exceptions
+from helpers import leaderboardHelper
+from objects import glob
+from common.sentry import sentry
+
+MODULE_NAME = "api/rebuildLeaderboards"
+
+def _rebuild(relaxList, gameModes):
+	try:
+		for relax in relaxList:
+			leaderboardHelper.rebuild(gameModes, relax)
+	except exceptions.leaderboardRebuildLockedError:
+		log.warning("Leaderboards rebuild skipped, another rebuild is running")
+	except Exception as e:
+		log.error("Error while rebuilding leaderboards: {}".format(e))
+
+class handler(requestsManager.asyncRequestHandler):
+	"""
+	Handler for /api/v1/rebuildLeaderboards
+
+	Rebuilds global and country leaderboards from the users stats in db, in the background.
+	Requires the admin key set in the "admin-api" section of the lets config ({"key": "..."}).
+	Arguments: k (admin key), type (std, relax or both. Default: both), mode (comma separated game modes. Default: all)
+	"""
+	@tornado.web.asynchronous
+	@tornado.gen.engine
+	@sentry.captureTornado
+	def asyncPost(self):
+		statusCode = 400
+		data = {"message": "unknown error"}
+		try:
+			# Check arguments
+			if not requestsManager.checkArguments(self.request.arguments, ["k"]):
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+
+			# Check admin key
+			key = glob.conf.extra["lets"].get("admin-api", {}).get("key")
+			if not key or not hmac.compare_digest(str(key), self.get_argument("k")):
+				statusCode = 403
+				data["message"] = "invalid key"
+				return
+
+			type_ = self.get_argument("type", "both")
+			if type_ not in ("std", "relax", "both"):
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+			relaxList = [False, True] if type_ == "both" else [type_ == "relax"]
+			gameModes = [int(x) for x in self.get_argument("mode", "0,1,2,3").split(",") if x.strip()]
+			if not gameModes or any(x not in range(4) for x in gameModes):
+				raise exceptions.invalidArgumentsException(MODULE_NAME)
+
+			# The rebuild takes its own lock, this only tells the caller early
+			if leaderboardHelper.isRebuilding():
+				statusCode = 409
+				data["message"] = "a rebuild is already running"
+				return
+			glob.pool.apply_async(_rebuild, (relaxList, gameModes))
+
+			# Set status code and message
+			statusCode = 202
+			data["message"] = "rebuilding"
+		except (exceptions.invalidArgumentsException, ValueError):
+			# Set error and message
+			statusCode = 400
+			data["message"] = "missing required arguments"
+		finally:
+			# Add status code to data
+			data["status"] = statusCode
+
+			# Send response
+			self.write(json.dumps(data))
+			self.set_header("Content-Type", "application/json")
+			self.set_status(statusCode)
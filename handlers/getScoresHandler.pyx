@@ -9,6 +9,8 @@ from common.log import logUtils as log
 from common.ripple import userUtils
 from common.web import requestsManager
 from constants import exceptions
+from constants import rankedStatuses
+from helpers import mapsHelper
 from objects import glob
 from common.constants import mods
 from common.sentry import sentry
@@ -93,6 +95,10 @@ class handler(requestsManager.asyncRequestHandler):
 			bmap = beatmap.beatmap(md5, beatmapSetID, gameMode, fileName=fileName)
 			bmap.saveFileName(fileName)
 
+			# Download the .osu file now if we don't have it, rather than when the score is submitted
+			if bmap.rankedStatus not in (rankedStatuses.NOT_SUBMITTED, rankedStatuses.NEED_UPDATE, rankedStatuses.UNKNOWN):
+				mapsHelper.prefetch(bmap)
+
 			# Create leaderboard object, link it to bmap and get all scores
 			if bool(mods & 128):
 					sboard = scoreboard.relax(
@@ -1,13 +1,9 @@
-import base64
 import collections
 import json
 import sys
-import threading
 import traceback
-from urllib.parse import urlencode
 import math
 
-import requests
 import tornado.gen
 import tornado.web
 
@@ -23,8 +19,11 @@ from constants import exceptions
 from constants import rankedStatuses
 from constants.exceptions import ppCalcException
 from helpers import aeshelper
+from helpers import jobQueue
 from helpers import replayHelper
 from helpers import leaderboardHelper
+from helpers import rankIndexHelper
+from helpers import writeBatch
 from helpers.generalHelper import zingonify, getHackByFlag
 from objects import beatmap
 from objects import glob
@@ -32,7 +31,7 @@ from objects import score
 from objects import scoreboard
 from objects.charts import BeatmapChart, OverallChart
 from secret import butterCake
-from discord_webhook import DiscordWebhook, DiscordEmbed
+from discord_webhook import DiscordEmbed
 
 MODULE_NAME = "submit_modular"
 class handler(requestsManager.asyncRequestHandler):
@@ -44,6 +43,7 @@ class handler(requestsManager.asyncRequestHandler):
 	#@sentry.captureTornado
 	def asyncPost(self):
 		newCharts = self.request.uri == "/web/osu-submit-modular-selector.php"
+		batch = None
 		try:
 			# Resend the score in case of unhandled exceptions
 			keepSending = True
@@ -156,11 +156,15 @@ class handler(requestsManager.asyncRequestHandler):
 			# Create score object and set its data
 			log.info("[{}] {} has submitted a score on {}...".format(prefixes[cpi], username, scoreData[0]))
 			
+			# Get beatmap info
+			# This object is used for the whole submission, so the beatmap is loaded only once
+			beatmapInfo = beatmap.beatmap(scoreData[0], 0)
+
 			scoreClass = score.standardScore
 			if UsingRelax:
 				scoreClass = score.relaxScore
 			s = scoreClass()
-			s.setDataFromScoreData(scoreData, quit_=quit_, failed=failed)
+			s.setDataFromScoreData(scoreData, quit_=quit_, failed=failed, b=beatmapInfo)
 			s.playerUserID = userID
 
 			if s.completed == -1:
@@ -171,10 +175,6 @@ class handler(requestsManager.asyncRequestHandler):
 			# Set score stuff missing in score data
 			s.playerUserID = userID
 
-			# Get beatmap info
-			beatmapInfo = beatmap.beatmap()
-			beatmapInfo.setDataFromDB(s.fileMd5)
-
 			# Make sure the beatmap is submitted and updated
 			#if beatmapInfo.rankedStatus == rankedStatuses.NOT_SUBMITTED or beatmapInfo.rankedStatus == rankedStatuses.NEED_UPDATE or beatmapInfo.rankedStatus == rankedStatuses.UNKNOWN:
 			#	log.debug("Beatmap is not submitted/outdated/unknown. Score submission aborted.")
@@ -196,24 +196,20 @@ class handler(requestsManager.asyncRequestHandler):
 				length = userUtils.getBeatmapTime(beatmapInfo.beatmapID)
 			else:
 				length = math.ceil(int(self.get_argument("ft")) / 1000)
-			if UsingRelax:
-				userUtils.incrementPlaytimeRX(userID, s.gameMode, length)
-			else:
-				userUtils.incrementPlaytime(userID, s.gameMode, length)
 			midPPCalcException = None
 			
 			# Send message
 			def send_bot_message(msg):
 				safe_user = username.encode().decode("ASCII", "ignore")
 				alert = "{}, {}".format(safe_user, msg)
-				params = urlencode({"k": glob.conf.config["server"]["apikey"], "to": safe_user, "msg": alert})
-				requests.get("{}/api/v1/fokabotMessage?{}".format(glob.conf.config["server"]["banchourl"], params))
+				jobQueue.enqueue("bot_message", to=safe_user, msg=alert)
 			
 			try:
 				retry = 5
 				while retry > 0:
 					try:
-						s.calculatePP()
+						# No-op if pp has already been calculated while setting the completed status
+						s.calculatePP(beatmapInfo)
 					except Exception as e:
 						retry -= 1
 						if retry > 0:
@@ -236,32 +232,30 @@ class handler(requestsManager.asyncRequestHandler):
 			# Do Restrict
 			def do_restrict(reason, note=None, warnlog=None):
 				userUtils.restrict(userID)
+				writeBatch.afterCommit(lambda: rankIndexHelper.refreshUser(userID))
 				if note:
 					userUtils.appendNotes(userID, note)
 				if warnlog:
 					log.warning(warnlog)
 				if glob.conf.config["discord"]["enable"]:
 					dcnel = glob.conf.config["discord"]["autobanned"]
-					webhook = DiscordWebhook(url=dcnel)
 					embed = DiscordEmbed(title='NEW CHEATER DETECTED!!', description=reason, color=16711680)
-					webhook.add_embed(embed)
-					webhook.execute()
+					jobQueue.enqueue("discord_webhook", url=dcnel, embeds=[embed.__dict__])
 				log.info("CHEATER GOBLOK MASUK DISCORD")
 			
 			# Do Ban
 			def do_ban(reason, note=None, warnlog=None):
 				userUtils.ban(userID)
+				writeBatch.afterCommit(lambda: rankIndexHelper.refreshUser(userID))
 				if note:
 					userUtils.appendNotes(userID, note)
 				if warnlog:
 					log.warning(warnlog)
 				if glob.conf.config["discord"]["enable"]:
 					dcnel = glob.conf.config["discord"]["autobanned"]
-					webhook = DiscordWebhook(url=dcnel)
 					embed = DiscordEmbed(title='NEW CHEATER DETECTED!!', description=reason, color=16711680)
-					webhook.add_embed(embed)
 					log.info("CHEATER GOBLOK MASUK DISCORD")
-					webhook.execute()
+					jobQueue.enqueue("discord_webhook", url=dcnel, embeds=[embed.__dict__])
 			
 			# Restrict obvious cheaters
 			is_fullmod  = bool( (s.mods & (mods.DOUBLETIME | mods.NIGHTCORE)) and (s.mods & mods.FLASHLIGHT) and (s.mods & mods.HARDROCK) and (s.mods & mods.HIDDEN) )
@@ -342,43 +336,7 @@ class handler(requestsManager.asyncRequestHandler):
 			elif invalidPP == 1:
 				s.pp = -1
 			
-			# Save score in db
-			s.saveScoreInDB()
-				
-			# Remove lock as we have the score in the database at this point
-			# and we can perform duplicates check through MySQL
-			log.debug("Resetting score lock key {}".format(lock_key))
-			glob.redis.delete(lock_key)
-			
-			# Client anti-cheat flags
-			if not restricted and glob.conf.extra["mode"]["anticheat"]:
-				haxFlags = scoreData[17].count(' ') # 4 is normal, 0 is irregular but inconsistent.
-				if haxFlags not in (0,4) and s.passed:
-					hack = getHackByFlag(int(haxFlags))
-					if type(hack) == str:
-						# THOT DETECTED
-						if glob.conf.config["discord"]["enable"]:
-							webhook = DiscordWebhook(url=glob.conf.config["discord"]["ahook"])
-							embed = DiscordEmbed(title='This is worst cheater', color=242424)
-							embed = DiscordEmbed(name='Catched some cheater {username} ({userID})')
-							embed = DiscordEmbed(description='This body catched with flag {haxFlags}\nIn enuming: {hack}')
-
-							if glob.conf.extra["mode"]["anticheat"]:
-								webhook.add_embed(embed)
-								webhook.execute()
-
-			'''
-			ignoreFlags = 4
-			if glob.debug:
-				# ignore multiple client flags if we are in debug mode
-				ignoreFlags |= 8
-			haxFlags = (len(scoreData[17])-len(scoreData[17].strip())) & ~ignoreFlags
-			if haxFlags != 0 and not restricted:
-				userHelper.restrict(userID)
-				userHelper.appendNotes(userID, "-- Restricted due to clientside anti cheat flag ({}) (cheated score id: {})".format(haxFlags, s.scoreID))
-				log.warning("**{}** ({}) has been restricted due clientside anti cheat flag **({})**".format(username, userID, haxFlags), "cm")
-			'''
-
+			# Reject invalid scores before opening the transaction, so bans are saved but nothing else is.
 			# bad integer score
 			int64_max = (1 << 63) - 1
 			norm_max  = 1000000
@@ -426,6 +384,53 @@ class handler(requestsManager.asyncRequestHandler):
 					send_bot_message("seems like you've used osu! score submitter limit (Impossible mod combination), this score won't submit for you.")
 					return
 
+			# Score, playtime and stats are written in a single transaction,
+			# committed before building the ranking panel.
+			# Redis, replay and beatmap playcount writes wait for the commit.
+			batch = writeBatch.writeBatch()
+			batch.begin()
+
+			# Update playtime
+			if UsingRelax:
+				userUtils.incrementPlaytimeRX(userID, s.gameMode, length)
+			else:
+				userUtils.incrementPlaytime(userID, s.gameMode, length)
+
+			# Save score in db
+			s.saveScoreInDB()
+			writeBatch.afterCommit(lambda: rankIndexHelper.update(userID, s, UsingRelax))
+				
+			# Remove lock once we have the score in the database
+			# and we can perform duplicates check through MySQL
+			writeBatch.afterCommit(lambda: glob.redis.delete(lock_key))
+			
+			# Client anti-cheat flags
+			if not restricted and glob.conf.extra["mode"]["anticheat"]:
+				haxFlags = scoreData[17].count(' ') # 4 is normal, 0 is irregular but inconsistent.
+				if haxFlags not in (0,4) and s.passed:
+					hack = getHackByFlag(int(haxFlags))
+					if type(hack) == str:
+						# THOT DETECTED
+						if glob.conf.config["discord"]["enable"]:
+							embed = DiscordEmbed(title='This is worst cheater', color=242424)
+							embed = DiscordEmbed(name='Catched some cheater {username} ({userID})')
+							embed = DiscordEmbed(description='This body catched with flag {haxFlags}\nIn enuming: {hack}')
+
+							if glob.conf.extra["mode"]["anticheat"]:
+								jobQueue.enqueue("discord_webhook", url=glob.conf.config["discord"]["ahook"], embeds=[embed.__dict__])
+
+			'''
+			ignoreFlags = 4
+			if glob.debug:
+				# ignore multiple client flags if we are in debug mode
+				ignoreFlags |= 8
+			haxFlags = (len(scoreData[17])-len(scoreData[17].strip())) & ~ignoreFlags
+			if haxFlags != 0 and not restricted:
+				userHelper.restrict(userID)
+				userHelper.appendNotes(userID, "-- Restricted due to clientside anti cheat flag ({}) (cheated score id: {})".format(haxFlags, s.scoreID))
+				log.warning("**{}** ({}) has been restricted due clientside anti cheat flag **({})**".format(username, userID, haxFlags), "cm")
+			'''
+
 			# NOTE: Process logging was removed from the client starting from 20180322
 			if s.completed == 3 and "pl" in self.request.arguments:
 				butterCake.bake(self, s)
@@ -434,38 +439,29 @@ class handler(requestsManager.asyncRequestHandler):
 			# Make sure the score has an id as well (duplicated?, query error?)
 			if s.passed and s.scoreID > 0 and s.completed == 3:
 				if "score" in self.request.files:
-					# Save the replay if it was provided
-					log.debug("Saving replay ({})...".format(s.scoreID))
+					# Save the replay if it was provided, once the score is in the db
 					replay = self.request.files["score"][0]["body"]
+					def saveReplay():
+						log.debug("Saving replay ({})...".format(s.scoreID))
+						if UsingRelax:
+							with open("{}_relax/replay_{}.osr".format(glob.conf.config["server"]["replayspath"], (s.scoreID)), "wb") as f:
+								f.write(replay)
+						else:
+							with open("{}/replay_{}.osr".format(glob.conf.config["server"]["replayspath"], (s.scoreID)), "wb") as f:
+								f.write(replay)
 
-					if UsingRelax:
-						with open("{}_relax/replay_{}.osr".format(glob.conf.config["server"]["replayspath"], (s.scoreID)), "wb") as f:
-							f.write(replay)
-					else:
-						with open("{}/replay_{}.osr".format(glob.conf.config["server"]["replayspath"], (s.scoreID)), "wb") as f:
-							f.write(replay)
-
-					if glob.conf.config["cono"]["enable"]:
-						RPBUILD = replayHelper.buildFullReplay
-						# We run this in a separate thread to avoid slowing down scores submission,
-						# as cono needs a full replay
-						threading.Thread(target=lambda: glob.redis.publish(
-							"cono:analyze", json.dumps({
+						if glob.conf.config["cono"]["enable"]:
+							# We run this in the background to avoid slowing down scores submission,
+							# as cono needs a full replay (built from the replay we've just saved)
+							jobQueue.enqueue("cono_analyze", data={
 								"score_id": s.scoreID,
 								"beatmap_id": beatmapInfo.beatmapID,
 								"user_id": s.playerUserID,
 								"game_mode": s.gameMode,
 								"pp": s.pp,
 								"completed": s.completed,
-								"replay_data": base64.b64encode(
-									RPBUILD(
-										s.scoreID,
-										rawReplay=self.request.files["score"][0]["body"],
-										relax=UsingRelax
-									)
-								).decode(),
-							})
-						)).start()
+							}, relax=bool(UsingRelax))
+					writeBatch.afterCommit(saveReplay)
 				else:
 					# Restrict if no replay was provided
 					if not restricted:
@@ -475,16 +471,18 @@ class handler(requestsManager.asyncRequestHandler):
 							warnlog="**{}** ({}) has been restricted due to not submitting a replay on map {}.".format(username, userID, s.fileMd5) \
 						)
 
-			# Update beatmap playcount (and passcount)
-			beatmap.incrementPlaycount(s.fileMd5, s.passed)
+			# Update beatmap playcount (and passcount) after the commit,
+			# so the beatmap row isn't locked for the whole transaction
+			writeBatch.afterCommit(lambda: beatmap.incrementPlaycount(s.fileMd5, s.passed))
 
 			# Let the api know of this score
 			if s.scoreID:
-				glob.redis.publish("api:score_submission", s.scoreID)
+				writeBatch.afterCommit(lambda: glob.redis.publish("api:score_submission", s.scoreID))
 
 			# Re-raise pp calc exception after saving score, cake, replay etc
 			# so Sentry can track it without breaking score submission
 			if midPPCalcException is not None:
+				batch.commit()
 				raise ppCalcException(midPPCalcException)
 
 			# If there was no exception, update stats and build score submitted panel
@@ -511,19 +509,19 @@ class handler(requestsManager.asyncRequestHandler):
 				# Get new stats
 				if UsingRelax:
 					newUserStats = userUtils.getUserStatsRx(userID, s.gameMode)
-					glob.userStatsCacheRX.update(userID, s.gameMode, newUserStats)
-					leaderboardHelper.update(userID, newUserStats["pp"], s.gameMode, relax=True)
 					maxCombo = userUtils.getMaxComboRX(userID, s.gameMode)
 				else:
 					newUserStats = userUtils.getUserStats(userID, s.gameMode)
-					glob.userStatsCache.update(userID, s.gameMode, newUserStats)
-					leaderboardHelper.update(userID, newUserStats["pp"], s.gameMode)
 					maxCombo = userUtils.getMaxCombo(userID, s.gameMode)
 
-				# Update leaderboard (global and country) if score/pp has changed
-				if s.completed == 3 and newUserStats["pp"] != oldUserStats["pp"]:
+				# Update stats cache and leaderboards (global, and country if score/pp has changed) once the stats are saved
+				def updateLeaderboards():
+					(glob.userStatsCacheRX if UsingRelax else glob.userStatsCache).update(userID, s.gameMode, newUserStats)
 					leaderboardHelper.update(userID, newUserStats["pp"], s.gameMode, relax=UsingRelax)
-					leaderboardHelper.updateCountry(userID, newUserStats["pp"], s.gameMode, relax=UsingRelax)
+					if s.completed == 3 and newUserStats["pp"] != oldUserStats["pp"]:
+						leaderboardHelper.updateCountry(userID, newUserStats["pp"], s.gameMode, relax=UsingRelax)
+				writeBatch.afterCommit(updateLeaderboards)
+				if s.completed == 3 and newUserStats["pp"] != oldUserStats["pp"]:
 					if not restricted and newUserStats['pp'] >= pp_total_max and not totalPPFlag:
 						send_bot_message("hello my fellow little demon! I heard that your performance on {}'s {} is rather outstanding! Why not submit yourself to our guild for an access to next dungeon?".format(gameModes.getGamemodeFull(s.gameMode), prefixes[cpi]))
 
@@ -540,6 +538,9 @@ class handler(requestsManager.asyncRequestHandler):
 			# IP log
 			userUtils.IPLog(userID, ip)
 
+			# Write everything
+			batch.commit()
+
 			# Score submission and stats update done
 			log.debug("Score submission and user stats update done!")
 			oldStats = userUtils.getUserStats(userID, s.gameMode)
@@ -642,10 +643,10 @@ class handler(requestsManager.asyncRequestHandler):
 				if s.completed == 3 and not restricted and beatmapInfo.rankedStatus >= rankedStatuses.RANKED and newScoreboard.personalBestRank > oldPersonalBestRank:
 					if newScoreboard.personalBestRank == 1 and len(newScoreboard.scores) > 2:
 						#woohoo we achieved #1, now we should say to #2 that he sniped!
-						userUtils.logUserLog(messages[2].format(newScoreboard.scores[2].playerName), s.fileMd5, newScoreboard.scores[2].playerUserID, s.gameMode, s.scoreID)
+						jobQueue.enqueue("user_log", message=messages[2].format(newScoreboard.scores[2].playerName), fileMd5=s.fileMd5, userID=newScoreboard.scores[2].playerUserID, gameMode=s.gameMode, scoreID=s.scoreID)
 
 					userLogMsg = messages[0]
-					userUtils.logUserLog(userLogMsg, s.fileMd5, userID, s.gameMode, s.scoreID)
+					jobQueue.enqueue("user_log", message=userLogMsg, fileMd5=s.fileMd5, userID=userID, gameMode=s.gameMode, scoreID=s.scoreID)
 
 				# How many PP you got and did you gain any ranks?
 				ppGained = newUserStats["pp"] - oldUserStats["pp"]
@@ -654,7 +655,7 @@ class handler(requestsManager.asyncRequestHandler):
 				# Get info about score if they passed the map (Ranked)
 				userStats = userUtils.getUserStats(userID, s.gameMode)
 				if s.completed == 3 and not restricted and beatmapInfo.rankedStatus >= rankedStatuses.RANKED and s.pp > 0:
-					glob.redis.publish("scores:new_score", json.dumps({
+					jobQueue.enqueue("publish", channel="scores:new_score", message=json.dumps({
 						"gm":s.gameMode,
 						"user":{"username":username, "userID": userID, "rank":newUserStats["gameRank"],"oldaccuracy":oldStats["accuracy"],"accuracy":newUserStats["accuracy"], "oldpp":oldStats["pp"],"pp":newUserStats["pp"]},
 						"score":{"scoreID": s.scoreID, "mods":s.mods, "accuracy":s.accuracy, "missess":s.cMiss, "combo":s.maxCombo, "pp":s.pp, "rank":newScoreboard.personalBestRank, "ranking":s.rank},
@@ -675,8 +676,7 @@ class handler(requestsManager.asyncRequestHandler):
 						)
 					
 					if not(userUtils.InvisibleBoard(userID) & 2):
-						params = urlencode({"k": glob.conf.config["server"]["apikey"], "to": "#announce", "msg": annmsg})
-						requests.get("{}/api/v1/fokabotMessage?{}".format(glob.conf.config["server"]["banchourl"], params))
+						jobQueue.enqueue("bot_message", to="#announce", msg=annmsg)
 
 					# Let's send them to Discord too, because we cool :sunglasses:
 					# First, let's check what mod does the play have
@@ -717,16 +717,14 @@ class handler(requestsManager.asyncRequestHandler):
 					discordMode = prefixes[cpi]
 					userLink    = 'rx/u' if UsingRelax else 'u'
 					urlweb = glob.conf.config["discord"][discordLink]
-					webhook = DiscordWebhook(url=urlweb)
 					embed = DiscordEmbed(title='New score Achieved!!', description='[{}] Achieved #1 on mode **{}**, {} +{}!'.format(discordMode, gameModes.getGamemodeFull(s.gameMode), beatmapInfo.songName.encode().decode("ASCII", "ignore"), ScoreMods), color=800080)
 					embed.set_author(name='{}'.format(username.encode().decode("ASCII", "ignore")), url='https://osu.troke.id/{}/{}'.format(userLink, userID), icon_url='https://a.troke.id/{}'.format(userID))
 					embed.add_embed_field(name='Accuracy: {}%'.format(s.accuracy * 100), value='Combo: {}{}'.format(s.maxCombo, ('/{}'.format(beatmapInfo.maxCombo) if s.gameMode != gameModes.MANIA else '')))
 					embed.add_embed_field(name='Total: {:.2f}pp'.format(s.pp), value='Gained: {:+.2f}pp'.format(ppGained))
 					embed.add_embed_field(name='Played by: {}'.format(username.encode().decode("ASCII", "ignore")), value="[Go to user's profile]({}/{}/{})".format(glob.conf.config["server"]["serverurl"], userLink, userID))
 					embed.set_thumbnail(url='https://b.ppy.sh/thumb/{}.jpg'.format(beatmapInfo.beatmapSetID))
-					webhook.add_embed(embed)
 					log.info(f"[{discordMode}] Score masuk ke discord bro")
-					webhook.execute()
+					jobQueue.enqueue("discord_webhook", url=urlweb, embeds=[embed.__dict__])
 
 				# Write message to client
 				self.write(output)
@@ -768,6 +766,11 @@ class handler(requestsManager.asyncRequestHandler):
 			self.set_status(408)
 			self.write("error: pass")
 		except:
+			# Discard the writes of a failed submission, and let the client send the score again
+			# (the submission lock is only removed once the score is committed)
+			if batch is not None and batch.rollback():
+				glob.redis.delete(lock_key)
+
 			# Try except block to avoid more errors
 			try:
 				log.error("Unknown error in {}!\n```{}\n{}```".format(MODULE_NAME, sys.exc_info(), traceback.format_exc()))
@@ -781,3 +784,7 @@ class handler(requestsManager.asyncRequestHandler):
 			# because the client will send the score again after some time.
 			if keepSending:
 				self.set_status(408)
+		finally:
+			# Discard the writes of a submission that stopped before committing
+			if batch is not None and batch.rollback():
+				glob.redis.delete(lock_key)
@@ -29,6 +29,12 @@ If any strings are of the wrong length a ValueError is thrown
 import copy
 import base64
 
+try:
+	from helpers import rijndaelFast
+except ImportError:
+	# Not compiled, use the pure python implementation only
+	rijndaelFast = None
+
 shifts = [[[0, 0], [1, 3], [2, 2], [3, 1]],
 		  [[0, 0], [1, 5], [2, 4], [3, 3]],
 		  [[0, 0], [1, 7], [3, 5], [4, 4]]]
@@ -433,6 +439,8 @@ class cbc:
 def decryptRinjdael(key, iv, data, areBase64 = False):
 	"""
 	Where the magic happens
+	Uses the compiled implementation (helpers/rijndaelFast.pyx) if available,
+	otherwise the pure python one.
 
 	key -- AES key (string)
 	IV -- IV thing (string)
@@ -440,9 +448,24 @@ def decryptRinjdael(key, iv, data, areBase64 = False):
 	areBase64 -- if True, iv and data are passed in base64
 	"""
 	if areBase64:
-		iv = base64.b64decode(iv).decode("latin_1")
-		data = base64.b64decode(data).decode("latin_1")
+		iv = base64.b64decode(iv)
+		data = base64.b64decode(data)
+	else:
+		iv = iv.encode("latin_1")
+		data = data.encode("latin_1")
+
+	if rijndaelFast is not None:
+		return str(zeropad(32).unpad(rijndaelFast.decryptCbc(key, iv, data, 32).decode("latin_1")))
+	return decryptRinjdaelReference(key, iv.decode("latin_1"), data.decode("latin_1"))
+
+def decryptRinjdaelReference(key, iv, data):
+	"""
+	Pure python decryptRinjdael
 
+	key -- AES key (string)
+	IV -- IV thing (string)
+	data -- data to decrypt (string)
+	"""
 	r = rijndael(key, 32)
 	p = zeropad(32)
 	c = cbc(p, r, iv)
@@ -1,5 +1,6 @@
 import time
 import datetime
+import threading
 import requests
 from urllib.parse import urlencode
 
@@ -22,34 +23,80 @@ def _wrapper_():
     - Criteria system, which degrades or checks map automatically.
     - Autorank system, which promotes map automatically.
     """
-    """ CRITERIA SYSTEM """
-    def getAllCriteria():
-        return glob.db.fetchAll('select * from beatmaps_criteria_control where active = 1 order by priority desc, criteria_id asc');
-    def getMatchingCriteria(beatmap):
-        criteriaIDs = []
-        mapKey = {
-            'beatmapset_id': 'beatmapSetID',
-            'beatmap_id': 'beatmapID',
-            'creator_id': 'creatorID',
-            'ranked': 'rankedStatus'
-        }
-        for criteria in getAllCriteria():
-            # SANITY CHECK: inactive criteria get out
-            if not criteria['active']:
-                continue
+    """ IN-MEMORY TABLES """
+    # Criteria and autorank tables are small and read on every beatmap load,
+    # so they're loaded all at once and kept in memory for a short while
+    # (or until someone publishes on lets:beatmap_criteria).
+    mapKey = {
+        'beatmapset_id': 'beatmapSetID',
+        'beatmap_id': 'beatmapID',
+        'creator_id': 'creatorID',
+        'ranked': 'rankedStatus'
+    }
+    tables = {'loaded_at': 0}
+    reloadLock = threading.Lock()
+    def reloadTables():
+        """
+        Load criteria and autorank tables from db
+        """
+        criteriaList = []
+        criteriaIndex = {}
+        for criteria in glob.db.fetchAll('select * from beatmaps_criteria_control where active = 1 order by priority desc, criteria_id asc') or []:
             # SKIP IF ALL CRITERIA IS NULL
             checkable = dict((k, criteria[k]) for k in mapKey if criteria[k] is not None)
             if not checkable:
                 continue
+            # Index each criteria by one of its fields, the other ones are checked when matching
+            position = len(criteriaList)
+            criteriaList.append((criteria['criteria_id'], checkable, criteria['stop_on_hit']))
+            indexKey = next(k for k in mapKey if k in checkable)
+            criteriaIndex.setdefault((indexKey, checkable[indexKey]), []).append(position)
+        criteriaActions = {}
+        for act in glob.db.fetchAll('select criteria_id, type, int_value as iv, str_value as sv from beatmaps_criteria_actions') or []:
+            criteriaActions.setdefault(act['criteria_id'], []).append(act)
+        autorankUsers = dict((r['bancho_id'], r) for r in glob.db.fetchAll('select bancho_id, active, datenshi_id from autorank_users') or [])
+        autorankFlags = dict((r['beatmap_id'], r) for r in glob.db.fetchAll('select beatmap_id, flag_valid, flag_lovable from autorank_flags') or [])
+        tables.update({
+            'criteria': criteriaList,
+            'criteria_index': criteriaIndex,
+            'criteria_actions': criteriaActions,
+            'autorank_users': autorankUsers,
+            'autorank_flags': autorankFlags,
+            'loaded_at': time.time(),
+        })
+        log.debug("Loaded {} beatmap criteria and {} autorank users".format(len(criteriaList), len(autorankUsers)))
+    def getTables():
+        ttl = glob.conf.extra["lets"].get("beatmap-criteria", {}).get("ttl", 60)
+        if time.time() - tables['loaded_at'] > ttl:
+            # Only one thread reloads, the other ones keep using the old tables (if there are any)
+            if reloadLock.acquire(blocking=tables['loaded_at'] == 0):
+                try:
+                    if time.time() - tables['loaded_at'] > ttl:
+                        reloadTables()
+                finally:
+                    reloadLock.release()
+        return tables
+
+    """ CRITERIA SYSTEM """
+    def getMatchingCriteria(beatmap):
+        t = getTables()
+        criteriaIDs = []
+        # Only criteria indexed by one of this beatmap's values can match, in priority order
+        candidates = sorted(set(
+            position for k in mapKey
+            for position in t['criteria_index'].get((k, getattr(beatmap,mapKey[k])), [])
+        ))
+        for position in candidates:
+            criteriaID, checkable, stopOnHit = t['criteria'][position]
             # CHECK ALL CRITERIONS HERE
-            if not all(checkable[k] == getattr(beatmap,mapKey[k]) for k in mapKey if k in checkable):
+            if not all(checkable[k] == getattr(beatmap,mapKey[k]) for k in checkable):
                 continue
-            criteriaIDs.append(criteria['criteria_id'])
-            if criteria['stop_on_hit']:
+            criteriaIDs.append(criteriaID)
+            if stopOnHit:
                 break
         return criteriaIDs
     def getCriteriaAction(criteriaID):
-        return glob.db.fetchAll('select type, int_value as iv, str_value as sv from beatmaps_criteria_actions where criteria_id = %s',[criteriaID])
+        return getTables()['criteria_actions'].get(criteriaID, [])
     
     def criteria__0001RankStatus(beatmap,iv,sv):
         if beatmap.rankedStatusFrozen:
@@ -88,22 +135,22 @@ def _wrapper_():
                     criteriaActions[act['type']](beatmap,act['iv'],act['sv'])
     
     """ AUTORANK SYSTEM """
-    def autorankQueryWrapper(field, table, key, value):
-        r = glob.db.fetch("SELECT {field} as f FROM {table} WHERE {key} = %s".format(field=field,table=table,key=key),[value])
+    def autorankQueryWrapper(field, table, value):
+        r = getTables()[table].get(value)
         if r is None:
             return False
-        return bool(r['f'])
+        return bool(r[field])
     def autorankActive(banchoID):
-        return autorankQueryWrapper('active','autorank_users','bancho_id', banchoID)
+        return autorankQueryWrapper('active','autorank_users', banchoID)
     def autorankUserID(banchoID):
-        r = glob.db.fetch("SELECT datenshi_id as user_id FROM autorank_users WHERE bancho_id = %s",[banchoID])
+        r = getTables()['autorank_users'].get(banchoID)
         if r is None:
             return None
-        return r['user_id']
+        return r['datenshi_id']
     def autorankFlagOK(beatmapID):
-        return autorankQueryWrapper('flag_valid','autorank_flags','beatmap_id', beatmapID)
+        return autorankQueryWrapper('flag_valid','autorank_flags', beatmapID)
     def autorankFlagForLove(beatmapID):
-        return autorankQueryWrapper('flag_lovable','autorank_flags','beatmap_id', beatmapID)
+        return autorankQueryWrapper('flag_lovable','autorank_flags', beatmapID)
     def autorankAnnounce(beatmap):
         if beatmap.rankedStatus >= 0:
             status = 'disqualified update ranked approved qualified loved'.split()[beatmap.rankedStatus]
@@ -175,13 +222,14 @@ def _wrapper_():
             beatmap.rankedStatusFrozen = 0
         if rankStatus != beatmap.rankedStatus:
             glob.db.execute('update beatmaps set ranked_status_freezed = 0 where beatmap_md5 = %s', [beatmap.fileMD5])
+            glob.beatmapCache.invalidate([beatmap.fileMD5])
             autorankAnnounce(beatmap)
         if needWipe:
             log.info(f"Wiping {beatmap.fileMD5} leaderboard")
             beatmap.clearLeaderboard()
             pass
     
-    whitelistFunList = [criteriaControl,autorankCheck]
+    whitelistFunList = [criteriaControl,autorankCheck,reloadTables]
     whitelistFun = {}
     for f in whitelistFunList:
         whitelistFun[f.__name__] = f
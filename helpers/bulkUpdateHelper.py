@@ -0,0 +1,158 @@
+"""
+Bulk column updates by primary key
+
+Staged (id, values...) rows are inserted in a temporary table with multi-row INSERTs
+and applied to the real table with a single joined UPDATE per batch, instead of
+running one UPDATE ... WHERE id = %s LIMIT 1 per row.
+The transaction is committed every commitInterval seconds, and when the updater is closed.
+
+Usage:
+	updater = bulkUpdateHelper.bulkUpdater("scores", ("pp", "pp_version"), ("FLOAT", "SMALLINT UNSIGNED"), batchSize=1000)
+	try:
+		for scoreID, pp in results:
+			updater.add(scoreID, pp, ppVersion)
+	finally:
+		updater.close()
+"""
+import hashlib
+import re
+import time
+
+import MySQLdb.cursors
+
+from objects import glob
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_COMMIT_INTERVAL = 5
+
+_identifier = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+class bulkUpdater:
+	def __init__(self, table, columns, valueTypes = "FLOAT", batchSize = DEFAULT_BATCH_SIZE, commitInterval = DEFAULT_COMMIT_INTERVAL):
+		"""
+		Check out a db connection and create the staging table
+
+		table -- table to update. Its primary key must be `id`.
+		columns -- column to update, or tuple of columns
+		valueTypes -- SQL type of the column in the staging table, or tuple of types (one per column)
+		batchSize -- number of rows staged before they're applied to the table
+		commitInterval -- seconds between commits. 0 commits after every batch.
+		"""
+		self.columns = (columns,) if type(columns) is str else tuple(columns)
+		valueTypes = (valueTypes,) * len(self.columns) if type(valueTypes) is str else tuple(valueTypes)
+		if not _identifier.match(table) or not all(_identifier.match(x) for x in self.columns):
+			raise ValueError("Invalid table or column name")
+		if len(valueTypes) != len(self.columns):
+			raise ValueError("There must be one value type per column")
+		self.table = table
+		self.batchSize = max(int(batchSize), 1)
+		self.commitInterval = commitInterval
+		self.staging = "bulk_{}_{}".format(table, "_".join(self.columns))
+		if len(self.staging) > 64:
+			# MySQL identifiers can't be longer than 64 characters
+			self.staging = "bulk_{}_{}".format(table, hashlib.md5("_".join(self.columns).encode()).hexdigest())[:64]
+		self.rows = []
+		self.updatedRows = 0
+		self.committedRows = 0
+		self.lastCommit = time.time()
+		self.worker = glob.db.pool.getWorker()
+		if self.worker is None:
+			raise RuntimeError("No database worker available")
+		try:
+			self.worker.connection.autocommit(False)
+			self._execute(
+				"CREATE TEMPORARY TABLE IF NOT EXISTS {} (id INT UNSIGNED NOT NULL PRIMARY KEY, {}) ENGINE=MEMORY".format(
+					self.staging, ", ".join("{} {} NOT NULL".format(x, y) for x, y in zip(self.columns, valueTypes))
+				)
+			)
+			self._execute("DELETE FROM {}".format(self.staging))
+		except:
+			self._release()
+			raise
+
+	def _execute(self, query, params = None, many = False):
+		cursor = self.worker.connection.cursor(MySQLdb.cursors.Cursor)
+		try:
+			if many:
+				cursor.executemany(query, params)
+			else:
+				cursor.execute(query, params)
+			return cursor.rowcount
+		finally:
+			cursor.close()
+
+	def _release(self):
+		try:
+			self._execute("DROP TEMPORARY TABLE IF EXISTS {}".format(self.staging))
+			self.worker.connection.autocommit(True)
+		finally:
+			glob.db.pool.putWorker(self.worker)
+			self.worker = None
+
+	def add(self, id_, *values):
+		"""
+		Stage new values for a row. Staged rows are applied once there are batchSize of them.
+
+		id_ -- row id
+		values -- new columns values, in the same order as columns
+		"""
+		if len(values) != len(self.columns):
+			raise ValueError("There must be one value per column")
+		self.rows.append((id_,) + values)
+		if len(self.rows) >= self.batchSize:
+			self.flush()
+
+	def flush(self):
+		"""
+		Apply every staged row to the table, and commit if commitInterval seconds have passed
+		"""
+		if self.rows:
+			# executemany turns this into multi-row INSERTs
+			self._execute(
+				"INSERT INTO {} (id, {}) VALUES ({})".format(
+					self.staging, ", ".join(self.columns), ", ".join(["%s"] * (len(self.columns) + 1))
+				),
+				self.rows,
+				many=True
+			)
+			self._execute(
+				"UPDATE {table} JOIN {staging} ON {table}.id = {staging}.id SET {values}".format(
+					table=self.table,
+					staging=self.staging,
+					values=", ".join("{0}.{2} = {1}.{2}".format(self.table, self.staging, x) for x in self.columns)
+				)
+			)
+			self._execute("DELETE FROM {}".format(self.staging))
+			self.updatedRows += len(self.rows)
+			self.rows = []
+		if time.time() - self.lastCommit >= self.commitInterval:
+			self.commit()
+
+	def commit(self):
+		"""
+		Commit every applied row
+		"""
+		try:
+			self.worker.connection.commit()
+		except:
+			self.worker.connection.rollback()
+			raise
+		self.committedRows = self.updatedRows
+		self.lastCommit = time.time()
+
+	def close(self):
+		"""
+		Apply and commit the remaining rows, and give the db connection back to the pool
+		"""
+		if self.worker is None:
+			return
+		try:
+			if self.rows:
+				self.flush()
+			self.commit()
+		except:
+			self.worker.connection.rollback()
+			raise
+		finally:
+			self._release()
@@ -0,0 +1,285 @@
+"""
+Background jobs for LETS
+
+Side effects that don't affect the client's response (discord webhooks, fokabot messages,
+user logs, pubsub messages for other services...) are pushed to a redis list and run
+by worker threads, so score submission doesn't wait on third-party HTTP latency.
+
+- The queue is bounded (oldest jobs are dropped when it's full) and lives outside lets:*,
+  so it survives restarts. A job popped by a worker is kept in the worker's processing
+  key until it's done. Processing keys belong to a lets instance (hostname:pid), which keeps
+  a heartbeat key alive while it runs, so several instances can share the queue. Jobs left
+  in the processing keys of an instance whose heartbeat has expired (crashed) are put back
+  in the queue by the other instances, or by the next start.
+- Failed jobs are retried with exponential backoff, up to max-attempts times.
+- Jobs with a destination are rate limited per destination (jobs per second).
+
+Configured in the additional config file, eg:
+	"lets": {
+		"job-queue": {
+			"enable": true, "workers": 2, "max-length": 10000, "max-attempts": 5, "backoff": 2,
+			"rate-limits": {"discord": 1, "bancho": 5}
+		}
+	}
+If disabled, jobs are run right away in the calling thread.
+"""
+import base64
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+import requests
+
+from common.log import logUtils as log
+from common.ripple import userUtils
+from discord_webhook import DiscordWebhook
+from helpers import replayHelper
+from helpers import writeBatch
+from objects import glob
+
+QUEUE_KEY = "ripple:lets_jobs"
+DELAYED_KEY = "ripple:lets_jobs:delayed"
+PROCESSING_KEY = "ripple:lets_jobs:processing:{}:{}"
+INSTANCE_KEY = "ripple:lets_jobs:instance:{}"
+RATE_KEY = "ripple:lets_jobs:rate:{}:{}"
+
+DEFAULT_RATE_LIMITS = {"discord": 1, "bancho": 5}
+
+# The heartbeat is refreshed every HEARTBEAT_INTERVAL seconds by its own thread,
+# an instance that hasn't refreshed it for INSTANCE_TTL seconds is considered dead
+INSTANCE = "{}:{}".format(socket.gethostname(), os.getpid())
+INSTANCE_TTL = 30
+HEARTBEAT_INTERVAL = 10
+
+_handlers = {}
+_threads = []
+_stopping = threading.Event()
+
+
+def job(jobType, destination=None):
+	"""
+	Register a job handler
+
+	jobType -- job type name
+	destination -- rate limit bucket for this job type. Optional.
+	"""
+	def decorator(f):
+		_handlers[jobType] = (f, destination)
+		return f
+	return decorator
+
+
+def _conf():
+	return glob.conf.extra["lets"].get("job-queue", {})
+
+
+def enqueue(jobType, **kwargs):
+	"""
+	Add a job to the queue
+
+	jobType -- job type name
+	kwargs -- job handler arguments, must be json serializable
+	"""
+	if writeBatch.current() is not None:
+		# The job may need what's being written, queue it once it's committed
+		writeBatch.afterCommit(lambda: enqueue(jobType, **kwargs))
+		return
+	if not _threads:
+		# Queue disabled or not started, run it now
+		try:
+			_handlers[jobType][0](**kwargs)
+		except Exception as e:
+			log.error("Job {} failed ({})".format(jobType, e))
+		return
+	maxLength = int(_conf().get("max-length", 10000))
+	pipe = glob.redis.pipeline()
+	# The id keeps identical jobs apart in the delayed jobs sorted set
+	pipe.lpush(QUEUE_KEY, json.dumps({"id": uuid.uuid4().hex, "type": jobType, "args": kwargs, "attempts": 0}))
+	pipe.ltrim(QUEUE_KEY, 0, maxLength - 1)
+	pipe.execute()
+
+
+def _delay(rawJob, seconds):
+	glob.redis.zadd(DELAYED_KEY, rawJob, time.time() + seconds)
+
+
+def _moveDueJobs():
+	"""
+	Move delayed jobs that are due back to the queue
+	"""
+	for rawJob in glob.redis.zrangebyscore(DELAYED_KEY, "-inf", time.time(), 0, 100):
+		# Only the thread that removes the job re-queues it
+		if glob.redis.zrem(DELAYED_KEY, rawJob):
+			glob.redis.lpush(QUEUE_KEY, rawJob)
+
+
+def _heartbeat():
+	glob.redis.set(INSTANCE_KEY.format(INSTANCE), "1", INSTANCE_TTL)
+
+
+def _requeueOrphans():
+	"""
+	Put back in the queue the jobs left in the processing keys of dead instances
+	"""
+	for key in glob.redis.scan_iter(match=PROCESSING_KEY.format("*", "*")):
+		key = key.decode() if type(key) is bytes else key
+		# ripple:lets_jobs:processing:hostname:pid:index
+		instance = key.split(":", 3)[3].rsplit(":", 1)[0]
+		if instance == INSTANCE or glob.redis.exists(INSTANCE_KEY.format(instance)):
+			continue
+		while glob.redis.rpoplpush(key, QUEUE_KEY) is not None:
+			pass
+		log.warning("Re-queued the jobs left behind by lets instance {}".format(instance))
+
+
+def _rateLimited(destination):
+	"""
+	Count a job for this destination in the current second
+
+	destination -- rate limit bucket
+	return -- True if the destination has already reached its limit
+	"""
+	limit = _conf().get("rate-limits", DEFAULT_RATE_LIMITS).get(destination)
+	if limit is None:
+		return False
+	key = RATE_KEY.format(destination, int(time.time()))
+	pipe = glob.redis.pipeline()
+	pipe.incr(key)
+	pipe.expire(key, 2)
+	count, _ = pipe.execute()
+	return count > limit
+
+
+def _run(rawJob):
+	data = json.loads(rawJob.decode("utf-8"))
+	if data["type"] not in _handlers:
+		log.error("Unknown job type {}, dropping it".format(data["type"]))
+		return
+	handler, destination = _handlers[data["type"]]
+	if destination is not None and _rateLimited(destination):
+		_delay(rawJob, 1)
+		return
+	try:
+		handler(**data["args"])
+	except Exception as e:
+		data["attempts"] += 1
+		maxAttempts = int(_conf().get("max-attempts", 5))
+		if data["attempts"] >= maxAttempts:
+			log.error("Job {} failed {} times, dropping it ({})".format(data["type"], data["attempts"], e))
+			glob.dog.increment(glob.DATADOG_PREFIX+".failed_jobs")
+			return
+		backoff = float(_conf().get("backoff", 2)) * 2 ** (data["attempts"] - 1)
+		log.warning("Job {} failed ({}), retrying in {} seconds".format(data["type"], e, backoff))
+		_delay(json.dumps(data), backoff)
+
+
+def _keepAlive():
+	"""
+	Refresh this instance's heartbeat, and pick up the jobs of instances that crashed while running
+	"""
+	while not _stopping.wait(HEARTBEAT_INTERVAL):
+		try:
+			_heartbeat()
+			_requeueOrphans()
+		except Exception as e:
+			log.error("Job queue heartbeat error: {}".format(e))
+
+
+def _work(index):
+	processingKey = PROCESSING_KEY.format(INSTANCE, index)
+	while not _stopping.is_set():
+		try:
+			_moveDueJobs()
+			rawJob = glob.redis.brpoplpush(QUEUE_KEY, processingKey, 1)
+			if rawJob is None:
+				continue
+			_run(rawJob)
+			glob.redis.delete(processingKey)
+		except Exception as e:
+			log.error("Job queue worker {} error: {}".format(index, e))
+			time.sleep(1)
+
+
+def start():
+	"""
+	Start the job queue workers, re-queuing jobs left behind by crashed instances
+	"""
+	conf = _conf()
+	if not conf.get("enable", True):
+		log.info("Job queue disabled, jobs will run synchronously")
+		return
+	_stopping.clear()
+	_heartbeat()
+	_requeueOrphans()
+	for i in range(int(conf.get("workers", 2))):
+		t = threading.Thread(target=_work, args=(i,), daemon=True)
+		t.start()
+		_threads.append(t)
+	t = threading.Thread(target=_keepAlive, daemon=True)
+	t.start()
+	_threads.append(t)
+
+
+def stop():
+	"""
+	Stop the job queue workers. Queued jobs will be run on the next start.
+	"""
+	_stopping.set()
+	for t in _threads:
+		t.join(5)
+	del _threads[:]
+
+
+@job("discord_webhook", destination="discord")
+def discordWebhook(url, embeds):
+	"""
+	Send embeds to a discord webhook
+
+	url -- webhook url
+	embeds -- list of DiscordEmbed objects or dicts
+	"""
+	response = DiscordWebhook(
+		url=url, embeds=[x if type(x) is dict else x.__dict__ for x in embeds], timeout=10
+	).execute()
+	if response.status_code == 429 or response.status_code >= 500:
+		raise Exception("discord returned {}".format(response.status_code))
+
+
+@job("bot_message", destination="bancho")
+def botMessage(to, msg):
+	"""
+	Send a chat message through FokaBot
+
+	to -- username or channel
+	msg -- message
+	"""
+	params = urlencode({"k": glob.conf.config["server"]["apikey"], "to": to, "msg": msg})
+	requests.get(
+		"{}/api/v1/fokabotMessage?{}".format(glob.conf.config["server"]["banchourl"], params), timeout=10
+	).raise_for_status()
+
+
+@job("user_log")
+def userLog(message, fileMd5, userID, gameMode, scoreID):
+	userUtils.logUserLog(message, fileMd5, userID, gameMode, scoreID)
+
+
+@job("publish")
+def publish(channel, message):
+	glob.redis.publish(channel, message)
+
+
+@job("cono_analyze")
+def conoAnalyze(data, relax):
+	"""
+	Send a score's full replay to cono
+
+	data -- cono:analyze message, without replay_data
+	relax -- True if it's a relax score
+	"""
+	data["replay_data"] = base64.b64encode(replayHelper.buildFullReplay(data["score_id"], relax=relax)).decode()
+	glob.redis.publish("cono:analyze", json.dumps(data))
@@ -1,8 +1,27 @@
+import uuid
+
+from common.constants import privileges
 from common.log import logUtils as log
 from common.ripple import scoreUtils
+from constants import exceptions
 from objects import glob
 from common.ripple import userUtils
 
+# Users read from MySQL with each query while rebuilding leaderboards, and members sent with each ZADD
+REBUILD_BATCH_SIZE = 5000
+REBUILD_ZADD_SIZE = 1000
+
+# Leaderboards are built here and renamed into place when they're complete
+REBUILD_KEY = "lets:leaderboard_rebuild:{}"
+
+# Only one rebuild at a time (CLI or API), so they don't overwrite each other's temporary keys.
+# The lock holds a random token and is renewed after every batch. It expires if its rebuild dies.
+REBUILD_LOCK_KEY = "lets:leaderboard_rebuild_lock"
+REBUILD_LOCK_EXPIRE = 600
+# Renew/release the lock only if it's still ours
+RENEW_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+RELEASE_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
 def getRankInfo(userID, gameMode, relax=False):
 	"""
 	Get userID's current rank, user above us and pp/score difference
@@ -79,3 +98,106 @@ def updateCountry(userID, newScore, gameMode, relax=False):
 			glob.redis.zadd(k, str(userID), str(newScore))
 	else:
 		log.debug("Country leaderboard update for user {} skipped (not allowed)".format(userID))
+
+def _leaderboardKey(gameMode, relax=False, country=None):
+	k = "ripple:leaderboard_relax:{}" if relax else "ripple:leaderboard:{}"
+	k = k.format(scoreUtils.readableGameMode(gameMode))
+	if country is not None:
+		k += ":{}".format(country)
+	return k
+
+def rebuild(gameModes=range(4), relax=False, batchSize=REBUILD_BATCH_SIZE):
+	"""
+	Rebuild global and country leaderboards from the users stats in db.
+	Stats are streamed from MySQL batchSize users at a time and every sorted set is built
+	in a temporary key with pipelined ZADDs. When they're all complete, they replace the
+	old leaderboards in a single MULTI/EXEC (RENAME), so readers never see a half-built one.
+	Country leaderboards with no users left are deleted.
+	Leaderboard updates made while rebuilding (score submissions) are overwritten.
+
+	:param gameModes: game mode numbers to rebuild. Default: all of them.
+	:param relax: if True, rebuild relax leaderboards (rx_stats)
+	:param batchSize: number of users read with each query
+	:raises exceptions.leaderboardRebuildLockedError: if another rebuild is running
+	:return: {leaderboard key: number of users}
+	"""
+	token = uuid.uuid4().hex
+	if not glob.redis.set(REBUILD_LOCK_KEY, token, REBUILD_LOCK_EXPIRE, nx=True):
+		raise exceptions.leaderboardRebuildLockedError()
+	try:
+		return _rebuild(list(gameModes), relax, batchSize, token)
+	finally:
+		glob.redis.eval(RELEASE_LOCK, 1, REBUILD_LOCK_KEY, token)
+
+def isRebuilding():
+	"""
+	Check if a leaderboard rebuild is running
+
+	:return: True if the rebuild lock is taken
+	"""
+	return glob.redis.exists(REBUILD_LOCK_KEY)
+
+def _rebuild(gameModes, relax, batchSize, token):
+	statsTable = "rx_stats" if relax else "users_stats"
+	columns = ", ".join("s.pp_{0} AS pp_{0}".format(scoreUtils.readableGameMode(x)) for x in gameModes)
+	allowed = privileges.USER_NORMAL | privileges.USER_PUBLIC
+	counts = {}
+
+	# Remove leftovers of a rebuild that didn't complete
+	for gameMode in gameModes:
+		tempKey = REBUILD_KEY.format(_leaderboardKey(gameMode, relax))
+		tempKeys = [tempKey] + list(glob.redis.scan_iter(match=tempKey + ":*"))
+		glob.redis.delete(*tempKeys)
+
+	lastID = 0
+	while True:
+		# Country is stored in users_stats, for relax too
+		rows = glob.db.fetchAll(
+			"SELECT users.id AS id, us.country AS country, {columns} FROM users "
+			"JOIN {stats} AS s ON s.id = users.id "
+			"JOIN users_stats AS us ON us.id = users.id "
+			"WHERE users.id > %s AND users.privileges & %s = %s "
+			"ORDER BY users.id LIMIT {limit}".format(columns=columns, stats=statsTable, limit=int(batchSize)),
+			[lastID, allowed, allowed]
+		)
+		if not rows:
+			break
+		lastID = rows[-1]["id"]
+
+		members = {}
+		for gameMode in gameModes:
+			column = "pp_{}".format(scoreUtils.readableGameMode(gameMode))
+			for row in rows:
+				if not row[column] or row[column] <= 0:
+					continue
+				keys = [_leaderboardKey(gameMode, relax)]
+				country = (row["country"] or "").lower()
+				if country and country != "xx":
+					keys.append(_leaderboardKey(gameMode, relax, country))
+				for k in keys:
+					members.setdefault(k, []).extend((str(row["id"]), str(row[column])))
+
+		pipe = glob.redis.pipeline(transaction=False)
+		for k, values in members.items():
+			for i in range(0, len(values), REBUILD_ZADD_SIZE * 2):
+				pipe.zadd(REBUILD_KEY.format(k), *values[i:i + REBUILD_ZADD_SIZE * 2])
+			counts[k] = counts.get(k, 0) + len(values) // 2
+		pipe.eval(RENEW_LOCK, 1, REBUILD_LOCK_KEY, token, REBUILD_LOCK_EXPIRE)
+		if not pipe.execute()[-1]:
+			# The lock expired and someone else may be rebuilding with the same temporary keys
+			raise exceptions.leaderboardRebuildLockedError()
+
+	# Swap the new leaderboards in, and delete global/country ones that are now empty
+	pipe = glob.redis.pipeline(transaction=True)
+	for gameMode in gameModes:
+		globalKey = _leaderboardKey(gameMode, relax)
+		oldKeys = {globalKey}
+		oldKeys.update(x.decode() if type(x) is bytes else x for x in glob.redis.scan_iter(match=globalKey + ":*"))
+		for k in oldKeys:
+			if k not in counts:
+				pipe.delete(k)
+	for k in counts:
+		pipe.rename(REBUILD_KEY.format(k), k)
+	pipe.execute()
+	log.info("Rebuilt {} {}leaderboards".format(len(counts), "relax " if relax else ""))
+	return counts
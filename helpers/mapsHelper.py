@@ -1,4 +1,7 @@
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from common import generalUtils
 from common.log import logUtils as log
@@ -20,20 +23,81 @@ def isBeatmap(fileName=None, content=None):
         raise ValueError("Either `fileName` or `content` must be provided.")
     return firstLine.lower().startswith("osu file format v")
 
+def _tempPath(path):
+    return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+def _atomicWrite(path, content):
+    """
+    Write a file so readers never see it half written
+
+    :param path: file path
+    :param content: file content (bytes)
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = _tempPath(path)
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+def _link(mapFile, storedFile):
+    """
+    Make mapFile a symlink to a file in the store, replacing it atomically if it points somewhere else
+
+    :param mapFile: path used by the pp calculator
+    :param storedFile: path of the .osu file in the store
+    :return:
+    """
+    target = os.path.abspath(storedFile)
+    if os.path.islink(mapFile) and os.readlink(mapFile) == target:
+        return
+    os.makedirs(os.path.dirname(mapFile) or ".", exist_ok=True)
+    tmp = _tempPath(mapFile)
+    os.symlink(target, tmp)
+    os.replace(tmp, mapFile)
+
+def storedMapPath(md5):
+    """
+    Path of a .osu file in the content addressed store.
+    Files are never changed once written, so if it exists it's the right file.
+
+    :param md5: .osu file md5
+    :return: path, {beatmapspath}/store/ab/abcdef....osu
+    """
+    return "{}/store/{}/{}.osu".format(glob.conf.config["server"]["beatmapspath"], md5[:2], md5)
+
+def isCached(_beatmap):
+    """
+    Check if a beatmap's .osu file is in the store
+
+    :param _beatmap: beatmap object
+    :return: True if it is
+    """
+    return os.path.isfile(storedMapPath(_beatmap.fileMD5))
+
 def cacheMap(mapFile, _beatmap):
-    # Check if we have to download the .osu file
-    download = False
-    if not os.path.isfile(mapFile):
-        # .osu file doesn't exist. We must download it
-        download = True
-    else:
-        # File exists, check md5
-        if generalUtils.fileMd5(mapFile) != _beatmap.fileMD5 or not isBeatmap(mapFile):
-            # MD5 don't match, redownload .osu file
-            download = True
+    """
+    Make sure mapFile is the .osu file of _beatmap, downloading it if it's not in the store.
+    mapFile becomes a symlink to the stored file, so the same .osu file is shared by every calculator.
+
+    :param mapFile: path where the pp calculator expects the .osu file
+    :param _beatmap: beatmap object
+    :return:
+    """
+    storedFile = storedMapPath(_beatmap.fileMD5)
+    if not os.path.isfile(storedFile) and os.path.isfile(mapFile) and not os.path.islink(mapFile):
+        # Old flat .osu file, move it to the store if it's still the right one
+        try:
+            if generalUtils.fileMd5(mapFile) == _beatmap.fileMD5 and isBeatmap(mapFile):
+                log.debug("maps ~> Moving {} osu file to the store".format(_beatmap.beatmapID))
+                os.makedirs(os.path.dirname(storedFile), exist_ok=True)
+                os.replace(mapFile, storedFile)
+        except OSError:
+            # Moved by another thread in the meantime
+            pass
 
     # Download .osu file if needed
-    if download:
+    if not os.path.isfile(storedFile):
         log.debug("maps ~> Downloading {} osu file".format(_beatmap.beatmapID))
 
         # Get .osu file from osu servers
@@ -43,17 +107,60 @@ def cacheMap(mapFile, _beatmap):
         if fileContent is None or not isBeatmap(content=fileContent):
             raise exceptions.osuApiFailException("maps")
 
-        # Delete old .osu file if it exists
-        # if os.path.isfile(mapFile):
-        #    os.remove(mapFile)
-        # why remove? "w" is overwrite operation.
-
-        # Save .osu file
-        with open(mapFile, "wb+") as f:
-            f.write(fileContent)
+        # Store it by its own md5. If it's a newer version of the beatmap, it'll be downloaded again next time.
+        contentMd5 = hashlib.md5(fileContent).hexdigest()
+        if contentMd5 != _beatmap.fileMD5:
+            log.warning("maps ~> Downloaded {} osu file has a different md5 ({})".format(_beatmap.beatmapID, contentMd5))
+            storedFile = storedMapPath(contentMd5)
+        _atomicWrite(storedFile, fileContent)
     else:
         # Map file is already in folder
         log.debug("maps ~> Beatmap found in cache!")
 
+    _link(mapFile, storedFile)
+
+# Background .osu downloads requested by getscores
+_prefetchExecutor = None
+_prefetching = set()
+_prefetchLock = threading.Lock()
+
+def _prefetchConf():
+    return glob.conf.extra["lets"].get("osu-prefetch", {})
+
+def _prefetchJob(_beatmap):
+    try:
+        cacheMap(cachedMapPath(_beatmap.beatmapID), _beatmap)
+    except Exception as e:
+        log.warning("maps ~> Couldn't prefetch {} osu file ({})".format(_beatmap.beatmapID, e))
+    finally:
+        with _prefetchLock:
+            _prefetching.discard(_beatmap.fileMD5)
+
+def prefetch(_beatmap):
+    """
+    Download a beatmap's .osu file in background if it's not in the store yet,
+    so it's already there when the scores set on it are submitted.
+    At most osu-prefetch.workers downloads run at the same time, and at most
+    osu-prefetch.max-queued are waiting; more requests are ignored.
+
+    :param _beatmap: beatmap object
+    :return:
+    """
+    global _prefetchExecutor
+    conf = _prefetchConf()
+    if not conf.get("enable", True) or isCached(_beatmap):
+        return
+    with _prefetchLock:
+        if _beatmap.fileMD5 in _prefetching or len(_prefetching) >= int(conf.get("max-queued", 100)):
+            return
+        # Another LETS process may be downloading it already
+        if not glob.redis.set("lets:osu_prefetch:{}".format(_beatmap.fileMD5), "1", 60, nx=True):
+            return
+        if _prefetchExecutor is None:
+            _prefetchExecutor = ThreadPoolExecutor(max_workers=int(conf.get("workers", 2)))
+        _prefetching.add(_beatmap.fileMD5)
+    log.debug("maps ~> Prefetching {} osu file".format(_beatmap.beatmapID))
+    _prefetchExecutor.submit(_prefetchJob, _beatmap)
+
 def cachedMapPath(beatmap_id):
     return "{}/{}.osu".format(glob.conf.config["server"]["beatmapspath"], beatmap_id)
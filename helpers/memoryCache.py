@@ -0,0 +1,92 @@
+"""
+Small in-process LRU cache with expiring entries
+
+Used for data that's read on every request, changes rarely and can be a bit stale
+(eg: clan tags), so hot values don't cost a MySQL/redis round trip each time.
+Every LETS process has its own copy, so entries must be invalidated by
+pubsub or expire on their own if they're changed elsewhere.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class memoryCache:
+	def __init__(self, maxSize = 1024, ttl = 60):
+		"""
+		Initialize a cache
+
+		maxSize -- max number of entries. The least recently used ones are removed first.
+		ttl -- seconds after which an entry expires
+		"""
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default = None):
+		"""
+		Get a cached value
+
+		key -- entry key
+		default -- value to return if the key is not cached or expired
+		return -- cached value or default
+		"""
+		with self._lock:
+			entry = self._data.get(key, _missing)
+			if entry is _missing:
+				return default
+			if entry[0] < time.time():
+				del self._data[key]
+				return default
+			self._data.move_to_end(key)
+			return entry[1]
+
+	def getMany(self, keys):
+		"""
+		Get multiple cached values
+
+		keys -- entries keys
+		return -- dictionary with the cached (not expired) keys only
+		"""
+		result = {}
+		for key in keys:
+			value = self.get(key, _missing)
+			if value is not _missing:
+				result[key] = value
+		return result
+
+	def set(self, key, value):
+		"""
+		Cache a value
+
+		key -- entry key
+		value -- value
+		"""
+		with self._lock:
+			self._data[key] = (time.time() + self.ttl, value)
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxSize:
+				self._data.popitem(last=False)
+
+	def delete(self, *keys):
+		"""
+		Remove some entries. Keys that aren't cached are ignored.
+
+		keys -- entries keys
+		"""
+		with self._lock:
+			for key in keys:
+				self._data.pop(key, None)
+
+	def clear(self):
+		"""
+		Remove every entry
+		"""
+		with self._lock:
+			self._data.clear()
+
+	def __len__(self):
+		return len(self._data)
@@ -1,13 +1,28 @@
 import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import quote
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from common.log import logUtils as log
 from common import generalUtils
 from objects import glob
 from constants import exceptions
 
+# One HTTP session for every osu!api request, so connections are reused
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# Threads that send the per-mode requests of getBeatmapAllModes in parallel
+_executor = ThreadPoolExecutor(max_workers=16)
+
+# get_beatmaps lookups currently running, so concurrent requests for the same beatmap share them
+_inFlight = {}
+_inFlightLock = threading.Lock()
+
 
 def osuApiRequest(request, params, getFirst=True):
 	"""
@@ -27,7 +42,7 @@ def osuApiRequest(request, params, getFirst=True):
 	try:
 		finalURL = "{}/api/{}?k={}&{}".format(glob.conf.config["osuapi"]["apiurl"], request, glob.conf.config["osuapi"]["apikey"], params)
 		log.debug(finalURL)
-		resp = requests.get(finalURL, timeout=5).text
+		resp = _session.get(finalURL, timeout=5).text
 		data = json.loads(resp)
 		if getFirst:
 			if len(data) >= 1:
@@ -41,6 +56,41 @@ def osuApiRequest(request, params, getFirst=True):
 		log.debug(str(resp).encode("utf-8"))
 		return resp
 
+def getBeatmapAllModes(key, value):
+	"""
+	Get a beatmap from osu!api in every game mode (with converts).
+	The four requests are sent in parallel, and if the same lookup is
+	already running in another thread, its result is used instead.
+
+	key -- get_beatmaps parameter, h (md5) or s (beatmap set id)
+	value -- md5 or beatmap set id
+	return -- list with std, taiko, ctb and mania osu!api data (None if not found)
+	"""
+	flightKey = (key, value)
+	with _inFlightLock:
+		future = _inFlight.get(flightKey)
+		leader = future is None
+		if leader:
+			future = Future()
+			_inFlight[flightKey] = future
+	if not leader:
+		log.debug("Waiting for osu!api lookup {}={} from another request".format(key, value))
+		return future.result()
+
+	try:
+		result = list(_executor.map(
+			lambda mode: osuApiRequest("get_beatmaps", "{}={}&a=1&m={}".format(key, value, mode)),
+			range(4)
+		))
+		future.set_result(result)
+		return result
+	except Exception as e:
+		future.set_exception(e)
+		raise
+	finally:
+		with _inFlightLock:
+			del _inFlight[flightKey]
+
 def getOsuFileFromName(fileName):
 	"""
 	Send a request to osu! servers to download a .osu file from file name
@@ -57,7 +107,7 @@ def getOsuFileFromName(fileName):
 	response = None
 	try:
 		URL = "{}/web/maps/{}".format(glob.conf.config["osuapi"]["apiurl"], quote(fileName))
-		req = requests.get(URL, timeout=20)
+		req = _session.get(URL, timeout=20)
 		req.encoding = "utf-8"
 		response = req.content
 	finally:
@@ -80,7 +130,7 @@ def getOsuFileFromID(beatmapID):
 	response = None
 	try:
 		URL = "{}/osu/{}".format(glob.conf.config["osuapi"]["apiurl"], beatmapID)
-		response = requests.get(URL, timeout=20).content
+		response = _session.get(URL, timeout=20).content
 	finally:
 		glob.dog.increment(glob.DATADOG_PREFIX+".osu_api.osu_file_requests")
 		return response
\ No newline at end of file
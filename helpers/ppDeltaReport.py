@@ -0,0 +1,311 @@
+"""
+pp delta report of a dry-run recalculation
+
+Every recalculated score is appended to a set of column files (score id, user, beatmap,
+table, game mode, old pp, new pp), a few bytes per score, instead of being written to the db.
+When the recalculation is over, the columns are read back with numpy memmaps, one chunk
+at a time, to build the aggregates: a pp delta histogram, the scores that moved the most
+and the projected change of every user's total pp. Memory usage doesn't depend on the
+number of scores, only on CHUNK_SIZE and USERS_PASS_SIZE.
+
+Usage:
+	report = ppDeltaReport.ppDeltaReport("tomejerry_report", ["scores", "scores_relax"])
+	report.addMany([(scoreID, userID, beatmapID, 0, gameMode, oldPP, newPP), ...])
+	summary = report.close()
+
+Columns can be loaded later with ppDeltaReport.load("tomejerry_report").
+"""
+import json
+import os
+import threading
+
+import numpy
+
+from helpers import statsRebuildHelper
+
+# name, dtype
+COLUMNS = (
+	("score_id", "<u4"),
+	("user_id", "<u4"),
+	("beatmap_id", "<u4"),
+	("table", "u1"),
+	("mode", "u1"),
+	("old_pp", "<f4"),
+	("new_pp", "<f4"),
+)
+USER_COLUMNS = (
+	("user_id", "<u4"),
+	("table", "u1"),
+	("mode", "u1"),
+	("old_pp", "<f4"),
+	("new_pp", "<f4"),
+)
+
+# Rows kept in memory before they're appended to the column files
+BUFFER_SIZE = 65536
+
+# Rows read at once while aggregating
+CHUNK_SIZE = 1 << 20
+
+# Max rows (roughly) loaded at once to calculate users total pp.
+# Users are split in (rows / USERS_PASS_SIZE) groups, each one takes a pass over the columns.
+USERS_PASS_SIZE = 1 << 23
+
+# Inner edges of the pp delta histogram. The first and last buckets are open-ended.
+HISTOGRAM_EDGES = (-100, -50, -25, -10, -5, -1, -0.01, 0.01, 1, 5, 10, 25, 50, 100)
+
+# Scores and users shown in the "top movers" lists
+TOP = 20
+
+
+class ppDeltaReport:
+	def __init__(self, path, tables):
+		"""
+		Create a new report. The files of an older report in the same directory are overwritten.
+
+		path -- report directory
+		tables -- names of the scores tables. Rows refer to them by index.
+		"""
+		self.path = path
+		self.tables = list(tables)
+		self.rows = 0
+		self._buffer = []
+		self._lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+		self._files = {x: open(_columnPath(path, "scores", x), "wb") for x, _ in COLUMNS}
+
+	def addMany(self, rows):
+		"""
+		Add some recalculated scores to the report
+
+		rows -- iterable of (score id, user id, beatmap id, table index, game mode, old pp, new pp) tuples
+		"""
+		with self._lock:
+			self._buffer.extend(rows)
+			if len(self._buffer) >= BUFFER_SIZE:
+				self._flush()
+
+	def _flush(self):
+		if not self._buffer:
+			return
+		data = numpy.array(self._buffer, dtype=list(COLUMNS))
+		for name, _ in COLUMNS:
+			data[name].tofile(self._files[name])
+		self.rows += len(self._buffer)
+		self._buffer = []
+
+	def close(self):
+		"""
+		Write the remaining rows, calculate the aggregates and save them in report.json
+
+		return -- aggregates dictionary (same as report.json)
+		"""
+		with self._lock:
+			self._flush()
+			for f in self._files.values():
+				f.close()
+		columns = load(self.path, rows=self.rows)
+		summary = {
+			"tables": self.tables,
+			"rows": self.rows,
+			"columns": dict(COLUMNS),
+			"user_columns": dict(USER_COLUMNS),
+		}
+		summary.update(_scoresAggregates(columns, self.tables))
+		summary["users"] = _usersAggregates(self.path, columns, self.tables)
+		summary["user_rows"] = summary["users"]["users"]
+		with open(os.path.join(self.path, "report.json"), "w") as f:
+			json.dump(summary, f, indent=4)
+		return summary
+
+
+def _columnPath(path, kind, column):
+	return os.path.join(path, "{}_{}.bin".format(kind, column))
+
+
+def load(path, kind = "scores", rows = None):
+	"""
+	Load the columns of a report, as read-only memmaps
+
+	path -- report directory
+	kind -- "scores" (one row per score) or "users" (one row per user, table and game mode)
+	rows -- number of rows. Optional, read from report.json if not given.
+	return -- dictionary with a numpy array per column
+	"""
+	if rows is None:
+		with open(os.path.join(path, "report.json"), "r") as f:
+			rows = json.load(f)["rows" if kind == "scores" else "user_rows"]
+	result = {}
+	for name, dtype in COLUMNS if kind == "scores" else USER_COLUMNS:
+		if rows == 0:
+			result[name] = numpy.zeros(0, dtype=dtype)
+		else:
+			result[name] = numpy.memmap(_columnPath(path, kind, name), dtype=dtype, mode="r", shape=(rows,))
+	return result
+
+
+def _chunks(length):
+	for i in range(0, length, CHUNK_SIZE):
+		yield slice(i, min(i + CHUNK_SIZE, length))
+
+
+def _top(candidates, values, count):
+	"""
+	Keep the count rows with the biggest abs(values)
+
+	candidates -- dictionary of numpy arrays (columns)
+	values -- numpy array to sort by
+	count -- rows to keep
+	return -- (candidates, values) with count rows at most
+	"""
+	if len(values) > count:
+		keep = numpy.argpartition(-numpy.abs(values), count - 1)[:count]
+		candidates = {k: v[keep] for k, v in candidates.items()}
+		values = values[keep]
+	return candidates, values
+
+
+def _merge(a, b):
+	if a is None:
+		return b
+	return {k: numpy.concatenate((a[k], b[k])) for k in a}
+
+
+def _scoresAggregates(columns, tables):
+	"""
+	pp delta summary, histogram and top movers of every score
+
+	columns -- score columns
+	tables -- scores tables names
+	return -- dictionary
+	"""
+	rows = len(columns["score_id"])
+	edges = numpy.array(HISTOGRAM_EDGES, dtype="<f8")
+	histogram = numpy.zeros(len(edges) + 1, dtype="<i8")
+	changed = 0
+	deltaSum = 0.0
+	oldSum = 0.0
+	newSum = 0.0
+	top = None
+	topDelta = numpy.zeros(0, dtype="<f8")
+	for chunk in _chunks(rows):
+		old = columns["old_pp"][chunk].astype("<f8")
+		new = columns["new_pp"][chunk].astype("<f8")
+		delta = new - old
+		histogram += numpy.bincount(numpy.searchsorted(edges, delta, side="right"), minlength=len(edges) + 1)
+		changed += int(numpy.count_nonzero(numpy.abs(delta) >= 0.01))
+		deltaSum += float(delta.sum())
+		oldSum += float(old.sum())
+		newSum += float(new.sum())
+
+		# Top movers of this chunk, merged with the previous ones
+		chunkTop, chunkDelta = _top({k: v[chunk] for k, v in columns.items()}, delta, TOP)
+		top = _merge(top, {k: numpy.asarray(v) for k, v in chunkTop.items()})
+		top, topDelta = _top(top, numpy.concatenate((topDelta, chunkDelta)), TOP)
+
+	bounds = [None] + list(HISTOGRAM_EDGES) + [None]
+	result = {
+		"scores": {
+			"changed": changed,
+			"old_pp": round(oldSum, 2),
+			"new_pp": round(newSum, 2),
+			"delta_sum": round(deltaSum, 2),
+			"delta_mean": round(deltaSum / rows, 4) if rows else 0,
+		},
+		"histogram": [
+			{"from": bounds[i], "to": bounds[i + 1], "scores": int(histogram[i])} for i in range(len(histogram))
+		],
+		"top_scores": [],
+	}
+	if top is not None:
+		for i in numpy.argsort(-numpy.abs(topDelta)):
+			result["top_scores"].append({
+				"score_id": int(top["score_id"][i]),
+				"user_id": int(top["user_id"][i]),
+				"beatmap_id": int(top["beatmap_id"][i]),
+				"table": tables[int(top["table"][i])],
+				"mode": int(top["mode"][i]),
+				"old_pp": round(float(top["old_pp"][i]), 2),
+				"new_pp": round(float(top["new_pp"][i]), 2),
+				"delta": round(float(topDelta[i]), 2),
+			})
+	return result
+
+
+def _usersAggregates(path, columns, tables):
+	"""
+	Projected total pp of every user, before and after the recalculation,
+	weighted like rebuild-stats.py does (statsRebuildHelper.weightedStats).
+	Only the recalculated scores are taken into account.
+	Saved in the users_* column files of the report.
+
+	path -- report directory
+	columns -- score columns
+	tables -- scores tables names
+	return -- dictionary with the users summary and top movers
+	"""
+	rows = len(columns["score_id"])
+	passes = max(-(-rows // USERS_PASS_SIZE), 1)
+	files = {x: open(_columnPath(path, "users", x), "wb") for x, _ in USER_COLUMNS}
+	userRows = 0
+	changed = 0
+	top = None
+	topDelta = numpy.zeros(0, dtype="<f8")
+	try:
+		for p in range(passes):
+			# Collect the scores of a group of users
+			parts = []
+			for chunk in _chunks(rows):
+				users = columns["user_id"][chunk]
+				mask = users % passes == p
+				# user id, table and game mode in a single sortable key
+				key = (
+					users[mask].astype("<u8") << 16 |
+					columns["table"][chunk][mask].astype("<u8") << 8 |
+					columns["mode"][chunk][mask].astype("<u8")
+				)
+				parts.append((key, columns["old_pp"][chunk][mask].astype("<f8"), columns["new_pp"][chunk][mask].astype("<f8")))
+			if not parts:
+				continue
+			keys = numpy.concatenate([x[0] for x in parts])
+			if not len(keys):
+				continue
+			old = numpy.concatenate([x[1] for x in parts])
+			new = numpy.concatenate([x[2] for x in parts])
+			del parts
+
+			# Scores are sorted by pp separately, the order of the keys is the same
+			userKeys, oldTotals, _ = statsRebuildHelper.weightedStats(keys, old)
+			_, newTotals, _ = statsRebuildHelper.weightedStats(keys, new)
+			del keys, old, new
+			data = numpy.zeros(len(userKeys), dtype=list(USER_COLUMNS))
+			data["user_id"] = userKeys >> 16
+			data["table"] = (userKeys >> 8) & 0xFF
+			data["mode"] = userKeys & 0xFF
+			data["old_pp"] = oldTotals
+			data["new_pp"] = newTotals
+			for name, _ in USER_COLUMNS:
+				data[name].tofile(files[name])
+			userRows += len(data)
+
+			delta = newTotals - oldTotals
+			changed += int(numpy.count_nonzero(numpy.abs(delta) >= 0.01))
+			passTop, passDelta = _top({x: data[x] for x, _ in USER_COLUMNS}, delta, TOP)
+			top = _merge(top, passTop)
+			top, topDelta = _top(top, numpy.concatenate((topDelta, passDelta)), TOP)
+	finally:
+		for f in files.values():
+			f.close()
+
+	result = {"users": userRows, "changed": changed, "top": []}
+	if top is not None:
+		for i in numpy.argsort(-numpy.abs(topDelta)):
+			result["top"].append({
+				"user_id": int(top["user_id"][i]),
+				"table": tables[int(top["table"][i])],
+				"mode": int(top["mode"][i]),
+				"old_pp": round(float(top["old_pp"][i]), 2),
+				"new_pp": round(float(top["new_pp"][i]), 2),
+				"delta": round(float(topDelta[i]), 2),
+			})
+	return result
@@ -0,0 +1,207 @@
+"""
+Per-beatmap personal best rank index
+
+For every (beatmap md5, game mode, relax) there's a sorted set per sort column
+(score and pp) with the value of each unrestricted user's best score, so a
+personal best rank on the global leaderboard is a ZCOUNT instead of a COUNT(*)
+over the scores table.
+
+Sets are built from MySQL the first time they're needed (in the background;
+until then the caller falls back to SQL), kept up to date on score submission
+and restrict/unrestrict, and expire after a day without a rebuild.
+Everything lives under lets:*, so the index is rebuilt after a restart.
+"""
+from common.constants import privileges
+from common.log import logUtils as log
+from common.ripple import userUtils
+from objects import glob
+
+KEY = "lets:rank_index:{}:{}:{}:{}"		# relax, md5, game mode, column
+REBUILD_LOCK_KEY = "lets:rank_index_rebuild:{}:{}:{}"	# relax, md5, game mode
+EXPIRE = 86400
+# Sets being rebuilt (KEY:tmp) are dropped after this if the rebuild dies
+REBUILD_EXPIRE = 60
+COLUMNS = ("score", "pp")
+
+# Marker member, so empty leaderboards don't look like cold ones.
+# Its value is -inf, so it's never counted in a rank.
+EMPTY_MARKER = "0"
+
+# Update the sets (live and being rebuilt) that have already been created
+ZADD_IF_EXISTS = """
+local added = 0
+for _, key in ipairs(KEYS) do
+	if redis.call('exists', key) == 1 then
+		added = added + redis.call('zadd', key, ARGV[2], ARGV[1])
+	end
+end
+return added
+"""
+
+
+def _key(fileMd5, gameMode, relax, column):
+	return KEY.format(int(bool(relax)), fileMd5, gameMode, column)
+
+def _tmpKey(key):
+	return "{}:tmp".format(key)
+
+def _table(relax):
+	return "scores_relax" if relax else "scores"
+
+def _isPublic(userID):
+	# Same check as the leaderboard queries (privileges & 1), so banned users are excluded too
+	return userUtils.getPrivileges(userID) & privileges.USER_PUBLIC > 0
+
+
+def _fetchBest(fileMd5, gameMode, relax, afterID=0):
+	return glob.db.fetchAll(
+		"SELECT sc.id, sc.userid, sc.score, sc.pp FROM {} AS sc "
+		"STRAIGHT_JOIN users ON sc.userid = users.id "
+		"WHERE sc.beatmap_md5 = %s AND sc.play_mode = %s AND sc.completed = 3 "
+		"AND users.privileges & 1 > 0 AND sc.id > %s ORDER BY sc.id".format(_table(relax)),
+		[fileMd5, gameMode, afterID]
+	) or []
+
+def _zaddRows(pipe, key, rows, column):
+	for i in range(0, len(rows), 500):
+		values = []
+		for row in rows[i:i+500]:
+			values += [row["userid"], row[column]]
+		pipe.zadd(key, *values)
+
+def rebuild(fileMd5, gameMode, relax=False):
+	"""
+	Build the rank index sets of a leaderboard from MySQL.
+	The new sets replace the live ones only when they're complete. Personal bests submitted
+	in the meantime are added to both (see update), and the ones committed while MySQL
+	was being read are read again before the switch, so none of them are lost.
+
+	:param fileMd5: beatmap md5
+	:param gameMode: game mode
+	:param relax: True for the relax leaderboard
+	:return:
+	"""
+	keys = [_key(fileMd5, gameMode, relax, column) for column in COLUMNS]
+
+	# Create the new sets first, so update() starts writing to them
+	pipe = glob.redis.pipeline()
+	for key in keys:
+		pipe.delete(_tmpKey(key))
+		pipe.zadd(_tmpKey(key), EMPTY_MARKER, "-inf")
+		pipe.expire(_tmpKey(key), REBUILD_EXPIRE)
+	pipe.execute()
+
+	rows = _fetchBest(fileMd5, gameMode, relax)
+	pipe = glob.redis.pipeline()
+	for key, column in zip(keys, COLUMNS):
+		_zaddRows(pipe, _tmpKey(key), rows, column)
+	pipe.execute()
+
+	# Rows read above may be older than what update() has written in the meantime,
+	# so add the personal bests submitted after them again, then switch the sets
+	newRows = _fetchBest(fileMd5, gameMode, relax, max((x["id"] for x in rows), default=0))
+	pipe = glob.redis.pipeline()
+	for key, column in zip(keys, COLUMNS):
+		_zaddRows(pipe, _tmpKey(key), newRows, column)
+		pipe.rename(_tmpKey(key), key)
+		pipe.expire(key, EXPIRE)
+	pipe.execute()
+	log.debug("Rebuilt rank index for {} ({} scores)".format(fileMd5, len(rows) + len(newRows)))
+
+
+def _rebuildInBackground(fileMd5, gameMode, relax):
+	# Only one rebuild at a time per leaderboard
+	if glob.pool is None or not glob.redis.set(REBUILD_LOCK_KEY.format(int(bool(relax)), fileMd5, gameMode), "1", 30, nx=True):
+		return
+	def job():
+		try:
+			rebuild(fileMd5, gameMode, relax)
+		except Exception as e:
+			log.error("Error while rebuilding rank index for {}: {}".format(fileMd5, e))
+	glob.pool.apply_async(job)
+
+
+def getRank(fileMd5, gameMode, userID, column="score", relax=False):
+	"""
+	Get a user's personal best rank on a beatmap's global leaderboard
+
+	:param fileMd5: beatmap md5
+	:param gameMode: game mode
+	:param userID: user id
+	:param column: leaderboard sort column, score or pp
+	:param relax: True for the relax leaderboard
+	:return: rank, or None if the index is cold or the user isn't in it (use SQL)
+	"""
+	key = _key(fileMd5, gameMode, relax, column)
+	pipe = glob.redis.pipeline()
+	pipe.exists(key)
+	pipe.zscore(key, userID)
+	exists, value = pipe.execute()
+	if not exists:
+		log.debug("Rank index miss")
+		_rebuildInBackground(fileMd5, gameMode, relax)
+		return None
+	if value is None:
+		return None
+	log.debug("Rank index hit")
+	return glob.redis.zcount(key, value, "+inf")
+
+
+def update(userID, score, relax=False):
+	"""
+	Add a new personal best to the rank index.
+	Restricted/banned users and scores that aren't personal bests are ignored.
+
+	:param userID: user id
+	:param score: score object
+	:param relax: True for the relax leaderboard
+	:return:
+	"""
+	if score.completed != 3 or not _isPublic(userID):
+		return
+	for column in COLUMNS:
+		key = _key(score.fileMd5, score.gameMode, relax, column)
+		glob.redis.eval(ZADD_IF_EXISTS, 2, key, _tmpKey(key), userID, getattr(score, column))
+
+
+def refreshUser(userID):
+	"""
+	Add or remove a user's personal bests from the rank index,
+	after they've been restricted, banned or unrestricted.
+	Cached leaderboards of the beatmaps they've played are dropped as well.
+
+	:param userID: user id
+	:return:
+	"""
+	public = _isPublic(userID)
+	fileMd5s = set()
+	for relax in (False, True):
+		rows = glob.db.fetchAll(
+			"SELECT beatmap_md5, play_mode, score, pp FROM {} WHERE userid = %s AND completed = 3".format(_table(relax)),
+			[userID]
+		) or []
+		pipe = glob.redis.pipeline(transaction=False)
+		for row in rows:
+			fileMd5s.add(row["beatmap_md5"])
+			for column in COLUMNS:
+				key = _key(row["beatmap_md5"], row["play_mode"], relax, column)
+				if public:
+					pipe.eval(ZADD_IF_EXISTS, 2, key, _tmpKey(key), userID, row[column])
+				else:
+					pipe.zrem(key, userID)
+					pipe.zrem(_tmpKey(key), userID)
+		pipe.execute()
+	# Cached leaderboards with their scores (or without them) are outdated too
+	glob.leaderboardCache.delete(*fileMd5s)
+
+
+def invalidate(fileMd5):
+	"""
+	Drop every rank index set of a beatmap, they'll be rebuilt when needed
+
+	:param fileMd5: beatmap md5
+	:return:
+	"""
+	keys = [_key(fileMd5, gameMode, relax, column) for gameMode in range(4) for relax in (False, True) for column in COLUMNS]
+	# Sets being rebuilt from the old data too, so their rebuild fails instead of replacing the live ones
+	glob.redis.delete(*keys, *[_tmpKey(x) for x in keys])
@@ -0,0 +1,115 @@
+"""
+Rijndael CBC decryption on bytes, compiled with Cython.
+
+Same algorithm as helpers/aeshelper.py (which is still the reference implementation
+and is used to build the key schedule and lookup tables), but the block loops run
+on C arrays instead of python strings.
+"""
+from libc.stdint cimport uint32_t
+
+# Decryption lookup tables, copied from the reference implementation on first use
+# (aeshelper imports this module, so we can't read them at import time)
+cdef uint32_t T5[256]
+cdef uint32_t T6[256]
+cdef uint32_t T7[256]
+cdef uint32_t T8[256]
+cdef uint32_t Si[256]
+cdef bint _tablesLoaded = False
+
+# Decryption round keys by (key, block size). Score submission always uses the same few keys.
+_roundKeys = {}
+
+def _loadTables():
+	global _tablesLoaded
+	from helpers import aeshelper
+	for i in range(256):
+		T5[i] = aeshelper.T5[i]
+		T6[i] = aeshelper.T6[i]
+		T7[i] = aeshelper.T7[i]
+		T8[i] = aeshelper.T8[i]
+		Si[i] = aeshelper.Si[i]
+	_tablesLoaded = True
+
+def _getRoundKeys(key, blockSize):
+	from helpers import aeshelper
+	k = (key, blockSize)
+	if k not in _roundKeys:
+		if len(_roundKeys) > 64:
+			_roundKeys.clear()
+		_roundKeys[k] = [x for roundKey in aeshelper.rijndael(key, blockSize).Kd for x in roundKey]
+	return _roundKeys[k]
+
+def decryptCbc(key, bytes iv, bytes data, int blockSize = 32):
+	"""
+	Decrypt data with rijndael in CBC mode. Padding is not removed.
+
+	key -- key (string)
+	iv -- initialization vector (bytes)
+	data -- data to decrypt (bytes)
+	blockSize -- block size, 16, 24 or 32
+	return -- decrypted data (bytes)
+	"""
+	if blockSize != 16 and blockSize != 24 and blockSize != 32:
+		raise ValueError("Invalid block size: " + str(blockSize))
+	assert len(iv) == blockSize
+	assert len(data) % blockSize == 0
+
+	if not _tablesLoaded:
+		_loadTables()
+	roundKeys = _getRoundKeys(key, blockSize)
+	cdef int BC = blockSize // 4
+	cdef int ROUNDS = len(roundKeys) // BC - 1
+	cdef uint32_t kd[120]
+	cdef int i, r, offset
+	for i in range(len(roundKeys)):
+		kd[i] = roundKeys[i]
+
+	# Same as aeshelper.shifts[SC][x][1]
+	cdef int s1, s2, s3
+	if BC == 4:
+		s1, s2, s3 = 3, 2, 1
+	elif BC == 6:
+		s1, s2, s3 = 5, 4, 3
+	else:
+		s1, s2, s3 = 7, 5, 4
+
+	cdef Py_ssize_t length = len(data)
+	out = bytearray(length)
+	cdef unsigned char* o = out
+	cdef const unsigned char* c = data
+	cdef const unsigned char* v = iv
+	cdef uint32_t t[8]
+	cdef uint32_t a[8]
+	cdef uint32_t tt
+
+	offset = 0
+	while offset < length:
+		# ciphertext to ints + key
+		for i in range(BC):
+			t[i] = (
+				(<uint32_t>c[offset + i * 4] << 24) |
+				(<uint32_t>c[offset + i * 4 + 1] << 16) |
+				(<uint32_t>c[offset + i * 4 + 2] << 8) |
+				(<uint32_t>c[offset + i * 4 + 3])
+			) ^ kd[i]
+		# apply round transforms
+		for r in range(1, ROUNDS):
+			for i in range(BC):
+				a[i] = (
+					T5[(t[i] >> 24) & 0xFF] ^
+					T6[(t[(i + s1) % BC] >> 16) & 0xFF] ^
+					T7[(t[(i + s2) % BC] >> 8) & 0xFF] ^
+					T8[t[(i + s3) % BC] & 0xFF]
+				) ^ kd[r * BC + i]
+			for i in range(BC):
+				t[i] = a[i]
+		# last round is special, then xor with the previous ciphertext block
+		for i in range(BC):
+			tt = kd[ROUNDS * BC + i]
+			o[offset + i * 4] = ((Si[(t[i] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF) ^ v[i * 4]
+			o[offset + i * 4 + 1] = ((Si[(t[(i + s1) % BC] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF) ^ v[i * 4 + 1]
+			o[offset + i * 4 + 2] = ((Si[(t[(i + s2) % BC] >> 8) & 0xFF] ^ (tt >> 8)) & 0xFF) ^ v[i * 4 + 2]
+			o[offset + i * 4 + 3] = ((Si[t[(i + s3) % BC] & 0xFF] ^ tt) & 0xFF) ^ v[i * 4 + 3]
+		v = c + offset
+		offset += blockSize
+	return bytes(out)
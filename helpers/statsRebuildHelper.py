@@ -0,0 +1,166 @@
+"""
+Bulk rebuild of users total pp and accuracy
+
+Instead of refreshing users one by one (a couple of queries per user and game mode),
+the best scores of a batch of users are loaded with a single query for every game mode,
+their weighted pp and accuracy are calculated with numpy and the results are written
+back to users_stats/rx_stats with one bulk update.
+
+Usage:
+	for userIDs in statsRebuildHelper.userBatches(1000):
+		statsRebuildHelper.rebuildBatch(userIDs, relax=False)
+"""
+import MySQLdb.cursors
+import numpy
+
+from helpers import bulkUpdateHelper
+from objects import glob
+
+GAME_MODES = ("std", "taiko", "ctb", "mania")
+
+# scores table -> stats table
+TABLES = {
+	False: ("scores", "users_stats"),
+	True: ("scores_relax", "rx_stats"),
+}
+
+# Only the best MAX_SCORES scores of a user count towards their total pp and accuracy.
+# The nth one is weighted WEIGHT ** n (pp) and int(WEIGHT ** n * 100) (accuracy).
+MAX_SCORES = 500
+WEIGHT = 0.95
+
+_ppWeights = numpy.power(WEIGHT, numpy.arange(MAX_SCORES))
+_accuracyWeights = numpy.floor(_ppWeights * 100)
+
+
+def userBatches(batchSize = 1000):
+	"""
+	Iterate over every user id, batchSize at a time
+
+	batchSize -- number of users in each batch
+	return -- generator of lists of user ids
+	"""
+	lastID = 0
+	while True:
+		rows = glob.db.fetchAll(
+			"SELECT id FROM users WHERE id > %s ORDER BY id LIMIT {}".format(int(batchSize)),
+			[lastID]
+		)
+		if not rows:
+			return
+		userIDs = [x["id"] for x in rows]
+		yield userIDs
+		lastID = userIDs[-1]
+
+
+def _fetchScores(table, userIDs):
+	"""
+	Load the completed scores of some users, in every game mode
+
+	table -- scores table
+	userIDs -- list of user ids
+	return -- numpy structured array (userid, play_mode, pp, accuracy)
+	"""
+	worker = glob.db.pool.getWorker()
+	if worker is None:
+		raise RuntimeError("No database worker available")
+	cursor = None
+	try:
+		# Plain tuples, no dicts
+		cursor = worker.connection.cursor(MySQLdb.cursors.SSCursor)
+		cursor.execute(
+			"SELECT userid, play_mode, IFNULL(pp, 0), IFNULL(accuracy, 0) FROM {} "
+			"WHERE completed = 3 AND userid IN ({})".format(
+				table, ", ".join(["%s"] * len(userIDs))
+			),
+			userIDs
+		)
+		rows = cursor.fetchall()
+	finally:
+		if cursor is not None:
+			cursor.close()
+		glob.db.pool.putWorker(worker)
+	return numpy.array(
+		[tuple(x) for x in rows],
+		dtype=[("userid", "<u4"), ("play_mode", "u1"), ("pp", "<f8"), ("accuracy", "<f8")]
+	)
+
+
+def weightedStats(keys, pp, accuracy = None):
+	"""
+	Weighted total pp and accuracy of every key (eg: user and game mode)
+
+	keys -- numpy array of keys, one per score
+	pp -- numpy array of scores pp
+	accuracy -- numpy array of scores accuracy. Optional.
+	return -- (sorted unique keys, total pp, accuracy) numpy arrays. accuracy is None if not given.
+	"""
+	if not len(keys):
+		return keys, numpy.zeros(0), None if accuracy is None else numpy.zeros(0)
+
+	# Best scores first, then keep the best MAX_SCORES of every key
+	order = numpy.lexsort((-pp, keys))
+	keys, pp = keys[order], pp[order]
+	starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+	ranks = numpy.arange(len(keys)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(keys))))
+	best = ranks < MAX_SCORES
+	keys, pp, ranks = keys[best], pp[best], ranks[best]
+	starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+
+	totalPP = numpy.add.reduceat(numpy.round(numpy.round(pp) * _ppWeights[ranks]), starts)
+	if accuracy is None:
+		return keys[starts], totalPP, None
+	accuracy = accuracy[order][best]
+	accuracyWeights = _accuracyWeights[ranks]
+	totalAccuracy = numpy.add.reduceat(accuracy * accuracyWeights, starts)
+	divideTotal = numpy.add.reduceat(accuracyWeights, starts)
+	return keys[starts], totalPP, numpy.divide(
+		totalAccuracy, divideTotal, out=numpy.zeros(len(starts)), where=divideTotal != 0
+	)
+
+
+def rebuildBatch(userIDs, relax = False, writeBatchSize = bulkUpdateHelper.DEFAULT_BATCH_SIZE):
+	"""
+	Recalculate and save total pp and accuracy of some users, in every game mode.
+	Users without scores in a game mode get 0 pp and 0% accuracy.
+
+	userIDs -- list of user ids
+	relax -- if True, rebuild relax stats (rx_stats) from relax scores
+	writeBatchSize -- number of users updated with each query
+	return -- (sorted numpy array of user ids, numpy array of total pp with one row per user and one column per game mode)
+	"""
+	scoresTable, statsTable = TABLES[relax]
+	userIDs = numpy.unique(numpy.array(userIDs, dtype="<u4"))
+	scores = _fetchScores(scoresTable, userIDs.tolist())
+
+	# One key per user and game mode
+	keys, totalPP, accuracy = weightedStats(
+		scores["userid"].astype("<u8") * len(GAME_MODES) + scores["play_mode"],
+		scores["pp"],
+		scores["accuracy"]
+	)
+	rows = numpy.searchsorted(userIDs, keys // len(GAME_MODES))
+	modes = keys % len(GAME_MODES)
+	ppMatrix = numpy.zeros((len(userIDs), len(GAME_MODES)), dtype="<i8")
+	accuracyMatrix = numpy.zeros((len(userIDs), len(GAME_MODES)), dtype="<f8")
+	ppMatrix[rows, modes] = totalPP
+	accuracyMatrix[rows, modes] = accuracy
+
+	columns = []
+	for mode in GAME_MODES:
+		columns += ["pp_{}".format(mode), "avg_accuracy_{}".format(mode)]
+	updater = bulkUpdateHelper.bulkUpdater(
+		statsTable,
+		columns,
+		("INT UNSIGNED", "FLOAT") * len(GAME_MODES),
+		batchSize=writeBatchSize
+	)
+	try:
+		for userID, pps, accuracies in zip(userIDs.tolist(), ppMatrix.tolist(), accuracyMatrix.tolist()):
+			values = []
+			for pp, acc in zip(pps, accuracies):
+				values += [pp, acc]
+			updater.add(userID, *values)
+	finally:
+		updater.close()
+	return userIDs, ppMatrix
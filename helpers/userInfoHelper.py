@@ -0,0 +1,84 @@
+"""
+Display names and leaderboard visibility of score owners
+
+A leaderboard has up to 51 different players. Their clan tags and visibility flags
+are resolved for the whole leaderboard at once with prefetch(), and kept for a minute
+in an in-process cache, instead of running a few queries for every score row.
+"""
+from common.ripple import userUtils
+from helpers import memoryCache
+from objects import glob
+
+_clanTags = memoryCache.memoryCache(maxSize=8192, ttl=60)
+_visibility = memoryCache.memoryCache(maxSize=8192, ttl=60)
+
+
+def prefetch(userIDs):
+	"""
+	Load clan tags and visibility flags of some users in cache,
+	so getDisplayName and isScoreVisible don't need any query for them
+
+	userIDs -- iterable of user ids
+	"""
+	userIDs = set(userIDs)
+	cached = _clanTags.getMany(userIDs)
+	missing = [x for x in userIDs if x not in cached]
+	if missing:
+		tags = {x: None for x in missing}
+		rows = glob.db.fetchAll(
+			"SELECT user_clans.user, clans.tag FROM user_clans "
+			"JOIN clans ON clans.id = user_clans.clan "
+			"WHERE user_clans.user IN ({})".format(", ".join(["%s"] * len(missing))),
+			missing
+		) or []
+		for row in rows:
+			tags[row["user"]] = row["tag"]
+		for userID, tag in tags.items():
+			_clanTags.set(userID, tag)
+
+	# The visibility flags are stored by common, so only the missing ones are loaded one by one
+	cached = _visibility.getMany(userIDs)
+	for userID in userIDs:
+		if userID not in cached:
+			_getVisibility(userID)
+
+
+def _getClanTag(userID):
+	tag = _clanTags.get(userID, False)
+	if tag is False:
+		prefetch([userID])
+		tag = _clanTags.get(userID)
+	return tag
+
+
+def _getVisibility(userID):
+	flags = _visibility.get(userID)
+	if flags is None:
+		flags = userUtils.InvisibleBoard(userID) if "InvisibleBoard" in dir(userUtils) else 0
+		_visibility.set(userID, flags)
+	return flags
+
+
+def getDisplayName(userID, username):
+	"""
+	Get a user's name as shown on leaderboards, with their clan tag
+
+	userID -- user id
+	username -- username
+	return -- "[TAG] username", or username if they're not in a clan
+	"""
+	tag = _getClanTag(userID)
+	if not tag:
+		return username
+	return "[{}] {}".format(tag, username)
+
+
+def isScoreVisible(userID):
+	"""
+	Check if a user's scores are shown on other players' leaderboards
+
+	userID -- user id
+	return -- True if visible
+	"""
+	return not (_getVisibility(userID) & 2)
+
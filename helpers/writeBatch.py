@@ -0,0 +1,167 @@
+"""
+Batched writes for score submission
+
+A write batch runs every glob.db query made by its thread on a single connection,
+inside one transaction, and queues redis counters in one pipeline.
+Everything is sent when the batch is committed, and thrown away if it's rolled back.
+Queries are routed by glob.db (a batchedDb object), so functions that use
+glob.db directly (eg: common's userUtils) take part in the batch too.
+
+Usage:
+	batch = writeBatch.writeBatch()
+	batch.begin()
+	try:
+		...
+		writeBatch.redis().incr("ripple:total_plays", 1)
+		writeBatch.afterCommit(lambda: glob.redis.publish("api:score_submission", scoreID))
+		batch.commit()
+	finally:
+		batch.rollback()	# no-op if already committed
+"""
+import threading
+
+import MySQLdb.cursors
+
+from common.db import dbConnector
+from common.log import logUtils as log
+from objects import glob
+
+_local = threading.local()
+
+
+def current():
+	"""
+	Get the current thread's write batch
+
+	return -- writeBatch object, or None if there's no active batch
+	"""
+	return getattr(_local, "batch", None)
+
+
+def redis():
+	"""
+	Get the redis object to use for counters.
+	Commands sent to it are delayed until commit if there's an active write batch.
+
+	return -- redis pipeline or glob.redis
+	"""
+	batch = current()
+	return batch.pipeline if batch is not None else glob.redis
+
+
+def afterCommit(callback):
+	"""
+	Run a function once the current write batch has been committed,
+	or right away if there's no active write batch.
+
+	callback -- function with no arguments
+	"""
+	batch = current()
+	if batch is None:
+		callback()
+	else:
+		batch.callbacks.append(callback)
+
+
+class writeBatch:
+	def __init__(self):
+		self.worker = None
+		self.pipeline = None
+		self.callbacks = []
+
+	def begin(self):
+		"""
+		Check out a db connection and start the transaction
+		"""
+		if current() is not None:
+			raise RuntimeError("There's already an active write batch in this thread")
+		self.worker = glob.db.pool.getWorker()
+		self.worker.connection.autocommit(False)
+		self.pipeline = glob.redis.pipeline(transaction=False)
+		self.callbacks = []
+		_local.batch = self
+
+	def _end(self):
+		_local.batch = None
+		try:
+			self.worker.connection.autocommit(True)
+		finally:
+			glob.db.pool.putWorker(self.worker)
+			self.worker = None
+
+	def commit(self):
+		"""
+		Commit the transaction, send queued redis commands and run after commit callbacks
+		"""
+		if self.worker is None:
+			return
+		try:
+			self.worker.connection.commit()
+		except:
+			self.worker.connection.rollback()
+			raise
+		finally:
+			self._end()
+		self.pipeline.execute()
+		for callback in self.callbacks:
+			try:
+				callback()
+			except Exception as e:
+				log.error("Error in write batch callback: {}".format(e))
+		self.callbacks = []
+
+	def rollback(self):
+		"""
+		Roll back the transaction and discard queued redis commands and callbacks.
+		Does nothing if the batch has already been committed.
+
+		return -- True if the transaction has been rolled back, False if there was nothing to roll back
+		"""
+		if self.worker is None:
+			return False
+		try:
+			self.worker.connection.rollback()
+		finally:
+			self._end()
+			self.pipeline.reset()
+			self.callbacks = []
+		return True
+
+	def execute(self, query, params = ()):
+		cursor = self.worker.connection.cursor(MySQLdb.cursors.DictCursor)
+		try:
+			cursor.execute(query, params)
+			return cursor.lastrowid
+		finally:
+			cursor.close()
+
+	def fetch(self, query, params = (), _all = False):
+		cursor = self.worker.connection.cursor(MySQLdb.cursors.DictCursor)
+		try:
+			cursor.execute(query, params)
+			return cursor.fetchall() if _all else cursor.fetchone()
+		finally:
+			cursor.close()
+
+
+class batchedDb(dbConnector.db):
+	"""
+	dbConnector.db that runs queries on the current thread's write batch, if there's one
+	"""
+	def execute(self, query, params = ()):
+		batch = current()
+		if batch is None:
+			return super().execute(query, params)
+		return batch.execute(query, params)
+
+	def fetch(self, query, params = (), _all = False):
+		batch = current()
+		if batch is None:
+			return super().fetch(query, params, _all)
+		return batch.fetch(query, params, _all)
+
+	def fetchAll(self, query, params = ()):
+		batch = current()
+		if batch is None:
+			return super().fetchAll(query, params)
+		return batch.fetch(query, params, True)
@@ -0,0 +1,91 @@
+from common.log import logUtils as log
+from objects import glob
+import json
+import time
+
+# Cached leaderboards are dropped after 5 minutes anyway,
+# so changes we don't get notified of (eg: hidden scores) show up eventually
+DEFAULT_EXPIRE = 300
+
+class leaderboardCache:
+	"""
+	Rendered top 50 of global leaderboards, as sent by getscores.
+	Personal bests are added by the scoreboard on every request, they aren't cached.
+
+	Stored in a redis hash per beatmap md5 (lets:leaderboard_cache:md5),
+	field relax:mode:mods:order, so a beatmap's leaderboards can be dropped all at once
+	when a new personal best is submitted or its ranked status changes.
+	Country/clan and friends leaderboards are never cached.
+	"""
+	@staticmethod
+	def _conf():
+		return glob.conf.extra["lets"].get("leaderboard-cache", {})
+
+	@property
+	def enabled(self):
+		return self._conf().get("enable", True)
+
+	@property
+	def expire(self):
+		# Checked on every field too, since setting a field refreshes the whole hash's ttl
+		return int(self._conf().get("expire", DEFAULT_EXPIRE))
+
+	def get(self, fileMd5, gameMode, relax, mods, order):
+		"""
+		Get a cached leaderboard
+
+		:param fileMd5: beatmap md5
+		:param gameMode: game mode number
+		:param relax: True for the relax leaderboard
+		:param mods: mods filter, -1 if not filtering by mods
+		:param order: sort column, score or pp
+		:return: list of [userID, visible, getscores line], or None if cache miss
+		"""
+		data = glob.redis.hget(
+			"lets:leaderboard_cache:{}".format(fileMd5),
+			"{}:{}:{}:{}".format(int(bool(relax)), gameMode, mods, order)
+		)
+		if data is not None:
+			cachedAt, rows = json.loads(data.decode("utf-8"))
+			if time.time() - cachedAt > self.expire:
+				rows = None
+		else:
+			rows = None
+		if rows is None:
+			log.debug("leaderboardCache miss")
+			glob.dog.increment(glob.DATADOG_PREFIX+".leaderboard_cache.misses")
+			return None
+		log.debug("leaderboardCache hit")
+		glob.dog.increment(glob.DATADOG_PREFIX+".leaderboard_cache.hits")
+		return rows
+
+	def set(self, fileMd5, gameMode, relax, mods, order, rows):
+		"""
+		Cache a leaderboard
+
+		:param fileMd5: beatmap md5
+		:param gameMode: game mode number
+		:param relax: True for the relax leaderboard
+		:param mods: mods filter, -1 if not filtering by mods
+		:param order: sort column, score or pp
+		:param rows: list of [userID, visible, getscores line]
+		:return:
+		"""
+		key = "lets:leaderboard_cache:{}".format(fileMd5)
+		pipe = glob.redis.pipeline()
+		pipe.hset(key, "{}:{}:{}:{}".format(int(bool(relax)), gameMode, mods, order), json.dumps([time.time(), rows]))
+		pipe.expire(key, self.expire)
+		pipe.execute()
+		log.debug("leaderboardCache set")
+
+	def delete(self, *fileMd5s):
+		"""
+		Remove every cached leaderboard of some beatmaps
+
+		:param fileMd5s: beatmaps md5
+		:return:
+		"""
+		if not fileMd5s:
+			return
+		glob.redis.delete(*["lets:leaderboard_cache:{}".format(x) for x in fileMd5s])
+		log.debug("leaderboardCache deleted {} beatmaps".format(len(fileMd5s)))
@@ -19,13 +19,13 @@ from distutils.version import LooseVersion
 from constants import rankedStatuses
 
 from common.constants import bcolors, mods
-from common.db import dbConnector
 from common.ddog import datadogClient
 from common.log import logUtils as log
 from common.redis import pubSub
 from common.web import schiavo
 from handlers import apiCacheBeatmapHandler, rateHandler, changelogHandler
 from handlers import apiPPHandler
+from handlers import apiRebuildLeaderboardsHandler
 from handlers import apiStatusHandler
 from handlers import banchoConnectHandler
 from handlers import checkUpdatesHandler
@@ -52,10 +52,15 @@ from handlers import commentHandler
 from handlers import lastFMHandler
 from helpers import config
 from helpers import consoleHelper
+from helpers import jobQueue
+from helpers import writeBatch
 from common import generalUtils
 from common import agpl
 from objects import glob
+from pp import calculatorPool
+from pubSubHandlers import beatmapCriteriaHandler
 from pubSubHandlers import beatmapUpdateHandler
+from pubSubHandlers import rankIndexHandler
 import secret.achievements.utils
 
 
@@ -93,10 +98,12 @@ def make_app():
 		(r"/api/v1/status", apiStatusHandler.handler),
 		(r"/api/v1/pp", apiPPHandler.handler),
 		(r"/api/v1/cacheBeatmap", apiCacheBeatmapHandler.handler),
+		(r"/api/v1/rebuildLeaderboards", apiRebuildLeaderboardsHandler.handler),
 
 		(r"/letsapi/v1/status", apiStatusHandler.handler),
 		(r"/letsapi/v1/pp", apiPPHandler.handler),
 		(r"/letsapi/v1/cacheBeatmap", apiCacheBeatmapHandler.handler),
+		(r"/letsapi/v1/rebuildLeaderboards", apiRebuildLeaderboardsHandler.handler),
 		(r"/web/lastfm.php", lastFMHandler.handler),
 		
 		# Not done yet
@@ -193,7 +200,7 @@ if __name__ == "__main__":
 		# Connect to db
 		try:
 			consoleHelper.printNoNl("> Connecting to MySQL database... ")
-			glob.db = dbConnector.db(glob.conf.config["db"]["host"], glob.conf.config["db"]["username"], glob.conf.config["db"]["password"], glob.conf.config["db"]["database"], int(
+			glob.db = writeBatch.batchedDb(glob.conf.config["db"]["host"], glob.conf.config["db"]["username"], glob.conf.config["db"]["password"], glob.conf.config["db"]["database"], int(
 				glob.conf.config["db"]["workers"]))
 			consoleHelper.printNoNl(" ")
 			consoleHelper.printDone()
@@ -305,8 +312,13 @@ if __name__ == "__main__":
 		# Connect to pubsub channels
 		pubSub.listener(glob.redis, {
 			"lets:beatmap_updates": beatmapUpdateHandler.handler(),
+			"lets:beatmap_criteria": beatmapCriteriaHandler.handler(),
+			"lets:rank_index": rankIndexHandler.handler(),
 		}).start()
 
+		# Start background jobs workers
+		jobQueue.start()
+
 		# Server start message and console output
 		consoleHelper.printColored("> L.E.T.S. is listening for clients on {}:{}...".format(glob.conf.config["server"]["host"], serverPort), bcolors.GREEN)
 		log.logMessage("Server started!", discord="bunker", stdout=False)
@@ -320,7 +332,7 @@ if __name__ == "__main__":
 				except:
 					log.info("[AUTOMATED QUERY] error! the connection will restart!")
 					#os.execv(sys.executable, [sys.executable] + sys.argv) //automated restart lets when error
-					glob.db = dbConnector.db(glob.conf.config["db"]["host"], glob.conf.config["db"]["username"], glob.conf.config["db"]["password"], glob.conf.config["db"]["database"], int(glob.conf.config["db"]["workers"]))
+					glob.db = writeBatch.batchedDb(glob.conf.config["db"]["host"], glob.conf.config["db"]["username"], glob.conf.config["db"]["password"], glob.conf.config["db"]["database"], int(glob.conf.config["db"]["workers"]))
 
 		# setting ke 1 jam nih
 		schedule.every(1800).seconds.do(ping)
@@ -353,4 +365,6 @@ if __name__ == "__main__":
 		# Perform some clean up
 		print("> Disposing server... ")
 		glob.fileBuffers.flushAll()
+		jobQueue.stop()
+		calculatorPool.shutdownAll()
 		consoleHelper.printColored("Goodbye!", bcolors.GREEN)
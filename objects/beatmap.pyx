@@ -6,6 +6,8 @@ from common.constants import privileges
 from constants import rankedStatuses
 from helpers import beatmapHelper
 from helpers import osuapiHelper
+from helpers import rankIndexHelper
+from helpers import writeBatch
 import objects.glob
 
 class beatmap:
@@ -55,6 +57,7 @@ class beatmap:
 		
 		# Statistics for ranking panel
 		self.playcount = 0
+		self.passcount = 0
 		self.isOsz2 = False
 
 		# Force refresh from osu api
@@ -138,6 +141,13 @@ class beatmap:
 			objects.glob.db.execute("UPDATE beatmaps SET {kp} WHERE id = %s".format(
 				kp=', '.join(f"{k} = %s" for k in params.keys())
 			), list(params.values()) + [bdata['id']])
+			# Cached leaderboards may have to be shown, hidden or sorted differently now
+			if bdata["ranked"] != self.rankedStatus:
+				objects.glob.leaderboardCache.delete(self.fileMD5)
+
+		# Drop the old row (maybe with a different md5, if the beatmap has been updated) from every process
+		fileMD5, beatmapID = self.fileMD5, self.beatmapID
+		writeBatch.afterCommit(lambda: objects.glob.beatmapCache.invalidate([fileMD5], [beatmapID]))
 
 	def saveFileName(self, fileName):
 		# Temporary workaround to avoid re-fetching all beatmaps from osu!api
@@ -149,6 +159,7 @@ class beatmap:
 				"UPDATE beatmaps SET file_name = %s WHERE beatmap_md5 = %s LIMIT 1",
 				(self.fileName, self.fileMD5)
 			)
+			objects.glob.beatmapCache.invalidate([self.fileMD5])
 
 	def setDataFromDB(self, md5):
 		"""
@@ -157,12 +168,15 @@ class beatmap:
 		md5 -- beatmap md5
 		return -- True if set, False if not set
 		"""
-		# Get data from DB
-		data = objects.glob.db.fetch("SELECT * FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [md5])
-
-		# Make sure the query returned something
+		# Get data from cache or DB
+		data = objects.glob.beatmapCache.get(md5)
 		if data is None:
-			return False
+			data = objects.glob.db.fetch("SELECT * FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [md5])
+
+			# Make sure the query returned something
+			if data is None:
+				return False
+			objects.glob.beatmapCache.set(data)
 
 		# Make sure the beatmap is not an old one
 		if data["difficulty_taiko"] == 0 and data["difficulty_ctb"] == 0 and data["difficulty_mania"] == 0:
@@ -177,9 +191,15 @@ class beatmap:
 			if data["ranked"] >= rankedStatuses.RANKED:
 				expire *= 3
 
-			# Make sure the beatmap data in db is not too old
+			# If the beatmap data in db is too old, use it anyway and refresh it in background
 			if int(expire) > 0 and time.time() > data["latest_update"]+int(expire):
-				return False
+				if self.refresh or objects.glob.pool is None:
+					return False
+				refreshInBackground(md5, data["beatmapset_id"])
+				stale = int(time.time() - data["latest_update"] - expire)
+				log.debug("Serving stale beatmap data ({} seconds)".format(stale))
+				objects.glob.dog.increment(objects.glob.DATADOG_PREFIX+".stale_beatmaps.served")
+				objects.glob.dog.gauge(objects.glob.DATADOG_PREFIX+".stale_beatmaps.staleness", stale)
 
 		# Data in DB, set beatmap data
 		log.debug("Got beatmap data from db")
@@ -231,10 +251,7 @@ class beatmap:
 		"""
 		# Check if osuapi is enabled
 		mainData = None
-		dataStd = osuapiHelper.osuApiRequest("get_beatmaps", "h={}&a=1&m=0".format(md5))
-		dataTaiko = osuapiHelper.osuApiRequest("get_beatmaps", "h={}&a=1&m=1".format(md5))
-		dataCtb = osuapiHelper.osuApiRequest("get_beatmaps", "h={}&a=1&m=2".format(md5))
-		dataMania = osuapiHelper.osuApiRequest("get_beatmaps", "h={}&a=1&m=3".format(md5))
+		dataStd, dataTaiko, dataCtb, dataMania = osuapiHelper.getBeatmapAllModes("h", md5)
 		if dataStd is not None:
 			mainData = dataStd
 		elif dataTaiko is not None:
@@ -251,10 +268,7 @@ class beatmap:
 		# Can't fint beatmap by MD5. The beatmap has been updated. Check with beatmap set ID
 		if mainData is None:
 			log.debug("osu!api data is None")
-			dataStd = osuapiHelper.osuApiRequest("get_beatmaps", "s={}&a=1&m=0".format(beatmapSetID))
-			dataTaiko = osuapiHelper.osuApiRequest("get_beatmaps", "s={}&a=1&m=1".format(beatmapSetID))
-			dataCtb = osuapiHelper.osuApiRequest("get_beatmaps", "s={}&a=1&m=2".format(beatmapSetID))
-			dataMania = osuapiHelper.osuApiRequest("get_beatmaps", "s={}&a=1&m=3".format(beatmapSetID))
+			dataStd, dataTaiko, dataCtb, dataMania = osuapiHelper.getBeatmapAllModes("s", beatmapSetID)
 			if dataStd is not None:
 				mainData = dataStd
 			elif dataTaiko is not None:
@@ -414,6 +428,8 @@ class beatmap:
 			# this is done to recover scores easier than what you think ;)
 			objects.glob.db.execute('update scores set completed = 0, pp = 0, score = 0 where beatmap_md5 = %s',[self.fileMD5])
 			objects.glob.db.execute('update scores_relax set completed = 0, pp = 0, score = 0 where beatmap_md5 = %s',[self.fileMD5])
+		rankIndexHelper.invalidate(self.fileMD5)
+		objects.glob.leaderboardCache.delete(self.fileMD5)
 	
 	def getCachedTillerinoPP(self):
 		"""
@@ -422,7 +438,9 @@ class beatmap:
 
 		return -- list with pp values. [0,0,0,0] if not cached.
 		"""
-		data = objects.glob.db.fetch("SELECT pp_100, pp_99, pp_98, pp_95 FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [self.fileMD5])
+		data = objects.glob.beatmapCache.get(self.fileMD5)
+		if data is None:
+			data = objects.glob.db.fetch("SELECT pp_100, pp_99, pp_98, pp_95 FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [self.fileMD5])
 		if data is None:
 			return [0,0,0,0]
 		return [data["pp_100"], data["pp_99"], data["pp_98"], data["pp_95"]]
@@ -434,6 +452,7 @@ class beatmap:
 		l -- list with 4 default pp values ([100,99,98,95])
 		"""
 		objects.glob.db.execute("UPDATE beatmaps SET pp_100 = %s, pp_99 = %s, pp_98 = %s, pp_95 = %s WHERE beatmap_md5 = %s", [l[0], l[1], l[2], l[3], self.fileMD5])
+		objects.glob.beatmapCache.invalidate([self.fileMD5])
 
 	@property
 	def is_rankable(self):
@@ -461,6 +480,35 @@ def convertRankedStatus(approvedStatus):
 	else:
 		return rankedStatuses.UNKNOWN
 
+def refreshInBackground(md5, beatmapSetID):
+	"""
+	Refresh a beatmap from osu!api in a background thread.
+	Only one refresh per beatmap runs at a time (across all LETS processes),
+	and at most beatmap-refresh.rate-limit refreshes are started per second
+	(rate limited beatmaps are refreshed by one of the next requests).
+
+	md5 -- beatmap md5
+	beatmapSetID -- beatmap set id
+	"""
+	conf = objects.glob.conf.extra["lets"].get("beatmap-refresh", {})
+	if not objects.glob.redis.set("lets:beatmap_refresh:{}".format(md5), "1", int(conf.get("lock-time", 60)), nx=True):
+		# Already being refreshed by someone else
+		return
+	rateKey = "lets:beatmap_refresh_rate:{}".format(int(time.time()))
+	pipe = objects.glob.redis.pipeline()
+	pipe.incr(rateKey)
+	pipe.expire(rateKey, 2)
+	count, _ = pipe.execute()
+	if count > int(conf.get("rate-limit", 5)):
+		objects.glob.redis.delete("lets:beatmap_refresh:{}".format(md5))
+		return
+	def job():
+		try:
+			beatmap(md5, beatmapSetID, refresh=True)
+		except Exception as e:
+			log.error("Error while refreshing beatmap {}: {}".format(md5, e))
+	objects.glob.pool.apply_async(job)
+
 def incrementPlaycount(md5, passed):
 	"""
 	Increment playcount (and passcount) for a beatmap
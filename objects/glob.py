@@ -1,3 +1,7 @@
+import beatmapCache
+import difficultyCache
+import leaderboardCache
+import ppMatrixCache
 import personalBestCache
 import personalBestCacheRX
 import userStatsCache
@@ -30,6 +34,10 @@ userStatsCache = userStatsCache.userStatsCache()
 userStatsCacheRX = userStatsCacheRX.userStatsCacheRX()
 personalBestCache = personalBestCache.personalBestCache()
 personalBestCacheRX = personalBestCacheRX.personalBestCacheRX()
+difficultyCache = difficultyCache.difficultyCache()
+beatmapCache = beatmapCache.beatmapCache()
+leaderboardCache = leaderboardCache.leaderboardCache()
+ppMatrixCache = ppMatrixCache.ppMatrixCache()
 fileBuffers = fileBuffer.buffersList()
 dog = datadogClient.datadogClient()
 schiavo = schiavo.schiavo()
@@ -9,6 +9,8 @@ from common.log import logUtils as log
 from common.ripple import userUtils
 from constants import rankedStatuses
 from common.ripple import scoreUtils
+from helpers import userInfoHelper
+from helpers import writeBatch
 from objects import glob
 
 RANKED_STATUS_COUNT   = [rankedStatuses.RANKED, rankedStatuses.APPROVED]
@@ -24,7 +26,7 @@ class baseScore:
 	__slots__ = ["scoreID", 'scoreChecksum', "playerName", "score", "maxCombo", "c50", "c100", "c300", "cMiss", "cKatu", "cGeki",
 				 "fullCombo", "mods", "playerUserID","rank","date", "hasReplay", "fileMd5", "passed", "playDateTime",
 				 "gameMode", "completed", "accuracy", "pp", "oldPersonalBest", "rankedScoreIncrease", "personalOldBestScore",
-				 "_playTime", "_fullPlayTime", "quit", "failed"]
+				 "_playTime", "_fullPlayTime", "quit", "failed", "_ppCache"]
 	def __init__(self, scoreID = None, rank = None, setData = True):
 		"""
 		Initialize a (empty) score object.
@@ -70,6 +72,9 @@ class baseScore:
 		self.quit = None
 		self.failed = None
 
+		# (key, pp) of the last pp calculation, see calculatePP
+		self._ppCache = None
+
 		if scoreID is not None and setData:
 			self.setDataFromDB(scoreID, rank)
 
@@ -111,7 +116,7 @@ class baseScore:
 
 	@property
 	def visibleScore(self):
-		return not(userUtils.InvisibleBoard(self.playerUserID) & 2)
+		return userInfoHelper.isScoreVisible(self.playerUserID)
 	
 	def calculateAccuracy(self):
 		"""
@@ -182,7 +187,7 @@ class baseScore:
 		self.scoreID = data["id"]
 		self.scoreChecksum = data['checksum']
 		if "username" in data:
-			self.playerName = userUtils.getClan(data["userid"])
+			self.playerName = userInfoHelper.getDisplayName(data["userid"], data["username"])
 		else:
 			self.playerName = userUtils.getUsername(data["userid"])
 		self.playerUserID = data["userid"]
@@ -205,11 +210,12 @@ class baseScore:
 		self.pp = data["pp"]
 		self.calculateAccuracy()
 
-	def setDataFromScoreData(self, scoreData, quit_=None, failed=None):
+	def setDataFromScoreData(self, scoreData, quit_=None, failed=None, b=None):
 		"""
 		Set this object's score data from scoreData list (submit modular)
 
 		scoreData -- scoreData list
+		b -- beatmap object of this score. Optional. If not passed, it will be loaded.
 		"""
 		if len(scoreData) >= 16:
 			self.fileMd5 = scoreData[0]
@@ -236,7 +242,7 @@ class baseScore:
 			self.failed = failed
 
 			# Set completed status
-			self.setCompletedStatus()
+			self.setCompletedStatus(b)
 
 
 	# replaced with key for further overrides
@@ -321,7 +327,7 @@ class baseScore:
 					self.rankedScoreIncrease = self.score-personalBest["score"]
 					self.oldPersonalBest = personalBest["id"]
 					if count_override:
-						self.calculatePP()
+						self.calculatePP(b)
 						"""
 						Allow score overtake if respective score key is the same one
 						"""
@@ -353,26 +359,59 @@ class baseScore:
 		"""
 		# Add this score
 		if self.completed >= 0:
-			query = f"INSERT INTO {type(self).t['sl']} (id, beatmap_md5, checksum, userid, score, max_combo, full_combo, mods, 300_count, 100_count, 50_count, katus_count, gekis_count, misses_count, `time`, play_mode, playtime, completed, accuracy, pp) VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-			self.scoreID = int(glob.db.execute(query, [self.fileMd5, self.scoreChecksum, userUtils.getID(self.playerName), self.score, self.maxCombo, int(self.fullCombo), self.mods, self.c300, self.c100, self.c50, self.cKatu, self.cGeki, self.cMiss, self.playDateTime, self.gameMode, self.playTime if self.playTime is not None and not self.passed else self.fullPlayTime, self.completed, self.accuracy * 100, self.pp]))
+			query = f"INSERT INTO {type(self).t['sl']} (id, beatmap_md5, checksum, userid, score, max_combo, full_combo, mods, 300_count, 100_count, 50_count, katus_count, gekis_count, misses_count, `time`, play_mode, playtime, completed, accuracy, pp, pp_version) VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
+			self.scoreID = int(glob.db.execute(query, [self.fileMd5, self.scoreChecksum, userUtils.getID(self.playerName), self.score, self.maxCombo, int(self.fullCombo), self.mods, self.c300, self.c100, self.c50, self.cKatu, self.cGeki, self.cMiss, self.playDateTime, self.gameMode, self.playTime if self.playTime is not None and not self.passed else self.fullPlayTime, self.completed, self.accuracy * 100, self.pp, type(self).ppVersion(self.gameMode)]))
 
 			# Set old personal best to completed = 2
 			if self.oldPersonalBest != 0 and self.completed == 3:
 				glob.db.execute(f"UPDATE {type(self).t['sl']} SET completed = 2 WHERE id = %s AND completed = 3 LIMIT 1", [self.oldPersonalBest])
 
-			# Update counters in redis
-			glob.redis.incr("ripple:total_submitted_scores", 1)
-			glob.redis.incr("ripple:total_pp", int(self.pp))
-		glob.redis.incr("ripple:total_plays", 1)
+			# New personal best, cached leaderboards of this beatmap are outdated
+			if self.completed == 3:
+				fileMd5 = self.fileMd5
+				writeBatch.afterCommit(lambda: glob.leaderboardCache.delete(fileMd5))
+
+			# Update counters in redis (sent on commit if we're in a write batch)
+			writeBatch.redis().incr("ripple:total_submitted_scores", 1)
+			writeBatch.redis().incr("ripple:total_pp", int(self.pp))
+		writeBatch.redis().incr("ripple:total_plays", 1)
+
+	@classmethod
+	def ppVersion(cls, gameMode):
+		"""
+		Version of the pp calculator that calculates this score class' pp in a game mode.
+		Relax taiko/ctb/mania scores use the standard calculator, so they get its version.
+
+		gameMode -- game mode
+		return -- pp_version value, 0 if the game mode has no pp calculator
+		"""
+		return getattr(cls.PP_CALCULATORS.get(gameMode), "PP_VERSION", 0)
 
 	def calculatePP(self, b = None):
 		"""
 		Calculate this score's pp value if completed == 3
+		The result is cached in this object, so calling this more than once
+		with the same score data doesn't run the pp calculator again.
+
+		b -- beatmap object of this score. Optional. If not passed, it will be loaded.
 		"""
 		# Create beatmap object
 		if b is None:
 			b = beatmap.beatmap(self.fileMd5, 0)
 
+		# Check if we have already calculated pp for this exact score data
+		key = (
+			self.fileMd5, self.gameMode, self.mods, self.c300, self.c100, self.c50, self.cGeki, self.cKatu,
+			self.cMiss, self.maxCombo, self.score, self.passed, b.rankedStatus
+		)
+		if self._ppCache is not None and self._ppCache[0] == key:
+			log.debug("Using cached pp for score {}".format(self.scoreID))
+			self.pp = self._ppCache[1]
+			return
+		self._calculatePP(b)
+		self._ppCache = (key, self.pp)
+
+	def _calculatePP(self, b):
 		# Calculate pp
 		precond    = scoreUtils.isRankable(self.mods) and self.passed and self.gameMode in type(self).PP_CALCULATORS
 		loved_nopp = glob.conf.extra["lets"]["submit"]["loved-dont-give-pp"] # OK FIRST OF ALL, WHO TF WANTS LOVED FOR A PP?????
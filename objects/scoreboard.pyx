@@ -3,6 +3,8 @@ from common.ripple import userUtils
 from constants import rankedStatuses
 from common.constants import mods as modsEnum
 from common.constants import privileges
+from helpers import rankIndexHelper
+from helpers import userInfoHelper
 from objects import glob
 from objects import beatmap
 
@@ -52,7 +54,9 @@ class baseScoreBoard:
 				self.boardmode = 0
 		elif beatmap.rankedStatus in [4]:
 			self.boardmode = 0
-		self.seeEverything = userUtils.getPrivileges(self.userID) & privileges.ADMIN_REPLAY_WATCHER
+		self.privileges = userUtils.getPrivileges(self.userID)
+		self.seeEverything = self.privileges & privileges.ADMIN_REPLAY_WATCHER
+		self.cachedScores = None		# rendered top 50 from leaderboardCache, if it was a hit
 		if setScores:
 			self.setScores()
 	
@@ -74,6 +78,11 @@ class baseScoreBoard:
 	def seeLeaderboard(self):
 		return not(self.boardvis & 1)
 	
+	@property
+	def cacheable(self):
+		# Restricted users see their own scores in the top 50, so they get uncached leaderboards
+		return glob.leaderboardCache.enabled and not (self.country or self.friends) and self.privileges & privileges.USER_PUBLIC > 0
+	
 	@staticmethod
 	def buildQuery(params):
 		return "{select} {joins} {country} {mods} {friends} {order} {limit}".format(**params)
@@ -126,15 +135,6 @@ class baseScoreBoard:
 		if self.beatmap.rankedStatus not in glob.conf.extra["_allowed_beatmap_rank"]:
 			return
 
-		# Query parts
-		cdef str select = ""
-		cdef str joins = ""
-		cdef str country = ""
-		cdef str mods = ""
-		cdef str friends = ""
-		cdef str order = ""
-		cdef str limit = ""
-
 		# Find personal best score
 		personalBestScore = self.getPersonalBest()
 
@@ -146,6 +146,54 @@ class baseScoreBoard:
 			# No personal best
 			self.scores[0] = -1
 
+		# Sort column and mods filter, used by the query and as leaderboard cache key
+		if self.forcedScore or (self.boardmode != 1):
+			# Order by score if we aren't filtering by mods or autoplay mod is enabled
+			orderColumn = "score"
+		else:
+			# Otherwise, filter by pp
+			orderColumn = "pp"
+		modsFilter = self.mods if self.mods >= 0 and self.mods & modsEnum.AUTOPLAY == 0 else -1
+
+		# Try to get the rendered top 50 from cache
+		if self.cacheable:
+			self.cachedScores = glob.leaderboardCache.get(self.beatmap.fileMD5, self.gameMode, self.relax, modsFilter, orderColumn)
+		if self.cachedScores is not None:
+			for i, cachedScore in enumerate(self.cachedScores):
+				if cachedScore[0] == self.userID:
+					self.personalBestRank = i + 1
+		else:
+			self.setTopScores(orderColumn, modsFilter)
+
+		# If personal best score was not in top 50, try to get it from cache
+		if personalBestScore is not None and self.personalBestRank < 1:
+			self.personalBestRank = glob.personalBestCache.get(self.userID, self.beatmap.fileMD5, self.country, self.friends, self.mods)
+
+		# It's not even in cache, get it from db
+		if personalBestScore is not None and self.personalBestRank < 1:
+			self.setPersonalBestRank()
+
+		# Cache our personal best rank so we can eventually use it later as
+		# before personal best rank" in submit modular when building ranking panel
+		if self.personalBestRank >= 1:
+			glob.personalBestCache.set(self.userID, self.personalBestRank, self.beatmap.fileMD5)
+
+	def setTopScores(self, str orderColumn, int modsFilter):
+		"""
+		Get top 50 scores from db, and cache them if this leaderboard can be cached
+
+		orderColumn -- sort column, score or pp
+		modsFilter -- mods to filter by, -1 if not filtering by mods
+		"""
+		# Query parts
+		cdef str select = ""
+		cdef str joins = ""
+		cdef str country = ""
+		cdef str mods = ""
+		cdef str friends = ""
+		cdef str order = ""
+		cdef str limit = ""
+
 		# Get top 50 scores
 		score_table = type(self).t['sl']
 		stats_table = type(self).t['us']
@@ -167,7 +215,7 @@ class baseScoreBoard:
 			country = ""
 
 		# Mods ranking (ignore auto, since we use it for pp sorting)
-		if self.mods >= 0 and self.mods & modsEnum.AUTOPLAY == 0:
+		if modsFilter >= 0:
 			mods = "AND sc.mods = %(mods)s"
 		else:
 			mods = ""
@@ -179,12 +227,7 @@ class baseScoreBoard:
 			friends = ""
 
 		# Sort and limit at the end
-		if self.forcedScore or (self.boardmode == 0):
-			# Order by score if we aren't filtering by mods or autoplay mod is enabled
-			order = "ORDER BY score DESC"
-		elif self.boardmode == 1:
-			# Otherwise, filter by pp
-			order = "ORDER BY pp DESC"
+		order = "ORDER BY {} DESC".format(orderColumn)
 		limit = "LIMIT 50"
 
 		# Build query, get params and run query
@@ -198,6 +241,8 @@ class baseScoreBoard:
 		cdef int c = 1
 		cdef dict topScore
 		if topScores is not None:
+			# Clan tags and visibility of every player in one go
+			userInfoHelper.prefetch(x["userid"] for x in topScores)
 			for topScore in topScores:
 				# Create score object
 				s = type(self).t['sm'](topScore["id"], setData=False)
@@ -214,6 +259,13 @@ class baseScoreBoard:
 				self.scores.append(s)
 				c+=1
 
+		# Cache the rendered rows. Visibility is stored too, since it's checked by the viewer.
+		if self.cacheable:
+			glob.leaderboardCache.set(
+				self.beatmap.fileMD5, self.gameMode, self.relax, modsFilter, orderColumn,
+				[[s.playerUserID, bool(s.visibleScore), s.getData(key=orderColumn)] for s in self.scores[1:]]
+			)
+
 		'''# If we have more than 50 scores, run query to get scores count
 		if c >= 50:
 			# Count all scores on this map
@@ -230,24 +282,20 @@ class baseScoreBoard:
 		else:
 			self.totalScores = c-1'''
 
-		# If personal best score was not in top 50, try to get it from cache
-		if personalBestScore is not None and self.personalBestRank < 1:
-			self.personalBestRank = glob.personalBestCache.get(self.userID, self.beatmap.fileMD5, self.country, self.friends, self.mods)
-
-		# It's not even in cache, get it from db
-		if personalBestScore is not None and self.personalBestRank < 1:
-			self.setPersonalBestRank()
-
-		# Cache our personal best rank so we can eventually use it later as
-		# before personal best rank" in submit modular when building ranking panel
-		if self.personalBestRank >= 1:
-			glob.personalBestCache.set(self.userID, self.personalBestRank, self.beatmap.fileMD5)
-
 	def setPersonalBestRank(self):
 		"""
 		Set personal best rank ONLY
 		Ikr, that query is HUGE but xd
 		"""
+		overwrite = ['score', 'pp'][self.boardmode]
+
+		# Global leaderboard ranks come from the rank index, if it's warm
+		if not (self.country or self.friends or self.mods > -1):
+			rank = rankIndexHelper.getRank(self.beatmap.fileMD5, self.gameMode, self.userID, overwrite, self.relax)
+			if rank is not None:
+				self.personalBestRank = rank
+				return
+
 		score_table = type(self).t['sl']
 		stats_table = type(self).t['us']
 		# Before running the HUGE query, make sure we have a score on that map
@@ -265,8 +313,6 @@ class baseScoreBoard:
 		hasScore = glob.db.fetch(query, params)
 		if hasScore is None:
 			return
-
-		overwrite = ['score', 'pp'][self.boardmode]
 		
 		# We have a score, run the huge query
 		# Base query
@@ -333,7 +379,12 @@ class baseScoreBoard:
 			data += self.scores[0].getData(key=score_key)
 
 		# Output top 50 scores
-		if self.seeLeaderboard:
+		if self.seeLeaderboard and self.cachedScores is not None:
+			for userID, visible, line in self.cachedScores:
+				if not (self.seeEverything or visible):
+					continue
+				data += line
+		elif self.seeLeaderboard:
 			for i in self.scores[1:]:
 				if not (self.seeEverything or i.visibleScore):
 					continue
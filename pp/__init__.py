@@ -2,14 +2,28 @@ from common.constants import gameModes
 from pp import rippoppai
 from pp import relaxoppai
 from pp import osuperfomance
+from pp import calculatorPool
+
+# Run on a persistent worker pool when enabled in config,
+# otherwise spawn one calculator process per score
+performanceCalculator = calculatorPool.pooled(osuperfomance.OsuPerfomanceCalculation, "performance")
+relaxCalculator = calculatorPool.pooled(relaxoppai.oppai, "relax")
+
+# Version of the pp algorithm of each calculator, stored in the pp_version column of the scores it calculates.
+# It follows the calculator, not the table: relax taiko/ctb/mania scores get PP_VERSION.
+# Bump it whenever a calculator changes, then run `tomejerry.py --outdated` to recalculate older scores.
+PP_VERSION = 1
+PP_RELAX_VERSION = 1
+performanceCalculator.PP_VERSION = PP_VERSION
+relaxCalculator.PP_VERSION = PP_RELAX_VERSION
 
 PP_CALCULATORS = {
-    gameModes.STD: osuperfomance.OsuPerfomanceCalculation,
-    gameModes.TAIKO: osuperfomance.OsuPerfomanceCalculation,
-    gameModes.CTB: osuperfomance.OsuPerfomanceCalculation,
-    gameModes.MANIA: osuperfomance.OsuPerfomanceCalculation
+    gameModes.STD: performanceCalculator,
+    gameModes.TAIKO: performanceCalculator,
+    gameModes.CTB: performanceCalculator,
+    gameModes.MANIA: performanceCalculator
 }
 
 PP_RELAX_CALCULATORS = {
-    gameModes.STD: relaxoppai.oppai
+    gameModes.STD: relaxCalculator
 }
@@ -0,0 +1,391 @@
+"""
+Persistent pp calculator workers for LETS
+
+Instead of spawning a calculator process for every score, a pool keeps a few
+long-lived calculator processes around and talks to them through their
+stdin/stdout pipes, one JSON object per line.
+
+Request sent to the worker:
+	{"id": 1, "mode": 0, "beatmap": ".data/beatmaps/123.osu", "mods": 72, "acc": 98.5,
+	 "combo": 727, "n300": 500, "n100": 12, "n50": 0, "geki": 0, "katu": 0, "miss": 1, "score": 0}
+Expected reply:
+	{"id": 1, "pp": 321.45, "stars": 5.67}
+or, if the calculation failed:
+	{"id": 1, "error": "description"}
+
+Difficulty attributes only depend on the beatmap, game mode and mods, so they're
+cached in difficultyCache. A worker should include them in its reply:
+	{"id": 1, "pp": 321.45, "stars": 5.67, "attributes": {"stars": 5.67, "aim": 2.81, ...}}
+and, when a request comes with cached "attributes", skip the difficulty calculation
+and only run the performance formula.
+A request can also ask for the pp of the same score at many accuracies, from a single difficulty calculation:
+	{"id": 3, "mode": 0, "beatmap": ".data/beatmaps/123.osu", "mods": 72, "accs": [100, 99, 98, 95], "combo": 727, "miss": 1, ...}
+	{"id": 3, "pp": [350.1, 330.2, 312.7, 270.4], "stars": 5.67}
+Score values left out of such a request (eg: "combo", "miss") mean a full combo without misses.
+A request with "difficulty": true and no score values asks for the attributes only:
+	{"id": 2, "mode": 0, "beatmap": ".data/beatmaps/123.osu", "mods": 64, "difficulty": true}
+	{"id": 2, "attributes": {"stars": 7.12, ...}}
+
+No calculator implementing this protocol ships with LETS, so pools are disabled by default.
+To use your own, set "enable", "command", "size" and "timeout" under lets -> pp-pool -> <pool name>
+in the additional config file.
+A disabled (or missing) pool makes the pooled backend fall back to its one-shot calculator.
+"""
+import json
+import queue
+import shlex
+import subprocess
+import threading
+
+from common.log import logUtils as log
+from constants import exceptions
+from helpers import mapsHelper
+from objects import glob
+
+DEFAULT_SIZE = 4
+DEFAULT_TIMEOUT = 10
+
+
+class CalculatorPoolError(Exception):
+	pass
+
+class CalculatorTimeoutError(CalculatorPoolError):
+	pass
+
+class CalculatorReplyError(CalculatorPoolError):
+	pass
+
+
+class calculatorWorker:
+	"""
+	A single long-lived calculator process
+	"""
+	def __init__(self, command):
+		"""
+		Spawn a new calculator process
+
+		command -- command line used to spawn the calculator
+		"""
+		self.command = command
+		self.lastID = 0
+		self.lines = queue.Queue()
+		self.process = subprocess.Popen(
+			shlex.split(command),
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL
+		)
+		# Read stdout in a separate thread, so calls can wait for a reply with a timeout
+		self.reader = threading.Thread(target=self._readOutput, daemon=True)
+		self.reader.start()
+
+	def _readOutput(self):
+		for line in iter(self.process.stdout.readline, b""):
+			self.lines.put(line)
+		# EOF, the process has died
+		self.lines.put(None)
+
+	def call(self, request, timeout):
+		"""
+		Send a request to this worker and wait for its reply
+
+		request -- request dictionary, without id
+		timeout -- max seconds to wait for the reply
+		return -- reply dictionary
+		"""
+		self.lastID += 1
+		request = dict(request, id=self.lastID)
+		try:
+			self.process.stdin.write(json.dumps(request).encode() + b"\n")
+			self.process.stdin.flush()
+		except (BrokenPipeError, OSError) as e:
+			raise CalculatorPoolError("Worker pipe is broken ({})".format(e))
+
+		while True:
+			try:
+				line = self.lines.get(timeout=timeout)
+			except queue.Empty:
+				raise CalculatorTimeoutError("Worker didn't reply in {} seconds".format(timeout))
+			if line is None:
+				raise CalculatorPoolError("Worker died (exit code {})".format(self.process.poll()))
+			try:
+				reply = json.loads(line.decode("utf-8", errors="ignore"))
+			except ValueError:
+				# Not a reply, probably some debug output. Skip it.
+				continue
+			if reply.get("id") != self.lastID:
+				# Reply to an older, timed out request
+				continue
+			if "error" in reply:
+				raise CalculatorReplyError(reply["error"])
+			return reply
+
+	def kill(self):
+		try:
+			self.process.kill()
+			self.process.wait(5)
+		except Exception:
+			pass
+
+
+class calculatorPool:
+	"""
+	A fixed size pool of calculator workers.
+	Hung or dead workers are replaced with new ones.
+	"""
+	def __init__(self, name, command, size=DEFAULT_SIZE, timeout=DEFAULT_TIMEOUT):
+		"""
+		Initialize a pool and spawn its workers
+
+		name -- pool name, used for logging only
+		command -- calculator command line
+		size -- number of workers
+		timeout -- per-call timeout, in seconds
+		"""
+		self.name = name
+		self.command = command
+		self.size = size
+		self.timeout = timeout
+		self.workers = queue.Queue()
+		# Number of running workers (idle or busy). Lower than size if some of them couldn't be restarted.
+		self.alive = 0
+		self._aliveLock = threading.Lock()
+		for _ in range(size):
+			self.workers.put(calculatorWorker(command))
+			self.alive += 1
+		log.info("pp pool {} ~> spawned {} workers".format(self.name, self.size))
+
+	def _replace(self, worker):
+		"""
+		Kill a hung or dead worker and spawn a new one
+
+		worker -- worker to kill, or None to only spawn a missing worker
+		return -- new worker, or None if it couldn't be spawned (the pool shrinks by one)
+		"""
+		if worker is not None:
+			worker.kill()
+			with self._aliveLock:
+				self.alive -= 1
+		try:
+			worker = calculatorWorker(self.command)
+		except OSError as e:
+			log.error("pp pool {} ~> cannot spawn worker ({}), {} left".format(self.name, e, self.alive))
+			return None
+		with self._aliveLock:
+			self.alive += 1
+		return worker
+
+	def call(self, request):
+		"""
+		Run a calculation on the first available worker
+
+		request -- request dictionary
+		return -- reply dictionary
+		"""
+		worker = None
+		if self.alive < self.size and self.workers.empty():
+			# Some workers couldn't be restarted earlier, try to refill the pool
+			worker = self._replace(None)
+		if worker is None:
+			if self.alive <= 0:
+				raise CalculatorPoolError("No {} workers running".format(self.name))
+			try:
+				worker = self.workers.get(timeout=self.timeout)
+			except queue.Empty:
+				raise CalculatorTimeoutError("No {} workers available".format(self.name))
+		try:
+			return worker.call(request, self.timeout)
+		except CalculatorReplyError:
+			# The calculator reported an error, but the worker is fine
+			raise
+		except CalculatorPoolError:
+			# Hung or dead, replace it
+			log.warning("pp pool {} ~> restarting worker".format(self.name))
+			worker = self._replace(worker)
+			raise
+		finally:
+			# Only live workers go back to the pool
+			if worker is not None:
+				self.workers.put(worker)
+
+	def shutdown(self):
+		while not self.workers.empty():
+			self.workers.get_nowait().kill()
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def getPool(name):
+	"""
+	Get a pool by name, spawning it if needed.
+
+	name -- pool name (key in "pp-pool" config)
+	return -- calculatorPool object, or None if the pool is disabled
+	"""
+	if name in _pools:
+		return _pools[name]
+	with _poolsLock:
+		if name not in _pools:
+			conf = glob.conf.extra["lets"].get("pp-pool", {}).get(name, {})
+			if not conf.get("enable", False):
+				_pools[name] = None
+			else:
+				try:
+					_pools[name] = calculatorPool(
+						name,
+						conf["command"],
+						size=int(conf.get("size", DEFAULT_SIZE)),
+						timeout=float(conf.get("timeout", DEFAULT_TIMEOUT))
+					)
+				except OSError as e:
+					log.error("pp pool {} ~> cannot spawn workers ({}). Pool disabled.".format(name, e))
+					_pools[name] = None
+	return _pools[name]
+
+def shutdownAll():
+	"""
+	Kill every spawned worker
+	"""
+	with _poolsLock:
+		for pool in _pools.values():
+			if pool is not None:
+				pool.shutdown()
+		_pools.clear()
+
+
+def difficultyAttributes(poolName, beatmap_, gameMode, mods):
+	"""
+	Get the difficulty attributes of a beatmap, calculating and caching them on the `poolName` pool if needed.
+
+	poolName -- pool name
+	beatmap_ -- beatmap object
+	gameMode -- game mode number
+	mods -- mods bitwise number
+	return -- attributes dictionary, or None if the pool is disabled or the worker doesn't return attributes
+	"""
+	attributes = glob.difficultyCache.get(beatmap_.fileMD5, poolName, gameMode, mods)
+	if attributes is not None:
+		return attributes
+	pool = getPool(poolName)
+	if pool is None:
+		return None
+	mapFile = mapsHelper.cachedMapPath(beatmap_.beatmapID)
+	mapsHelper.cacheMap(mapFile, beatmap_)
+	reply = pool.call({
+		"mode": gameMode,
+		"beatmap": mapFile,
+		"mods": mods,
+		"difficulty": True,
+	})
+	attributes = reply.get("attributes")
+	if attributes is not None:
+		glob.difficultyCache.set(beatmap_.fileMD5, poolName, gameMode, mods, attributes)
+	return attributes
+
+
+def accuracyPP(poolName, beatmap_, gameMode, mods, accs):
+	"""
+	Calculate the pp of a full combo without misses at many accuracies (tillerino-like),
+	with a single request to the `poolName` pool and the cached difficulty attributes if there are any.
+
+	poolName -- pool name
+	beatmap_ -- beatmap object
+	gameMode -- game mode number
+	mods -- mods bitwise number
+	accs -- list of accuracies
+	return -- (pp list, stars), or None if the pool is disabled
+	"""
+	pool = getPool(poolName)
+	if pool is None:
+		return None
+	mapFile = mapsHelper.cachedMapPath(beatmap_.beatmapID)
+	mapsHelper.cacheMap(mapFile, beatmap_)
+	request = {
+		"mode": gameMode,
+		"beatmap": mapFile,
+		"mods": mods,
+		"accs": list(accs),
+	}
+	attributes = glob.difficultyCache.get(beatmap_.fileMD5, poolName, gameMode, mods)
+	if attributes is not None:
+		request["attributes"] = attributes
+	reply = pool.call(request)
+	if attributes is None and "attributes" in reply:
+		attributes = reply["attributes"]
+		glob.difficultyCache.set(beatmap_.fileMD5, poolName, gameMode, mods, attributes)
+	return [float(x) for x in reply["pp"]], float(reply.get("stars", (attributes or {}).get("stars", 0)))
+
+
+def pooled(fallback, poolName):
+	"""
+	Build a pp calculator class that runs on the `poolName` pool
+	and falls back to `fallback` when the pool is disabled or unavailable.
+	The returned class can be used as a PP_CALCULATORS entry.
+
+	fallback -- one-shot calculator class
+	poolName -- pool name
+	return -- calculator class
+	"""
+	class pooledCalculation:
+		def __init__(self, beatmap_, score_=None, **kwargs):
+			self.beatmap = beatmap_
+			self.score = score_
+			self.pp = 0
+			self.stars = 0
+
+			pool = getPool(poolName)
+			accs = kwargs.get("accs")
+			if pool is None or score_ is None or set(kwargs) - {"accs"}:
+				# Pool disabled, or tillerino-like calculation. Use the one-shot calculator.
+				self._fallback(kwargs)
+				return
+
+			try:
+				mapFile = mapsHelper.cachedMapPath(self.beatmap.beatmapID)
+				mapsHelper.cacheMap(mapFile, self.beatmap)
+				request = {
+					"mode": self.score.gameMode,
+					"beatmap": mapFile,
+					"mods": self.score.mods,
+					"acc": self.score.accuracy * 100,
+					"combo": self.score.maxCombo,
+					"n300": self.score.c300,
+					"n100": self.score.c100,
+					"n50": self.score.c50,
+					"geki": self.score.cGeki,
+					"katu": self.score.cKatu,
+					"miss": self.score.cMiss,
+					"score": self.score.score,
+				}
+				if accs is not None:
+					request["accs"] = list(accs)
+				# Send cached difficulty attributes, so the worker only has to run the performance formula
+				attributes = glob.difficultyCache.get(self.beatmap.fileMD5, poolName, self.score.gameMode, self.score.mods)
+				if attributes is not None:
+					request["attributes"] = attributes
+				reply = pool.call(request)
+				if attributes is None and "attributes" in reply:
+					attributes = reply["attributes"]
+					glob.difficultyCache.set(self.beatmap.fileMD5, poolName, self.score.gameMode, self.score.mods, attributes)
+				self.pp = [float(x) for x in reply["pp"]] if accs is not None else float(reply["pp"])
+				self.stars = float(reply.get("stars", (attributes or {}).get("stars", 0)))
+				log.debug("pp pool {} ~> pp: {}, stars: {}".format(poolName, self.pp, self.stars))
+			except exceptions.osuApiFailException:
+				log.error("pp pool {} ~> osu!api error!".format(poolName))
+				self.pp = 0
+			except CalculatorTimeoutError as e:
+				log.error("pp pool {} ~> {}".format(poolName, e))
+				self.pp = 0
+			except CalculatorPoolError as e:
+				log.warning("pp pool {} ~> {}, using {}".format(poolName, e, fallback.__name__))
+				self._fallback(kwargs)
+
+		def _fallback(self, kwargs):
+			calculator = fallback(self.beatmap, self.score, **kwargs)
+			self.pp = calculator.pp
+			self.stars = getattr(calculator, "stars", 0)
+
+	pooledCalculation.__name__ = "pooled_{}".format(fallback.__name__)
+	pooledCalculation.poolName = poolName
+	return pooledCalculation
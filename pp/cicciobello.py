@@ -9,7 +9,7 @@ from pp.catch_the_pp import ppCalc
 
 
 class Cicciobello:
-    def __init__(self, _beatmap, _score=None, accuracy=0, mods=0, combo=-1, misses=0, tillerino=False):
+    def __init__(self, _beatmap, _score=None, accuracy=0, mods=0, combo=-1, misses=0, tillerino=False, accs=None):
         # Beatmap is always present
         self.beatmap = _beatmap
 
@@ -29,8 +29,11 @@ class Cicciobello:
                 self.combo = self.beatmap.maxCombo
             self.misses = misses
 
-        # Multiple acc values computation
-        self.tillerino = tillerino
+        # Multiple acc values computation (accs in %, like the other calculators)
+        if accs is None and tillerino:
+            accs = [100, 99, 98, 95]
+        self.accs = accs
+        self.tillerino = accs is not None
 
         # Result
         self.pp = 0
@@ -59,7 +62,7 @@ class Cicciobello:
             # Calculate pp
             if self.tillerino:
                 results = []
-                for acc in [1, 0.99, 0.98, 0.95]:
+                for acc in (x / 100 for x in self.accs):
                     results.append(ppCalc.calculate_pp(
                         diff=difficulty,
 						accuracy=acc,
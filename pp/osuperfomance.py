@@ -1,5 +1,7 @@
+import os
 import subprocess
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from common.log import logUtils as log
 from helpers import mapsHelper
@@ -13,6 +15,11 @@ CTB = 2
 MANIA = 3
 '''
 
+# PerformanceCalculator processes of accuracy lists run in parallel, but at most one per CPU
+# across all requests, so a big batch can't spawn an unbounded number of them
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
+
 def ReadableMods(m):
     """
     Return a string with readable std mods.
@@ -88,9 +95,16 @@ class OsuPerfomanceCalculation:
     OPC_DATA = ".data/{}"
     OPC_REGEX = r"(.+?)\s.*:\s(.*)"
 
-    def __init__(self, beatmap_, score_):
+    def __init__(self, beatmap_, score_, accs=None):
+        """
+        :param beatmap_: beatmap object
+        :param score_: score object
+        :param accs: list of accuracies. If passed, self.pp will be a list with pp values
+                     for the score's combo and misses at each of them. Optional.
+        """
         self.beatmap = beatmap_
         self.score = score_
+        self.accs = accs
         self.pp = 0
 
         # we will use this for taiko, ctb, mania
@@ -106,7 +120,7 @@ class OsuPerfomanceCalculation:
 
         self.getPP()
 
-    def _runProcess(self):
+    def _runProcess(self, acc=None):
         # Run with dotnet
         # dotnet run --project .\osu-tools\PerformanceCalculator\ simulate osu <map_path> -a 94 -c 334 -m dt -m hd -X(misses) 0 -M(50) 0 -G(100) 21
         command = "dotnet ./pp/osu-tools/PerformanceCalculator/bin/Release/netcoreapp3.1/PerformanceCalculator.dll simulate"
@@ -121,8 +135,9 @@ class OsuPerfomanceCalculation:
             # cmd.append('-a'); cmd.append(int(self.score.accuracy * 100))
             cmd.append('-c'); cmd.append(int(self.score.maxCombo))
             cmd.append('-X'); cmd.append(int(self.score.cMiss))
-            cmd.append('-M'); cmd.append(int(self.score.c50))
-            cmd.append('-G'); cmd.append(int(self.score.c100))
+            if acc is None:
+                cmd.append('-M'); cmd.append(int(self.score.c50))
+                cmd.append('-G'); cmd.append(int(self.score.c100))
         elif self.score.gameMode == 1:
             # taiko
             command += f" taiko {self.mapPath} -a {int(self.score.accuracy)} " \
@@ -133,7 +148,8 @@ class OsuPerfomanceCalculation:
             # cmd.append('-a'); cmd.append(int(self.score.accuracy * 100))
             cmd.append('-c'); cmd.append(int(self.score.maxCombo))
             cmd.append('-X'); cmd.append(int(self.score.cMiss))
-            cmd.append('-G'); cmd.append(int(self.score.c100))
+            if acc is None:
+                cmd.append('-G'); cmd.append(int(self.score.c100))
         elif self.score.gameMode == 2:
             # ctb
             command += f" catch {self.mapPath} -a {int(self.score.accuracy)} " \
@@ -145,14 +161,19 @@ class OsuPerfomanceCalculation:
             # cmd.append('-a'); cmd.append(int(self.score.accuracy * 100))
             cmd.append('-c'); cmd.append(int(self.score.maxCombo))
             cmd.append('-X'); cmd.append(int(self.score.cMiss))
-            cmd.append('-T'); cmd.append(int(self.score.c50))
-            cmd.append('-D'); cmd.append(int(self.score.c100))
+            if acc is None:
+                cmd.append('-T'); cmd.append(int(self.score.c50))
+                cmd.append('-D'); cmd.append(int(self.score.c100))
         elif self.score.gameMode == 3:
             # mania
             command += f" mania {self.mapPath} -s {int(self.score.score)} "
             cmd.append('mania'); cmd.append(self.mapPath)
             cmd.append('-s'); cmd.append(self.score.score)
 
+        # Hit counts are replaced by the requested accuracy (mania pp only depends on score)
+        if acc is not None and self.score.gameMode != 3:
+            cmd.append('-a'); cmd.append(acc)
+
         if self.score.mods > 0:
             for mod in ReadableMods(self.score.mods):
                 command += f"-m {mod} "
@@ -203,7 +224,11 @@ class OsuPerfomanceCalculation:
             mapsHelper.cacheMap(self.mapPath, self.beatmap)
 
             # Calculate pp
-            self.pp = self._runProcess()
+            if self.accs is None:
+                self.pp = self._runProcess()
+            else:
+                # PerformanceCalculator takes one acc per run, so run them all at the same time
+                self.pp = list(_executor.map(self._runProcess, self.accs))
         except OsuPerfomanceCalculationsError as e:
             log.warning("Invalid beatmap {}".format(
                 self.beatmap.beatmapID))
@@ -4,6 +4,7 @@ oppai interface for ripple 2 / LETS
 import json
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from common.constants import gameModes
 from common.log import logUtils as log
@@ -12,9 +13,14 @@ from constants import exceptions
 from helpers import mapsHelper
 
 # constants
+TILLERINO_ACCS = [100, 99, 98, 95]
 MODULE_NAME = "rippoppai"
 UNIX = True if os.name == "posix" else False
 
+# oppai processes of tillerino-like calculations run in parallel, but at most one per CPU
+# across all requests, so a big batch can't spawn an unbounded number of them
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
 def fixPath(command):
 	"""
 	Replace / with \ if running under WIN32
@@ -37,7 +43,7 @@ class oppai:
 	"""
 	# __slots__ = ["pp", "score", "acc", "mods", "combo", "misses", "stars", "beatmap", "map"]
 
-	def __init__(self, __beatmap, __score = None, acc = 0, mods = 0, tillerino = False):
+	def __init__(self, __beatmap, __score = None, acc = 0, mods = 0, tillerino = False, accs = None):
 		"""
 		Set oppai params.
 
@@ -46,6 +52,7 @@ class oppai:
 		acc -- manual acc. Used in tillerino-like bot. You don't need this if you pass __score object
 		mods -- manual mods. Used in tillerino-like bot. You don't need this if you pass __score object
 		tillerino -- If True, self.pp will be a list with pp values for 100%, 99%, 98% and 95% acc. Optional.
+		accs -- list of accuracies. If passed, self.pp will be a list with pp values for each of them. Optional.
 		"""
 		# Default values
 		self.pp = None
@@ -55,7 +62,8 @@ class oppai:
 		self.combo = -1	#FC
 		self.misses = 0
 		self.stars = 0
-		self.tillerino = tillerino
+		self.accs = accs if accs is not None else (TILLERINO_ACCS if tillerino else None)
+		self.tillerino = self.accs is not None
 
 		# Beatmap object
 		self.beatmap = __beatmap
@@ -152,18 +160,15 @@ class oppai:
 				else:
 					self.pp = temp_pp
 			else:
-				pp_list = []
-				for acc in [100, 99, 98, 95]:
-					temp_command = command
-					temp_command += " {acc:.2f}%".format(acc=acc)
-					pp, self.stars = self._runOppaiProcess(temp_command)
-
-					# If this is a broken converted, set all pp to 0 and break the loop
-					if self.gameMode == gameModes.TAIKO and self.beatmap.starsStd > 0 and pp > 800:
-						pp_list = [0, 0, 0, 0]
-						break
-
-					pp_list.append(pp)
+				# oppai takes one acc per run, so run them all at the same time
+				commands = [command + " {acc:.2f}%".format(acc=acc) for acc in self.accs]
+				results = list(_executor.map(self._runOppaiProcess, commands))
+				pp_list = [pp for pp, _ in results]
+				self.stars = results[0][1] if results else 0
+
+				# If this is a broken converted, set all pp to 0
+				if self.gameMode == gameModes.TAIKO and self.beatmap.starsStd > 0 and any(pp > 800 for pp in pp_list):
+					pp_list = [0] * len(pp_list)
 				self.pp = pp_list
 
 			log.debug("oppai ~> Calculated PP: {}, stars: {}".format(self.pp, self.stars))
@@ -0,0 +1,83 @@
+from common.constants import mods as PlayMods
+from common.log import logUtils as log
+from objects import glob
+import json
+
+# Mods supported by oppai (same mask as rippoppai/relaxoppai), plus relax since it uses another calculator
+PP_MODS = 5983 | PlayMods.RELAX
+
+# Accuracy values of a pp matrix row
+ACCURACIES = (100, 99, 98, 95)
+
+# Unused pp matrixes are removed after 30 days
+EXPIRE = 2592000
+
+class ppMatrixCache:
+	"""
+	pp values for 100%, 99%, 98% and 95% accuracy (and star rating) of a beatmap,
+	for a game mode and mods combination, as returned by /api/v1/pp.
+	They never change for a given .osu file, so each mods combination is calculated once.
+
+	Stored in a redis hash per beatmap md5 (ripple:pp_matrix:md5), field mode:mods
+	"""
+	@staticmethod
+	def normalizeMods(mods):
+		"""
+		Remove mods that don't affect pp, so equivalent mods combinations share the same cache entry
+
+		:param mods: mods bitwise number
+		:return: normalized mods bitwise number
+		"""
+		mods &= PP_MODS
+		if mods & PlayMods.NIGHTCORE:
+			mods = (mods & ~PlayMods.NIGHTCORE) | PlayMods.DOUBLETIME
+		return mods
+
+	def get(self, fileMd5, gameMode, mods):
+		"""
+		Get a cached pp matrix row
+
+		:param fileMd5: beatmap md5
+		:param gameMode: game mode number
+		:param mods: mods bitwise number
+		:return: {"pp": [pp for each of ACCURACIES], "stars": stars}, or None if cache miss
+		"""
+		data = glob.redis.hget(
+			"ripple:pp_matrix:{}".format(fileMd5),
+			"{}:{}".format(gameMode, self.normalizeMods(mods))
+		)
+		if data is None:
+			log.debug("ppMatrixCache miss")
+			return None
+		log.debug("ppMatrixCache hit")
+		return json.loads(data.decode("utf-8"))
+
+	def set(self, fileMd5, gameMode, mods, pp, stars):
+		"""
+		Cache a pp matrix row
+
+		:param fileMd5: beatmap md5
+		:param gameMode: game mode number
+		:param mods: mods bitwise number
+		:param pp: list with pp for each of ACCURACIES
+		:param stars: star rating with these mods
+		:return:
+		"""
+		key = "ripple:pp_matrix:{}".format(fileMd5)
+		pipe = glob.redis.pipeline()
+		pipe.hset(key, "{}:{}".format(gameMode, self.normalizeMods(mods)), json.dumps({"pp": pp, "stars": stars}))
+		pipe.expire(key, EXPIRE)
+		pipe.execute()
+		log.debug("ppMatrixCache set")
+
+	def delete(self, *fileMd5s):
+		"""
+		Remove every cached pp matrix row of some beatmaps
+
+		:param fileMd5s: beatmaps md5
+		:return:
+		"""
+		if not fileMd5s:
+			return
+		glob.redis.delete(*["ripple:pp_matrix:{}".format(x) for x in fileMd5s])
+		log.debug("ppMatrixCache deleted {} beatmaps".format(len(fileMd5s)))
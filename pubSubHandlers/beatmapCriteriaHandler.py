@@ -0,0 +1,15 @@
+from common.redis import generalPubSubHandler
+from helpers import beatmapHelper
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	Reloads the in-memory beatmap criteria and autorank tables.
+	Publish anything on lets:beatmap_criteria after editing them.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.structure = {}
+		self.strict = False
+
+	def handle(self, data):
+		beatmapHelper.reloadTables()
@@ -1,15 +1,29 @@
 from common.redis import generalPubSubHandler
 from helpers import osuapiHelper
 from objects import beatmap
+from objects import glob
 
 def updateSet(beatmapSetID):
 	apiResponse = osuapiHelper.osuApiRequest("get_beatmaps", "s={}".format(beatmapSetID), False)
 	if len(apiResponse) == 0:
 		return
+
+	# Drop cached difficulty attributes and pp of both the old and the new difficulties
+	oldMd5s = [x["beatmap_md5"] for x in glob.db.fetchAll(
+		"SELECT beatmap_md5 FROM beatmaps WHERE beatmapset_id = %s", [beatmapSetID]
+	)]
+	md5s = set(oldMd5s + [x["file_md5"] for x in apiResponse])
+	glob.difficultyCache.delete(*md5s)
+	glob.ppMatrixCache.delete(*md5s)
+
 	for i in apiResponse:
 		beatmap.beatmap(i["file_md5"], int(i["beatmapset_id"]), refresh=True)
 
 class handler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	Refreshes beatmaps from osu!api ({"id": ...} or {"set_id": ...}),
+	or drops them from the in-process beatmap cache ({"invalidate": true, "beatmap_md5": [...], "beatmap_id": [...]})
+	"""
 	def __init__(self):
 		super().__init__()
 		self.structure = {}
@@ -19,7 +33,10 @@ class handler(generalPubSubHandler.generalPubSubHandler):
 		data = super().parseData(data)
 		if data is None:
 			return
-		if "id" in data:
+		if data.get("invalidate"):
+			# A beatmap row has been changed by another process, drop our cached copy
+			glob.beatmapCache.delete(data.get("beatmap_md5", []), data.get("beatmap_id", []))
+		elif "id" in data:
 			beatmapData = osuapiHelper.osuApiRequest("get_beatmaps", "b={}".format(data["id"]))
 			if beatmapData is not None and "beatmapset_id" in beatmapData:
 				updateSet(beatmapData["beatmapset_id"])
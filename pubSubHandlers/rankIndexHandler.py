@@ -0,0 +1,24 @@
+from common.redis import generalPubSubHandler
+from helpers import rankIndexHelper
+from objects import glob
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+	"""
+	Keeps the personal best rank index and cached leaderboards in sync with changes made outside lets.
+	Publish {"user_id": ...} after restricting, banning or unrestricting someone,
+	or {"beatmap_md5": ...} after changing a beatmap's scores.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.structure = {}
+		self.strict = False
+
+	def handle(self, data):
+		data = super().parseData(data)
+		if data is None:
+			return
+		if "user_id" in data:
+			rankIndexHelper.refreshUser(int(data["user_id"]))
+		elif "beatmap_md5" in data:
+			rankIndexHelper.invalidate(data["beatmap_md5"])
+			glob.leaderboardCache.delete(data["beatmap_md5"])
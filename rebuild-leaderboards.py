@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.6
+import argparse
+import json
+import logging
+import time
+
+import redis
+
+from common.db import dbConnector
+from constants import exceptions
+from helpers import config
+from helpers import leaderboardHelper
+from objects import glob
+
+
+def main():
+    # CLI stuff
+    parser = argparse.ArgumentParser(
+        description="Rebuilds the global and country leaderboards in redis from the users stats in db"
+    )
+    parser.add_argument(
+        "-t", "--table", help="leaderboards to rebuild: std (users_stats), relax (rx_stats) or both. Default: both",
+        choices=["std", "relax", "both"], default="both", required=False
+    )
+    parser.add_argument(
+        "-m", "--modes", help="comma separated game modes to rebuild (std:0, taiko:1, ctb:2, mania:3). Default: all",
+        default="0,1,2,3", required=False
+    )
+    parser.add_argument(
+        "-bs", "--batchsize", help="number of users loaded with each query. Default: {}".format(
+            leaderboardHelper.REBUILD_BATCH_SIZE
+        ), default=leaderboardHelper.REBUILD_BATCH_SIZE, required=False
+    )
+    parser.add_argument("-v", "--verbose", help="verbose/debug mode", required=False, action="store_true")
+    args = parser.parse_args()
+    try:
+        game_modes = [int(x) for x in args.modes.split(",") if x.strip()]
+    except ValueError:
+        game_modes = []
+    if not game_modes or any(x not in range(4) for x in game_modes):
+        parser.error("invalid game modes: {} (expected comma separated numbers from 0 to 3)".format(args.modes))
+
+    # Logging
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    glob.debug = args.verbose
+
+    # Load config
+    logging.info("Reading config file")
+    glob.conf = config.config("config.ini")
+    with open(glob.conf.config["custom"]["config"], "r") as f:
+        glob.conf.extra = json.load(f)
+
+    # Connect to MySQL and redis
+    logging.info("Connecting to MySQL db")
+    glob.db = dbConnector.db(
+        glob.conf.config["db"]["host"],
+        glob.conf.config["db"]["username"],
+        glob.conf.config["db"]["password"],
+        glob.conf.config["db"]["database"],
+        int(glob.conf.config["db"]["workers"])
+    )
+    logging.info("Connecting to redis")
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+    glob.redis.ping()
+
+    relax_list = [False, True] if args.table == "both" else [args.table == "relax"]
+
+    start_time = time.time()
+    counts = {}
+    for relax in relax_list:
+        logging.info("Rebuilding {}leaderboards".format("relax " if relax else ""))
+        try:
+            counts.update(leaderboardHelper.rebuild(game_modes, relax, int(args.batchsize)))
+        except exceptions.leaderboardRebuildLockedError:
+            logging.error("Another leaderboards rebuild is running (lock: {})".format(leaderboardHelper.REBUILD_LOCK_KEY))
+            return
+
+    global_keys = sorted([x for x in counts if x.count(":") == 2])
+    logging.info(
+        "\n\nDone!\n"
+        "{}\n"
+        ":: Country leaderboards\t{}\n\n"
+        ":: Took\t{:.2f} seconds".format(
+            "\n".join(":: {}\t{} users".format(x, counts[x]) for x in global_keys),
+            len(counts) - len(global_keys),
+            time.time() - start_time
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3.6
+import argparse
+import json
+import logging
+import time
+import warnings
+
+import MySQLdb
+import progressbar
+import redis
+
+from common.db import dbConnector
+from helpers import bulkUpdateHelper
+from helpers import config
+from helpers import statsRebuildHelper
+from objects import glob
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def main():
+    # CLI stuff
+    parser = argparse.ArgumentParser(
+        description="Rebuilds total pp and accuracy of every user, in every game mode, from their best scores"
+    )
+    parser.add_argument(
+        "-t", "--table", help="stats to rebuild: std (users_stats), relax (rx_stats) or both. Default: both",
+        choices=["std", "relax", "both"], default="both", required=False
+    )
+    parser.add_argument(
+        "-bs", "--batchsize", help="number of users loaded with each query. Default: {}".format(DEFAULT_BATCH_SIZE),
+        default=DEFAULT_BATCH_SIZE, required=False
+    )
+    parser.add_argument("-v", "--verbose", help="verbose/debug mode", required=False, action="store_true")
+    args = parser.parse_args()
+
+    # Logging
+    progressbar.streams.wrap_stderr()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    glob.debug = args.verbose
+
+    # Load config
+    logging.info("Reading config file")
+    glob.conf = config.config("config.ini")
+    with open(glob.conf.config["custom"]["config"], "r") as f:
+        glob.conf.extra = json.load(f)
+
+    # Stats are updated with a joined UPDATE on a temporary table
+    warnings.filterwarnings("ignore", category=MySQLdb.Warning)
+
+    # Connect to MySQL and redis
+    logging.info("Connecting to MySQL db")
+    glob.db = dbConnector.db(
+        glob.conf.config["db"]["host"],
+        glob.conf.config["db"]["username"],
+        glob.conf.config["db"]["password"],
+        glob.conf.config["db"]["database"],
+        int(glob.conf.config["db"]["workers"])
+    )
+    logging.info("Connecting to redis")
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+    glob.redis.ping()
+
+    relax_list = [False, True] if args.table == "both" else [args.table == "relax"]
+    total_users = glob.db.fetch("SELECT COUNT(*) AS c FROM users")["c"]
+    logging.info("Rebuilding {} stats of {} users".format(
+        " and ".join([statsRebuildHelper.TABLES[x][1] for x in relax_list]), total_users
+    ))
+
+    start_time = time.time()
+    done_users = 0
+    with progressbar.ProgressBar(max_value=total_users, redirect_stdout=True) as bar:
+        for user_ids in statsRebuildHelper.userBatches(int(args.batchsize)):
+            for relax in relax_list:
+                statsRebuildHelper.rebuildBatch(user_ids, relax, bulkUpdateHelper.DEFAULT_BATCH_SIZE)
+
+            # Drop the cached stats of these users, LETS will read the new ones from db
+            pipe = glob.redis.pipeline()
+            for user_id in user_ids:
+                for game_mode in range(len(statsRebuildHelper.GAME_MODES)):
+                    if False in relax_list:
+                        pipe.delete("lets:user_stats_cache:{}:{}".format(game_mode, user_id))
+                    if True in relax_list:
+                        pipe.delete("lets:user_stats_cache_relax:{}:{}".format(game_mode, user_id))
+            pipe.execute()
+
+            done_users += len(user_ids)
+            bar.update(min(done_users, total_users))
+
+    logging.info(
+        "\n\nDone!\n"
+        ":: Users\t{}\n\n"
+        ":: Took\t{:.2f} seconds".format(done_users, time.time() - start_time)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -11,10 +11,11 @@ import secret.achievements.utils
 from common import generalUtils
 from common.constants import bcolors
 from common.db import dbConnector
-from common.ripple.userUtils import refreshStatsRx, getAll
 from constants import rankedStatuses
 from helpers import config
 from helpers import consoleHelper
+from helpers import leaderboardHelper
+from helpers import statsRebuildHelper
 from objects import glob
 
 
@@ -199,6 +200,7 @@ def init():
 if __name__ == '__main__':
     init()
 
-    users = getAll()
-    for user in users:
-        refreshStatsRx(user['id'], 0)  # 0 is std
+    # Rebuild rx_stats of every user in bulk, in every game mode, then the relax leaderboards
+    for user_ids in statsRebuildHelper.userBatches(1000):
+        statsRebuildHelper.rebuildBatch(user_ids, relax=True)
+    leaderboardHelper.rebuild(relax=True)
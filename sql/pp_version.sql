@@ -0,0 +1,5 @@
+-- pp calculator version of every score (see PP_VERSION in pp/__init__.py).
+-- Run it before deploying a LETS version that writes pp_version: score submission and
+-- tomejerry fail on databases without this column.
+ALTER TABLE scores ADD pp_version SMALLINT UNSIGNED NOT NULL DEFAULT 0, ADD INDEX (pp_version);
+ALTER TABLE scores_relax ADD pp_version SMALLINT UNSIGNED NOT NULL DEFAULT 0, ADD INDEX (pp_version);
@@ -0,0 +1,44 @@
+"""
+Microbenchmark of the score submission decryption: compiled backend vs pure python reference.
+
+Run from the repo root, after building the Cython modules (python3.6 setup.py build_ext --inplace):
+	python -m tests.bench_aeshelper [-n ITERATIONS]
+"""
+import argparse
+import base64
+import os
+import timeit
+
+from helpers import aeshelper
+
+KEY = "osu!-scoreburgr---------20190906"
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Rijndael-256 CBC decryption benchmark")
+	parser.add_argument("-n", "--iterations", help="decryptions per payload size. Default: 1000", type=int, default=1000)
+	args = parser.parse_args()
+
+	if aeshelper.rijndaelFast is None:
+		print("helpers/rijndaelFast.pyx is not compiled, only the reference implementation will be measured")
+	iv = base64.b64encode(os.urandom(32)).decode()
+	# Score data (~200 bytes), client hash (~700 bytes), and something bigger
+	for size in (224, 704, 4096):
+		data = base64.b64encode(os.urandom(size)).decode()
+		reference = timeit.timeit(
+			lambda: aeshelper.decryptRinjdaelReference(
+				KEY, base64.b64decode(iv).decode("latin_1"), base64.b64decode(data).decode("latin_1")
+			),
+			number=args.iterations
+		)
+		fast = timeit.timeit(lambda: aeshelper.decryptRinjdael(KEY, iv, data, True), number=args.iterations)
+		print("{} bytes\treference {:.1f} us\tdecryptRinjdael {:.1f} us\t{:.1f}x".format(
+			size,
+			reference / args.iterations * 1e6,
+			fast / args.iterations * 1e6,
+			reference / fast
+		))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,53 @@
+"""
+Tiny JSON-lines pp calculator used by the tests in place of a real one (see pp/calculatorPool.py).
+
+pp is twice the accuracy, stars depend on the mods only. Every reply has the worker's
+pid, so tests can tell when a worker has been replaced. Test-only request fields:
+	"crash": true -- exit without replying
+	"hang": true -- never reply
+	"fail": true -- reply with an error
+"""
+import json
+import os
+import sys
+import time
+
+
+def stars(mods):
+	return 5 + mods / 1000
+
+
+def reply(request):
+	result = {"id": request["id"], "pid": os.getpid()}
+	if request.get("fail"):
+		result["error"] = "calculation failed"
+		return result
+	attributes = request.get("attributes")
+	result["cachedAttributes"] = attributes is not None
+	if attributes is None:
+		attributes = {"stars": stars(request.get("mods", 0))}
+		result["attributes"] = attributes
+	if request.get("difficulty"):
+		return result
+	if "accs" in request:
+		result["pp"] = [acc * 2 for acc in request["accs"]]
+	else:
+		result["pp"] = request.get("acc", 100) * 2
+	result["stars"] = attributes["stars"]
+	return result
+
+
+def main():
+	for line in sys.stdin:
+		request = json.loads(line)
+		if request.get("crash"):
+			sys.exit(1)
+		if request.get("hang"):
+			while True:
+				time.sleep(60)
+		sys.stdout.write(json.dumps(reply(request)) + "\n")
+		sys.stdout.flush()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,44 @@
+"""
+In-memory stand-in for the few redis commands used by the caches under test
+"""
+
+
+class fakeRedis:
+	def __init__(self):
+		self.data = {}
+
+	def hget(self, key, field):
+		return self.data.get(key, {}).get(field)
+
+	def hset(self, key, field, value):
+		self.data.setdefault(key, {})[field] = value.encode() if type(value) is str else value
+
+	def hgetall(self, key):
+		return dict(self.data.get(key, {}))
+
+	def expire(self, key, seconds):
+		return key in self.data
+
+	def delete(self, *keys):
+		for k in keys:
+			self.data.pop(k, None)
+
+	def pipeline(self, transaction=True):
+		return fakePipeline(self)
+
+
+class fakePipeline:
+	def __init__(self, redis):
+		self.redis = redis
+		self.commands = []
+
+	def __getattr__(self, name):
+		def command(*args, **kwargs):
+			self.commands.append((getattr(self.redis, name), args, kwargs))
+			return self
+		return command
+
+	def execute(self):
+		results = [f(*args, **kwargs) for f, args, kwargs in self.commands]
+		self.commands = []
+		return results
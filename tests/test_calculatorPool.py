@@ -0,0 +1,151 @@
+"""
+Persistent pp calculator pool, driven by a fake JSON-lines worker (tests/fakeCalculator.py).
+Needs the common submodule, like the rest of LETS.
+
+Run from the repo root: python -m pytest tests
+"""
+import os
+import shlex
+import sys
+import types
+import unittest
+from unittest import mock
+
+from fakeRedis import fakeRedis
+from objects import glob
+from pp import calculatorPool
+
+COMMAND = "{} {}".format(
+	shlex.quote(sys.executable), shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakeCalculator.py"))
+)
+
+
+def poolConfig(**pools):
+	return types.SimpleNamespace(extra={"lets": {"pp-pool": pools}})
+
+
+def fakeBeatmap():
+	return types.SimpleNamespace(beatmapID=123, fileMD5="a" * 32)
+
+
+def fakeScore(**kwargs):
+	values = dict(
+		gameMode=0, mods=64, accuracy=0.985, maxCombo=727, c300=500, c100=12, c50=0,
+		cGeki=0, cKatu=0, cMiss=1, score=1234567
+	)
+	values.update(kwargs)
+	return types.SimpleNamespace(**values)
+
+
+class fakeOneShotCalculator:
+	"""
+	Stands for the one-shot calculators (oppai, PerformanceCalculator)
+	"""
+	def __init__(self, beatmap_, score_=None, **kwargs):
+		self.pp = -1
+		self.stars = -1
+
+
+class testCalculatorPool(unittest.TestCase):
+	def setUp(self):
+		self.pool = calculatorPool.calculatorPool("test", COMMAND, size=1, timeout=2)
+
+	def tearDown(self):
+		self.pool.shutdown()
+
+	def testReply(self):
+		reply = self.pool.call({"mode": 0, "mods": 0, "acc": 98.5})
+		self.assertEqual(reply["pp"], 197)
+		self.assertEqual(reply["stars"], 5)
+		reply = self.pool.call({"mode": 0, "mods": 64, "accs": [100, 95]})
+		self.assertEqual(reply["pp"], [200, 190])
+
+	def testReplyError(self):
+		pid = self.pool.call({"acc": 100})["pid"]
+		with self.assertRaises(calculatorPool.CalculatorReplyError):
+			self.pool.call({"fail": True})
+		# An error reply doesn't mean the worker is broken
+		self.assertEqual(self.pool.call({"acc": 100})["pid"], pid)
+
+	def testHungWorker(self):
+		self.pool.timeout = 0.5
+		pid = self.pool.call({"acc": 100})["pid"]
+		with self.assertRaises(calculatorPool.CalculatorTimeoutError):
+			self.pool.call({"hang": True})
+		# Killed and replaced
+		self.assertEqual(self.pool.alive, 1)
+		self.assertNotEqual(self.pool.call({"acc": 100})["pid"], pid)
+
+	def testCrashedWorker(self):
+		pid = self.pool.call({"acc": 100})["pid"]
+		with self.assertRaises(calculatorPool.CalculatorPoolError) as e:
+			self.pool.call({"crash": True})
+		self.assertNotIsInstance(e.exception, calculatorPool.CalculatorTimeoutError)
+		self.assertEqual(self.pool.alive, 1)
+		self.assertNotEqual(self.pool.call({"acc": 100})["pid"], pid)
+
+	def testRespawnFailure(self):
+		command = self.pool.command
+		self.pool.command = "/nonexistent/calculator"
+		with self.assertRaises(calculatorPool.CalculatorPoolError):
+			self.pool.call({"crash": True})
+		# The dead worker isn't put back, the pool shrinks
+		self.assertEqual(self.pool.alive, 0)
+		self.assertTrue(self.pool.workers.empty())
+		with self.assertRaises(calculatorPool.CalculatorPoolError):
+			self.pool.call({"acc": 100})
+
+		# And refills once workers can be spawned again
+		self.pool.command = command
+		self.assertEqual(self.pool.call({"acc": 100})["pp"], 200)
+		self.assertEqual(self.pool.alive, 1)
+		self.assertEqual(self.pool.workers.qsize(), 1)
+
+
+class testPooledCalculator(unittest.TestCase):
+	def setUp(self):
+		self.patches = [
+			mock.patch.object(glob, "redis", fakeRedis()),
+			mock.patch.object(calculatorPool.mapsHelper, "cachedMapPath", lambda beatmapID: "{}.osu".format(beatmapID)),
+			mock.patch.object(calculatorPool.mapsHelper, "cacheMap", lambda mapFile, beatmap_: None),
+		]
+		for x in self.patches:
+			x.start()
+		self.calculator = calculatorPool.pooled(fakeOneShotCalculator, "test")
+
+	def tearDown(self):
+		calculatorPool.shutdownAll()
+		for x in self.patches:
+			x.stop()
+
+	def testPool(self):
+		with mock.patch.object(glob, "conf", poolConfig(test={"enable": True, "command": COMMAND, "size": 1})):
+			calculation = self.calculator(fakeBeatmap(), fakeScore())
+		self.assertEqual(calculation.pp, 197)
+		self.assertEqual(calculation.stars, 5.064)
+
+	def testDisabledPool(self):
+		with mock.patch.object(glob, "conf", poolConfig(test={"enable": False})):
+			calculation = self.calculator(fakeBeatmap(), fakeScore())
+		self.assertEqual(calculation.pp, -1)
+
+	def testUnavailablePool(self):
+		with mock.patch.object(glob, "conf", poolConfig(test={"enable": True, "command": COMMAND, "size": 1})):
+			calculatorPool.getPool("test").command = "/nonexistent/calculator"
+			# The worker dies and can't be replaced
+			with mock.patch.object(calculatorPool.calculatorWorker, "call", side_effect=calculatorPool.CalculatorPoolError("dead")):
+				calculation = self.calculator(fakeBeatmap(), fakeScore())
+			self.assertEqual(calculation.pp, -1)
+			# Then the pool is empty
+			calculation = self.calculator(fakeBeatmap(), fakeScore())
+			self.assertEqual(calculation.pp, -1)
+
+	def testSpawnFailure(self):
+		with mock.patch.object(glob, "conf", poolConfig(test={"enable": True, "command": "/nonexistent/calculator"})):
+			self.assertIsNone(calculatorPool.getPool("test"))
+			calculation = self.calculator(fakeBeatmap(), fakeScore())
+		self.assertEqual(calculation.pp, -1)
+
+
+if __name__ == "__main__":
+	unittest.main()
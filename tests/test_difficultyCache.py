@@ -0,0 +1,108 @@
+"""
+Difficulty attributes cache: keys, pooled calculations and invalidation on beatmap updates.
+Attributes are calculated by the fake worker of tests/fakeCalculator.py.
+Needs the common submodule and the compiled Cython modules, like the rest of LETS.
+
+Run from the repo root: python -m pytest tests
+"""
+import json
+import types
+import unittest
+from unittest import mock
+
+from common.constants import mods
+from fakeRedis import fakeRedis
+from objects import glob
+from pp import calculatorPool
+from pubSubHandlers import beatmapUpdateHandler
+from test_calculatorPool import COMMAND, fakeBeatmap, fakeOneShotCalculator, fakeScore, poolConfig
+
+KEY = "ripple:difficulty_attributes:{}"
+
+
+class testKeys(unittest.TestCase):
+	def testNormalizeMods(self):
+		cache = glob.difficultyCache
+		# NF, SD and PF don't change the difficulty
+		self.assertEqual(cache.normalizeMods(mods.NOFAIL | mods.HIDDEN), mods.HIDDEN)
+		self.assertEqual(cache.normalizeMods(mods.SUDDENDEATH | mods.PERFECT | mods.HARDROCK), mods.HARDROCK)
+		# NC is DT
+		self.assertEqual(cache.normalizeMods(mods.NIGHTCORE), mods.DOUBLETIME)
+		self.assertEqual(cache.normalizeMods(mods.NIGHTCORE | mods.DOUBLETIME), mods.DOUBLETIME)
+		self.assertEqual(cache.normalizeMods(mods.RELAX | mods.EASY), mods.RELAX | mods.EASY)
+
+	def testField(self):
+		self.assertEqual(glob.difficultyCache.field("performance", 0, mods.NIGHTCORE | mods.NOFAIL), "performance:0:64")
+		self.assertEqual(glob.difficultyCache.field("relax", 0, mods.RELAX), "relax:0:128")
+
+	def testGetSet(self):
+		with mock.patch.object(glob, "redis", fakeRedis()):
+			glob.difficultyCache.set("a" * 32, "performance", 1, mods.DOUBLETIME, {"stars": 4})
+			self.assertEqual(glob.redis.hgetall(KEY.format("a" * 32)), {"performance:1:64": b'{"stars": 4}'})
+			# Equivalent mods share the entry
+			self.assertEqual(glob.difficultyCache.get("a" * 32, "performance", 1, mods.NIGHTCORE | mods.NOFAIL), {"stars": 4})
+			# Other pools, game modes and mods don't
+			self.assertIsNone(glob.difficultyCache.get("a" * 32, "relax", 1, mods.DOUBLETIME))
+			self.assertIsNone(glob.difficultyCache.get("a" * 32, "performance", 0, mods.DOUBLETIME))
+			self.assertIsNone(glob.difficultyCache.get("a" * 32, "performance", 1, mods.HALFTIME))
+
+
+class testPooledAttributes(unittest.TestCase):
+	def setUp(self):
+		self.patches = [
+			mock.patch.object(glob, "redis", fakeRedis()),
+			mock.patch.object(glob, "conf", poolConfig(test={"enable": True, "command": COMMAND, "size": 1})),
+			mock.patch.object(calculatorPool.mapsHelper, "cachedMapPath", lambda beatmapID: "{}.osu".format(beatmapID)),
+			mock.patch.object(calculatorPool.mapsHelper, "cacheMap", lambda mapFile, beatmap_: None),
+		]
+		for x in self.patches:
+			x.start()
+
+	def tearDown(self):
+		calculatorPool.shutdownAll()
+		for x in self.patches:
+			x.stop()
+
+	def testScoreCachesAttributes(self):
+		calculation = calculatorPool.pooled(fakeOneShotCalculator, "test")(fakeBeatmap(), fakeScore(mods=mods.NIGHTCORE))
+		self.assertEqual(calculation.pp, 197)
+		# Cached under DT, with the stars the worker calculated for the submitted mods
+		attributes = json.loads(glob.redis.hget(KEY.format("a" * 32), "test:0:64").decode())
+		self.assertAlmostEqual(attributes["stars"], calculation.stars)
+
+	def testCachedAttributesAreSent(self):
+		self.assertEqual(calculatorPool.difficultyAttributes("test", fakeBeatmap(), 0, mods.DOUBLETIME), {"stars": 5.064})
+		pool = calculatorPool.getPool("test")
+		with mock.patch.object(pool, "call", wraps=pool.call) as call:
+			pp, stars = calculatorPool.accuracyPP("test", fakeBeatmap(), 0, mods.DOUBLETIME | mods.NOFAIL, [100, 95])
+		self.assertEqual(pp, [200, 190])
+		self.assertEqual(stars, 5.064)
+		self.assertEqual(call.call_args[0][0]["attributes"], {"stars": 5.064})
+
+	def testCachedAttributesWithoutPool(self):
+		calculatorPool.difficultyAttributes("test", fakeBeatmap(), 0, mods.HARDROCK)
+		calculatorPool.shutdownAll()
+		with mock.patch.object(glob, "conf", poolConfig()):
+			self.assertEqual(calculatorPool.difficultyAttributes("test", fakeBeatmap(), 0, mods.HARDROCK), {"stars": 5.016})
+			self.assertIsNone(calculatorPool.difficultyAttributes("test", fakeBeatmap(), 0, mods.EASY))
+
+
+class testBeatmapUpdates(unittest.TestCase):
+	def testUpdateSetDropsOldAndNewMd5s(self):
+		oldMd5, newMd5, otherMd5 = "o" * 32, "n" * 32, "x" * 32
+		with mock.patch.object(glob, "redis", fakeRedis()), \
+			mock.patch.object(glob, "db", types.SimpleNamespace(fetchAll=lambda query, params: [{"beatmap_md5": oldMd5}])), \
+			mock.patch.object(glob, "ppMatrixCache", mock.Mock()), \
+			mock.patch.object(beatmapUpdateHandler.osuapiHelper, "osuApiRequest", return_value=[{"file_md5": newMd5, "beatmapset_id": "1"}]), \
+			mock.patch.object(beatmapUpdateHandler.beatmap, "beatmap"):
+			for md5 in (oldMd5, newMd5, otherMd5):
+				glob.difficultyCache.set(md5, "performance", 0, 0, {"stars": 1})
+			beatmapUpdateHandler.updateSet(1)
+			self.assertIsNone(glob.difficultyCache.get(oldMd5, "performance", 0, 0))
+			self.assertIsNone(glob.difficultyCache.get(newMd5, "performance", 0, 0))
+			self.assertEqual(glob.difficultyCache.get(otherMd5, "performance", 0, 0), {"stars": 1})
+			self.assertEqual(set(glob.ppMatrixCache.delete.call_args[0]), {oldMd5, newMd5})
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,21 +1,24 @@
 #!/usr/bin/env python3.6
 import argparse
+import itertools
 import logging
 import math
 import sys
 import traceback
 import warnings
 from collections import namedtuple
-from typing import Iterable, Optional, Union, List, Dict, Any
+from typing import Iterable, Optional, Union, List, Dict, Any, Tuple, Set
 
 import os
 import threading
 import time
 import json
+import multiprocessing
 import re
 
 import MySQLdb.cursors
 import progressbar
+import redis
 from abc import abstractmethod, ABC
 from enum import Enum, IntEnum
 from progressbar import DynamicMessage, FormatLabel
@@ -23,17 +26,34 @@ from progressbar import DynamicMessage, FormatLabel
 from objects import beatmap
 from objects import score
 from common.db import dbConnector
+from constants import rankedStatuses
+from helpers import bulkUpdateHelper
 from helpers import config
+from helpers import ppDeltaReport
+from helpers import rankIndexHelper
 from objects import glob
+from pp import calculatorPool
 
 
 MAX_WORKERS = 32
+DEFAULT_BATCH_SIZE = 5000
+CHECKPOINT_INTERVAL = 10
+DEFAULT_STATE_FILE = "tomejerry_state.json"
+DEFAULT_REPORT_DIR = "tomejerry_report"
 UNIX = os.name == "posix"
 FAILED_SCORES_LOGGER = None
+LOVED_SCORES_LOGGER = None
 
 
 RecalculatorQuery = namedtuple("RecalculatorQuery", "query parameters")
 
+# A scores table: its short name, its db table and the score class whose pp calculators recalculate its scores
+ScoreTable = namedtuple("ScoreTable", "name table score_class")
+TABLES = {
+    "std": ScoreTable("std", "scores", score.standardScore),
+    "relax": ScoreTable("relax", "scores_relax", score.relaxScore)
+}
+
 
 class WorkerStatus(IntEnum):
     NOT_STARTED = 0
@@ -44,11 +64,11 @@ class WorkerStatus(IntEnum):
 
 class LwScore:
     """
-    A lightweight score object, that can hold score id and pp only
+    A lightweight score object, that can hold score id, pp and pp calculator version only
     """
-    __slots__ = ("score_id", "pp")
+    __slots__ = ("score_id", "pp", "pp_version")
 
-    def __init__(self, score_id: Optional[int]=None, pp: Optional[int]=None, score_: Optional[score.standardScore]=None):
+    def __init__(self, score_id: Optional[int]=None, pp: Optional[int]=None, score_: Optional[score.baseScore]=None):
         """
         Initializes a new LwScore. Either score_id and pp OR just score must be provided.
 
@@ -59,9 +79,11 @@ class LwScore:
         if score_ is not None:
             self.score_id = score_.scoreID
             self.pp = score_.pp
+            self.pp_version = type(score_).ppVersion(score_.gameMode)
         elif score_id is not None and pp is not None:
             self.score_id = score_id
             self.pp = pp
+            self.pp_version = 0
         else:
             raise RuntimeError("")
 
@@ -70,26 +92,49 @@ class Recalculator(ABC):
     """
     Base PP Recalculator
     """
-    def __init__(self, ids_query: RecalculatorQuery, count_query: RecalculatorQuery):
+    def __init__(self, table: ScoreTable, count_query: RecalculatorQuery):
         """
         Instantiates a new recalculator
 
-        :param ids_query: `RecalculatorQuery` that fetches the `id`s of the scores of which pp will be recalculated
+        :param table: `ScoreTable` of the scores that will be recalculated
         :param count_query: `RecalculatorQuery` that counts the _total_ number of the scoresof which pp will be
         recalculated
         """
-        self.ids_query: RecalculatorQuery = ids_query
+        self.table: ScoreTable = table
         self.count_query: RecalculatorQuery = count_query
 
     @abstractmethod
-    def offset_ids_query(self, limit: int, offset: int) -> RecalculatorQuery:
+    def keyset_query(self, limit: int, last_id: Optional[int], min_id: Optional[int]=None) -> RecalculatorQuery:
         """
-        Returns a new `RecalculatorQuery` based on `self.ids_query`, but based with LIMIT and OFFSET.
-        Will be run by each worker to get their scores.
+        Returns a new `RecalculatorQuery` that fetches the next `limit` scores (joined with their beatmaps)
+        whose id is lower than `last_id` (and not lower than `min_id`), ordered by id descending.
+        Will be run by the scores pool to get the next batch of scores.
 
         :param limit: LIMIT value
-        :param offset: OFFSET value
-        :return: `RecalculatorQuery` with LIMIT and OFFSET
+        :param last_id: id of the last score of the previous batch. `None` for the first batch.
+        :param min_id: lowest score id to fetch. Optional. Used to resume interrupted batches.
+        :return: `RecalculatorQuery` with LIMIT and keyset condition
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def beatmaps_query(self) -> RecalculatorQuery:
+        """
+        Returns a new `RecalculatorQuery` that fetches the md5 (`beatmap_md5`) and the number of scores (`c`)
+        of every beatmap with scores to recalculate. Used in process pool mode.
+
+        :return: `RecalculatorQuery`
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def beatmap_scores_query(self, beatmap_md5: str) -> RecalculatorQuery:
+        """
+        Returns a new `RecalculatorQuery` that fetches every score to recalculate (joined with its beatmap)
+        set on a beatmap. Used in process pool mode.
+
+        :param beatmap_md5: beatmap md5
+        :return: `RecalculatorQuery`
         """
         raise NotImplementedError()
 
@@ -100,13 +145,16 @@ class SimpleRecalculator(Recalculator):
     """
     def __init__(
         self,
+        table: ScoreTable,
         conditions: Union[Iterable[str], str],
         parameters: Optional[Union[Iterable[str], Dict[str, Any]]]=None
     ):
         """
         Initializes a new SimpleRecalculator
 
+        :param table: `ScoreTable` of the scores that will be recalculated
         :param conditions: The conditions that will be joined with login ANDs.
+        `{t}` is replaced with the name of the scores table.
         They can be:
         * an iterable (list, tuple, ...) of str (multiple conditions)
         * str (one condition)
@@ -119,78 +167,281 @@ class SimpleRecalculator(Recalculator):
             conditions_str = conditions
         else:
             raise TypeError("`conditions` must be either a `str`, `tuple` or `list`")
-        q = "SELECT {} FROM scores JOIN beatmaps USING(beatmap_md5) WHERE {} ORDER BY scores.id DESC"
+        conditions_str = conditions_str.replace("{t}", table.table)
+        q = "SELECT {{}} FROM {t} JOIN beatmaps USING(beatmap_md5) WHERE {{}} ORDER BY {t}.id DESC".format(t=table.table)
         # Enforces PP filter if it's not defined (to avoid nullified PP)
         if not re.search(r'\bpp (?:[<>]|[=]|[<>][=]) \d+\b', conditions_str):
             conditions_str = conditions_str + " AND pp >= 0"
+        self.conditions_str: str = conditions_str
+        self.parameters = parameters
         super(SimpleRecalculator, self).__init__(
-            ids_query=RecalculatorQuery(q.format("scores.id AS id", conditions_str), parameters),
+            table=table,
             count_query=RecalculatorQuery(q.format("COUNT(*) AS c", conditions_str), parameters)
         )
 
-    def offset_ids_query(self, limit: int, offset: int) -> str:
-        return self.ids_query.query + " LIMIT {} OFFSET {}".format(limit, offset)
+    def keyset_query(self, limit: int, last_id: Optional[int], min_id: Optional[int]=None) -> RecalculatorQuery:
+        conditions_str = self.conditions_str
+        if last_id is not None:
+            conditions_str += " AND {}.id < {}".format(self.table.table, int(last_id))
+        if min_id is not None:
+            conditions_str += " AND {}.id >= {}".format(self.table.table, int(min_id))
+        return RecalculatorQuery(
+            "SELECT * FROM {t} JOIN beatmaps USING(beatmap_md5) "
+            "WHERE {} ORDER BY {t}.id DESC LIMIT {}".format(conditions_str, int(limit), t=self.table.table),
+            self.parameters
+        )
+
+    def beatmaps_query(self) -> RecalculatorQuery:
+        return RecalculatorQuery(
+            "SELECT {t}.beatmap_md5 AS beatmap_md5, COUNT(*) AS c FROM {t} JOIN beatmaps USING(beatmap_md5) "
+            "WHERE {} GROUP BY {t}.beatmap_md5".format(self.conditions_str, t=self.table.table),
+            self.parameters
+        )
+
+    def beatmap_scores_query(self, beatmap_md5: str) -> RecalculatorQuery:
+        if not re.match(r"^[0-9a-fA-F]{32}$", beatmap_md5):
+            raise ValueError("Invalid beatmap md5")
+        return RecalculatorQuery(
+            "SELECT * FROM {t} JOIN beatmaps USING(beatmap_md5) "
+            "WHERE {} AND {t}.beatmap_md5 = '{}' ORDER BY {t}.id DESC".format(
+                self.conditions_str, beatmap_md5, t=self.table.table
+            ),
+            self.parameters
+        )
+
+
+class RecalcState:
+    """
+    Checkpoints of a recalculation, saved in a local json file so an interrupted recalculation can be resumed
+    """
+    def __init__(self, path: str, fingerprint: str):
+        """
+        Initializes a new RecalcState
+
+        :param path: path of the state file
+        :param fingerprint: string that identifies the recalculation (table, query, mode).
+        A state file can be resumed only by a recalculation with the same fingerprint.
+        """
+        self.path: str = path
+        self.fingerprint: str = fingerprint
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Loads the last checkpoint
+
+        :return: checkpoint dict, or `None` if there's no state file
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        if data.get("fingerprint") != self.fingerprint:
+            raise RuntimeError("{} has been written by a different recalculation".format(self.path))
+        return data["checkpoint"]
+
+    def save(self, checkpoint: Dict[str, Any]):
+        """
+        Saves a checkpoint, replacing the previous one
+
+        :param checkpoint: checkpoint dict
+        :return:
+        """
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "time": int(time.time()), "checkpoint": checkpoint}, f)
+        os.replace(temp_path, self.path)
+
+    def delete(self):
+        """
+        Deletes the state file, if it exists
 
+        :return:
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
-class ScoreIdsPool:
+
+class ScoresPool:
     """
-    Pool of score ids that needs to be recalculated.
+    Pool of scores that need to be recalculated.
+    Scores (joined with their beatmaps) are fetched from the database in id-ordered batches
+    (keyset pagination), only when a worker asks for a new chunk, so no score id list is kept in memory.
+    The pool keeps track of the batches that haven't been saved yet, so it can be checkpointed and resumed.
     """
-    logger = logging.getLogger("score_ids_pool")
+    logger = logging.getLogger("scores_pool")
 
     def __init__(self):
         """
         Initializes a new pool
         """
         self._lock = threading.RLock()
-        self.scores = []
+        self.recalculator: Optional[Recalculator] = None
+        self.batch_size: int = DEFAULT_BATCH_SIZE
+        self.last_id: Optional[int] = None
+        self.pending: List[List[Optional[int]]] = []
+        self.in_flight: Dict[int, Dict[str, Any]] = {}
+        self._next_batch_id: int = 0
+        self._fetched_all: bool = True
+        self._failed: bool = False
+
+    def load(
+        self,
+        recalculator: Recalculator,
+        batch_size: int=DEFAULT_BATCH_SIZE,
+        checkpoint: Optional[Dict[str, Any]]=None
+    ):
+        """
+        Sets the Recalculator instance the scores will be fetched from
+
+        :param recalculator: The recalculator instance that will be used to fetch the scores
+        :param batch_size: Number of scores fetched with each query
+        :param checkpoint: checkpoint to resume from, as returned by `checkpoint()`. Optional.
+        :return:
+        """
+        with self._lock:
+            self.recalculator = recalculator
+            self.batch_size = batch_size
+            self.last_id = None
+            self.pending = []
+            self.in_flight = {}
+            self._fetched_all = False
+            self._failed = False
+            if checkpoint is not None:
+                # What's left of the interrupted batches is fetched first, then we go on from where we stopped
+                self.last_id = checkpoint["next_id"]
+                self._fetched_all = checkpoint["fetched_all"]
+                self.pending = [
+                    [x["last_id"] if x["last_id"] is not None else x["from_id"], x["to_id"]]
+                    for x in checkpoint["batches"]
+                ]
+
+    def chunk(self, worker_id: int=-1) -> Tuple[Optional[int], List[Dict[str, Any]]]:
+        """
+        Fetches the next batch of scores (joined with their beatmaps), and moves the pool past it.
+        Batches are fetched one at a time, with a server-side cursor that is consumed right away.
 
-    def load(self, recalculator: Recalculator):
+        :param worker_id: id of the worker that will recalculate the batch
+        :return: (batch id, list of score dicts) tuple. Empty list (and `None` batch id) if there are no more scores.
+        """
+        with self._lock:
+            if self.is_empty:
+                return None, []
+            db_worker = glob.db.pool.getWorker()
+            if db_worker is None:
+                self.logger.warning("Cannot fetch scores. No database worker available!!")
+                return None, []
+            if self.pending:
+                from_id, to_id = self.pending.pop(0)
+            else:
+                from_id, to_id = self.last_id, None
+            query = self.recalculator.keyset_query(self.batch_size, from_id, to_id)
+            cursor = None
+            try:
+                cursor = db_worker.connection.cursor(MySQLdb.cursors.SSDictCursor)
+                cursor.execute(query.query, query.parameters)
+                scores = cursor.fetchall()
+            except Exception:
+                # Stop handing out chunks, or the workers would be recycled forever
+                self._failed = True
+                if to_id is not None:
+                    self.pending.insert(0, [from_id, to_id])
+                raise
+            finally:
+                if cursor is not None:
+                    cursor.close()
+                glob.db.pool.putWorker(db_worker)
+            if to_id is None:
+                if len(scores) < self.batch_size:
+                    self._fetched_all = True
+                if scores:
+                    self.last_id = scores[-1]["id"]
+            elif len(scores) == self.batch_size:
+                # There's more left in this interrupted batch
+                self.pending.insert(0, [scores[-1]["id"], to_id])
+            if not scores:
+                return None, []
+            batch_id = self._next_batch_id
+            self._next_batch_id += 1
+            self.in_flight[batch_id] = {"worker": worker_id, "from_id": from_id, "to_id": scores[-1]["id"], "last_id": None}
+        self.logger.debug("Chunked {} scores. Last score id: {}".format(len(scores), scores[-1]["id"]))
+        return batch_id, list(scores)
+
+    def progress(self, batch_id: int, last_id: int):
         """
-        Loads score ids in the pool from a Recalculator instance
+        Records that every score of a batch, up to `last_id` (included), has been saved
 
-        :param recalculator: The recalculator instance that will be used to fetch the score ids
+        :param batch_id: batch id
+        :param last_id: id of the last saved score
         :return:
         """
         with self._lock:
-            query_result = glob.db.fetchAll(recalculator.ids_query.query, recalculator.ids_query.parameters)
-            self.scores += [LwScore(x["id"], 0) for x in query_result]
-        self.logger.debug("Loaded {} scores".format(len(self.scores)))
+            if batch_id in self.in_flight:
+                self.in_flight[batch_id]["last_id"] = last_id
 
-    def chunk(self, chunk_size: int) -> List[int]:
+    def done(self, batch_id: int):
         """
-        Returns a chunk of score ids of the specified size, and removes the chunk from the pool.
+        Records that every score of a batch has been saved
 
-        :param chunk_size: size of the chunk
-        :return: score ids list
+        :param batch_id: batch id
+        :return:
         """
         with self._lock:
-            chunked_scores = self.scores[:chunk_size]
-            self.scores = self.scores[chunk_size:]
-        self.logger.debug("Chunked {} scores. Current scores in pool: {}".format(chunk_size, len(self.scores)))
-        return chunked_scores
+            self.in_flight.pop(batch_id, None)
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """
+        Returns the pool's current state: the id to fetch new batches from, and the batches
+        (with the last saved id of each worker) that haven't been saved yet
+
+        :return: checkpoint dict
+        """
+        with self._lock:
+            return {
+                "next_id": self.last_id,
+                "fetched_all": self._fetched_all,
+                "batches": [dict(x) for x in self.in_flight.values()] + [
+                    {"worker": None, "from_id": x[0], "to_id": x[1], "last_id": None} for x in self.pending
+                ]
+            }
 
     @property
     def is_empty(self):
         """
-        Whether the pool is empty or not
+        Whether every score has been fetched or not
 
         :return: `True` if the pool is empty else `False`
         """
-        return not bool(self.scores)
+        return self._failed or (self._fetched_all and not self.pending)
+
+    @property
+    def is_complete(self):
+        """
+        Whether every score has been fetched and saved or not
+
+        :return: `True` if the recalculation is complete else `False`
+        """
+        with self._lock:
+            return self._fetched_all and not self.pending and not self.in_flight
 
 
 class Worker:
     """
     A tomejerry worker. Recalculates pp for a set of scores.
+    Workers are shared by every scores table: each chunk comes from the next pool (table) that still has scores.
     """
-    score_ids_pool = ScoreIdsPool()
-
-    def __init__(self, chunk_size: int, worker_id: int=-1, start: bool=True):
+    scores_pools: List[ScoresPool] = []
+    _rotation = itertools.count()
+    # Dry run: pp deltas are added to this report instead of being saved in the database
+    report: Optional[ppDeltaReport.ppDeltaReport] = None
+    write_batch_size: int = bulkUpdateHelper.DEFAULT_BATCH_SIZE
+    commit_interval: float = bulkUpdateHelper.DEFAULT_COMMIT_INTERVAL
+
+    def __init__(self, worker_id: int=-1, start: bool=True):
         """
         Initializes a new worker.
 
-        :param chunk_size: Number of scores to process
         :param worker_id: This worker's id. Optional. Default: -1.
         :param start: Whether to start the worker immediately or not
         :param
@@ -200,10 +451,16 @@ class Worker:
         self.logger: logging.Logger = logging.getLogger("w{}".format(worker_id))
         self.recalculated_scores_count: int = 0
         self.saved_scores_count: int = 0
-        self.chunk_size: int = chunk_size
-        self.scores: List[LwScore] = self.score_ids_pool.chunk(self.chunk_size)
+        self.chunk_size: int = 0
+        self.pool: Optional[ScoresPool] = None
+        self.batch_id: Optional[int] = None
+        self.scores: List[LwScore] = []
+        # Beatmaps of the chunk, their leaderboards change once the new pp are saved
+        self.beatmap_md5s: Set[str] = set()
+        self.report_rows: List[Tuple] = []
         self.status: WorkerStatus = WorkerStatus.NOT_STARTED
         self.failed_scores: int = 0
+        self.loved_scores: int = 0
         if start:
             self.threaded_work()
 
@@ -219,26 +476,68 @@ class Worker:
         del self.thread
         self.thread = None
         self.status = WorkerStatus.NOT_STARTED
-        self.scores = self.score_ids_pool.chunk(self.chunk_size)
-        self.logger.debug("Recycled with {} new scores".format(self.chunk_size))
+        self.chunk_size = 0
+        self.pool = None
+        self.batch_id = None
+        self.scores = []
+        self.beatmap_md5s = set()
+        self.report_rows = []
+        self.logger.debug("Recycled")
         if start:
             self.threaded_work()
 
-    def recalc_score(self, score_data: Dict) -> score.baseScore:
+    @classmethod
+    def all_pools_empty(cls) -> bool:
+        """
+        Whether every score of every table has been fetched or not
+
+        :return: `True` if every pool is empty else `False`
+        """
+        return all([x.is_empty for x in cls.scores_pools])
+
+    @classmethod
+    def next_chunk(cls, worker_id: int=-1) -> Tuple[Optional[ScoresPool], Optional[int], List[Dict[str, Any]]]:
+        """
+        Fetches the next batch of scores from the pools, rotating between tables
+
+        :param worker_id: id of the worker that will recalculate the batch
+        :return: (pool, batch id, list of score dicts) tuple. Empty list if there are no more scores.
+        """
+        if not cls.scores_pools:
+            return None, None, []
+        offset = next(cls._rotation)
+        for i in range(len(cls.scores_pools)):
+            pool = cls.scores_pools[(offset + i) % len(cls.scores_pools)]
+            if pool.is_empty:
+                continue
+            batch_id, scores_data = pool.chunk(worker_id)
+            if scores_data:
+                return pool, batch_id, scores_data
+        return None, None, []
+
+    @staticmethod
+    def recalc_score(
+        score_data: Dict,
+        b: Optional[beatmap.beatmap]=None,
+        score_class: type=score.standardScore
+    ) -> score.baseScore:
         """
         Recalculates pp for a score
 
         :param score_data: dict containing score and beatmap information about a score.
+        :param b: beatmap object of this score. Optional. If not passed, it will be created from `score_data`.
+        :param score_class: score class of the score's table. Default: `score.standardScore`.
         :return: new `score` object, with `pp` attribute set to the new value
         """
         # Create score object and set its data
-        s: score.baseScore = score.standardScore()
+        s: score.baseScore = score_class()
         s.setDataFromDict(score_data)
         s.passed = True
 
         # Create beatmap object and set its data
-        b: beatmap.beatmap = beatmap.beatmap()
-        b.setDataFromDict(score_data)
+        if b is None:
+            b = beatmap.beatmap()
+            b.setDataFromDict(score_data)
 
         # Calculate score pp
         s.calculatePP(b)
@@ -255,7 +554,7 @@ class Worker:
         if self.status == WorkerStatus.DONE:
             raise RuntimeError("This worker has been disposed")
 
-        self.logger.info("Started worker. Assigned {} scores".format(self.chunk_size))
+        self.logger.info("Started worker")
         try:
             # Recalculate all pp and save results in memory using LwScore objects
             self.recalculate_pp()
@@ -273,52 +572,44 @@ class Worker:
 
         :return:
         """
-        # We cannot use a SSDictCursor directly, because the connection will time out
-        # if the cursor doesn't consume every result before the `wait_timeout`, which is
-        # 600 seconds in MariaDB's default configuration. This means that we have to recalculate
-        # PPs for all scores in no more than 600 seconds, or we'll get a 'MySQL server has
-        # gone away error'. Fetching every score (joined with the respective beatmap)
-        # directly would take up too much RAM, so we fetch all the score_ids at the
-        # beginning with one query, store them in memory and fetch the data for
-        # each score, one by one, using the same connection (to avoid pool overhead)
+        # Scores are fetched together with their beatmaps in batches of a few thousands rows,
+        # with a server-side cursor (SSDictCursor) that is consumed as soon as the query runs.
+        # This way we never hit MariaDB's `wait_timeout` (600 seconds by default) while
+        # recalculating, we don't run one query per score and we don't load every score at once.
         self.status = WorkerStatus.RECALCULATING
-        # self.recalculated_scores_count = 0
 
-        # Fetch all score_ids
-        # self.scores = [LwScore(x["id"], 0) for x in glob.db.fetchAll(self.ids_query.query, self.ids_query.parameters)]
-
-        # Get a db worker
-        cursor = None
-        db_worker = glob.db.pool.getWorker()
-        if db_worker is None:
-            self.logger.warning("Cannot fetch scores. No database worker available!!")
+        # Fetch the next batch of scores
+        self.pool, self.batch_id, scores_data = self.next_chunk(self.worker_id)
+        self.chunk_size = len(scores_data)
+        if self.pool is None:
             return
+        table = self.pool.recalculator.table
+        self.logger.debug("Assigned {} {} scores".format(self.chunk_size, table.name))
 
         try:
-            # Get a cursor (normal DictCursor)
-            cursor = db_worker.connection.cursor(MySQLdb.cursors.DictCursor)
-            for i, lw_score in enumerate(self.scores):
+            for i, score_ in enumerate(scores_data):
                 if i % self.log_every == 0:
                     self.logger.debug("Processed {}/{} scores".format(i, self.chunk_size))
 
-                # Fetch score and beatmap data for this id
-                cursor.execute(
-                    "SELECT * FROM scores JOIN beatmaps USING(beatmap_md5) WHERE scores.id = %s LIMIT 1",
-                    (lw_score.score_id,)
-                )
-                score_ = cursor.fetchone()
-                if score_ is None:
-                    continue
+                lw_score = LwScore(score_["id"], 0)
+                self.scores.append(lw_score)
+                self.beatmap_md5s.add(score_["beatmap_md5"])
+                if self.report is not None:
+                    self.report_rows.append(report_row(score_, self.report.tables.index(table.table)))
                 try:
                     # Recalculate pp
-                    recalculated_score = self.recalc_score(score_)
+                    recalculated_score = self.recalc_score(score_, score_class=table.score_class)
 
                     if recalculated_score is not None:
                         # New score returned, store new pp in memory
-                        self.scores[i].pp = recalculated_score.pp
+                        lw_score.pp = recalculated_score.pp
+                        lw_score.pp_version = table.score_class.ppVersion(score_["play_mode"])
                         if recalculated_score.pp == 0:
                             # PP calculator error
                             self.log_failed_score(score_, "0 pp")
+                        if recalculated_score.pp == 0 and score_["ranked"] == rankedStatuses.LOVED:
+                            # Loved beatmaps may not give pp
+                            self.log_loved_score(score_, "no pp")
 
                     # Mark for garbage collection
                     del score_
@@ -328,11 +619,8 @@ class Worker:
                 finally:
                     self.recalculated_scores_count += 1
         finally:
-            # Close cursor and connection
-            if cursor is not None:
-                cursor.close()
-            if db_worker is not None:
-                glob.db.pool.putWorker(db_worker)
+            # Mark the fetched rows for garbage collection
+            del scores_data
             self.logger.debug("PP Recalculated")
 
     def save_recalculations(self):
@@ -349,13 +637,38 @@ class Worker:
             self.logger.warning("No scores to update.")
             return
 
-        # Update db
+        # Dry run, add the new pp to the report
+        if self.report is not None:
+            self.report.addMany(x + (y.pp,) for x, y in zip(self.report_rows, self.scores))
+            self.saved_scores_count += len(self.scores)
+            self.pool.done(self.batch_id)
+            return
+
+        # Update db, `write_batch_size` scores at a time
         self.logger.debug("Updating scores in database")
-        for i, lw_score in enumerate(self.scores):
-            if i % self.log_every == 0:
-                self.logger.debug("Updated {}/{} scores".format(i, self.chunk_size))
-            glob.db.execute("UPDATE scores SET pp = %s WHERE id = %s LIMIT 1", (lw_score.pp, lw_score.score_id))
-            self.saved_scores_count += 1
+        saved_before = self.saved_scores_count
+        updater = bulkUpdateHelper.bulkUpdater(
+            self.pool.recalculator.table.table,
+            ("pp", "pp_version"),
+            ("FLOAT", "SMALLINT UNSIGNED"),
+            batchSize=self.write_batch_size,
+            commitInterval=self.commit_interval
+        )
+        try:
+            for i, lw_score in enumerate(self.scores):
+                if i % self.log_every == 0:
+                    self.logger.debug("Updated {}/{} scores".format(updater.updatedRows, self.chunk_size))
+                updater.add(lw_score.score_id, lw_score.pp, lw_score.pp_version)
+                self.saved_scores_count = saved_before + updater.updatedRows
+                if updater.committedRows:
+                    # Checkpoint: every score up to this one has been committed
+                    self.pool.progress(self.batch_id, self.scores[updater.committedRows - 1].score_id)
+        finally:
+            updater.close()
+            self.saved_scores_count = saved_before + updater.updatedRows
+            if updater.updatedRows:
+                invalidate_leaderboards(*self.beatmap_md5s)
+        self.pool.done(self.batch_id)
 
         self.logger.debug("Scores updated")
 
@@ -387,65 +700,244 @@ class Worker:
         It should be `True` if the logging was triggered by an unhandled exception
         :return:
         """
-        msg = ""
-        if traceback_:
-            msg = "\n\n\nUnhandled exception: {}\n{}".format(sys.exc_info(), traceback.format_exc())
-        msg += "score_id:{} ({})".format(score_["id"], additional_information).strip()
-        FAILED_SCORES_LOGGER.error(msg)
+        FAILED_SCORES_LOGGER.error(failed_score_message(score_, additional_information, traceback_))
         self.failed_scores += 1
 
+    def log_loved_score(self, score_: Dict[str, Any], additional_information: str=""):
+        """
+        Logs a score set on a loved beatmap that didn't get any pp.
+
+        :param score_: score dict (from db)
+        :param additional_information: additional information
+        :return:
+        """
+        LOVED_SCORES_LOGGER.error(failed_score_message(score_, additional_information))
+        self.loved_scores += 1
+
 
-def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chunk_size: Optional[int]=None):
+def pp_versions(table: ScoreTable) -> List[Tuple[int, int]]:
     """
-    Recalculate performance points for a set of scores, using multiple workers
+    Current pp calculator version of every game mode of a scores table
 
-    :param recalculator: the recalculator that will be used
-    :param workers_number: the number of workers to spawn
+    :param table: `ScoreTable`
+    :return: list of (game mode, pp_version) tuples, for the game modes that have a pp calculator
+    """
+    return [
+        (mode, table.score_class.ppVersion(mode)) for mode in range(4) if mode in table.score_class.PP_CALCULATORS
+    ]
+
+
+def pp_pool(table: ScoreTable, game_mode: int) -> Optional[str]:
+    """
+    Name of the pp pool that calculates the scores of a table in a game mode
+
+    :param table: `ScoreTable`
+    :param game_mode: game mode
+    :return: pool name, or None if the game mode's pp calculator doesn't run on a pool
+    """
+    return getattr(table.score_class.PP_CALCULATORS.get(game_mode), "poolName", None)
+
+
+def invalidate_leaderboards(*beatmap_md5s: str):
+    """
+    Drops the personal best rank index and the cached leaderboards of some beatmaps,
+    after their scores' pp have been updated. They're rebuilt by LETS when needed.
+
+    :param beatmap_md5s: beatmaps md5
     :return:
     """
-    start_time = time.time()
-    global FAILED_SCORES_LOGGER
-    workers = []
+    for beatmap_md5 in beatmap_md5s:
+        rankIndexHelper.invalidate(beatmap_md5)
+    glob.leaderboardCache.delete(*beatmap_md5s)
 
-    logging.info("Query: {} ({})".format(recalculator.ids_query.query, recalculator.ids_query.parameters))
 
-    # Fetch the total number of scores
-    total_scores = glob.db.fetch(recalculator.count_query.query, recalculator.count_query.parameters)
-    if total_scores is None:
-        logging.warning("No scores to recalc.")
-        return
+def failed_score_message(score_: Dict[str, Any], additional_information: str="", traceback_: bool=False) -> str:
+    """
+    Returns the log message of a failed score.
 
-    # Set up failed scores logger (creates file too)
+    :param score_: score dict (from db) that triggered the error
+    :param additional_information: additional information (type of error)
+    :param traceback_: Whether the traceback should be included or not.
+    :return: log message
+    """
+    msg = ""
+    if traceback_:
+        msg = "\n\n\nUnhandled exception: {}\n{}".format(sys.exc_info(), traceback.format_exc())
+    msg += "score_id:{} ({})".format(score_["id"], additional_information).strip()
+    return msg
+
+
+def report_row(score_: Dict[str, Any], table_index: int) -> Tuple:
+    """
+    Dry run report row of a score, without its new pp
+
+    :param score_: score dict (from db, joined with its beatmap)
+    :param table_index: index of the score's table in the report
+    :return: (score id, user id, beatmap id, table index, game mode, old pp) tuple
+    """
+    return score_["id"], score_["userid"], score_["beatmap_id"], table_index, score_["play_mode"], score_["pp"]
+
+
+def log_report(summary: Dict[str, Any], path: str):
+    """
+    Prints the aggregates of a dry run report
+
+    :param summary: aggregates returned by `ppDeltaReport.close()`
+    :param path: report directory
+    :return:
+    """
+    histogram = "\n".join(
+        ":: {:>8} .. {:<8}\t{} scores".format(
+            "" if x["from"] is None else x["from"], "" if x["to"] is None else x["to"], x["scores"]
+        ) for x in summary["histogram"]
+    )
+    top_scores = "\n".join(
+        ":: score_id:{score_id} user_id:{user_id} beatmap_id:{beatmap_id} ({table}, mode {mode})\t"
+        "{old_pp} -> {new_pp} ({delta:+})".format(**x) for x in summary["top_scores"]
+    )
+    top_users = "\n".join(
+        ":: user_id:{user_id} ({table}, mode {mode})\t{old_pp} -> {new_pp} ({delta:+})".format(**x)
+        for x in summary["users"]["top"]
+    )
+    logging.info(
+        "\n\nDry run, nothing has been saved in the database. Report saved in {}\n"
+        ":: Changed\t{} scores\n"
+        ":: Total pp\t{} -> {} ({:+})\n\n"
+        "pp delta:\n{}\n\n"
+        "Top scores:\n{}\n\n"
+        "Projected users total pp ({} users changed):\n{}".format(
+            path,
+            summary["scores"]["changed"],
+            summary["scores"]["old_pp"],
+            summary["scores"]["new_pp"],
+            summary["scores"]["delta_sum"],
+            histogram,
+            top_scores,
+            summary["users"]["changed"],
+            top_users
+        )
+    )
+
+
+def setup_scores_loggers():
+    """
+    Sets up the failed and loved scores loggers (creates their files too)
+
+    :return:
+    """
+    global FAILED_SCORES_LOGGER
+    global LOVED_SCORES_LOGGER
     FAILED_SCORES_LOGGER = logging.getLogger("failed_scores")
     FAILED_SCORES_LOGGER.addHandler(
         logging.FileHandler("tomejerry_failed_scores_{}.log".format(time.strftime("%d-%m-%Y--%H-%M-%S")))
     )
+    LOVED_SCORES_LOGGER = logging.getLogger("loved_scores")
+    LOVED_SCORES_LOGGER.addHandler(
+        logging.FileHandler("tomejerry_loved_scores_{}.log".format(time.strftime("%d-%m-%Y--%H-%M-%S")))
+    )
+
+
+def print_stats(total_scores: int, failed_scores: int, loved_scores: int, took: float):
+    """
+    Prints the final stats of a recalculation
+
+    :param total_scores: number of scores
+    :param failed_scores: number of failed scores
+    :param loved_scores: number of scores on loved beatmaps that didn't get any pp (they're failed scores too)
+    :param took: seconds taken by the recalculation
+    :return:
+    """
+    logging.info(
+        "\n\nDone!\n"
+        ":: Recalculated\t{} scores\n"
+        ":: Failed\t{} scores\n"
+        ":: Loved 0PP\t{} scores\n"
+        ":: Total\t{} scores\n\n"
+        ":: Took\t{:.2f} seconds".format(
+            total_scores - failed_scores + loved_scores,
+            failed_scores,
+            loved_scores,
+            total_scores,
+            took
+        )
+    )
+
+
+def mass_recalc(
+    recalculators: List[Recalculator],
+    workers_number: int=MAX_WORKERS,
+    chunk_size: Optional[int]=None,
+    write_batch_size: Optional[int]=None,
+    commit_interval: Optional[float]=None,
+    state: Optional[RecalcState]=None,
+    checkpoint: Optional[Dict[str, Any]]=None,
+    report: Optional[ppDeltaReport.ppDeltaReport]=None
+):
+    """
+    Recalculate performance points for a set of scores, using multiple workers.
+    The scores of every recalculator (one per table) are recalculated by the same workers, in a single run.
 
-    # Get the number of total scores from the result dict
-    total_scores = total_scores[next(iter(total_scores))]
-    logging.info("Total scores: {}".format(total_scores))
+    :param recalculators: the recalculators that will be used
+    :param workers_number: the number of workers to spawn
+    :param chunk_size: number of scores fetched from the database at a time. Default: `DEFAULT_BATCH_SIZE`.
+    :param write_batch_size: number of scores updated with each query. Default: `bulkUpdateHelper.DEFAULT_BATCH_SIZE`.
+    :param commit_interval: seconds between commits of each worker. Default:
+    `bulkUpdateHelper.DEFAULT_COMMIT_INTERVAL`.
+    :param state: state file the checkpoints will be saved to. Optional.
+    :param checkpoint: checkpoint to resume from. Optional.
+    :param report: dry run report. If set, the new pp are added to it and not saved in the database. Optional.
+    :return:
+    """
+    start_time = time.time()
+    workers = []
+    Worker.report = report
+
+    if chunk_size is None:
+        chunk_size = DEFAULT_BATCH_SIZE
+
+    # Fetch the total number of scores
+    total_scores = 0
+    for recalculator in recalculators:
+        first_query = recalculator.keyset_query(chunk_size, None)
+        logging.info("Query: {} ({})".format(first_query.query, first_query.parameters))
+        count = glob.db.fetch(recalculator.count_query.query, recalculator.count_query.parameters)
+        if count is None:
+            logging.warning("No scores to recalc.")
+            return
+
+        # Get the number of total scores from the result dict
+        count = count[next(iter(count))]
+        logging.info("Total {} scores: {}".format(recalculator.table.name, count))
+        total_scores += count
     if total_scores == 0:
         return
 
-    # for some reason `typing` believes that `math.ceil` returns a `float`, so we need an extra cast here...
-    scores_per_worker = int(math.ceil(total_scores / workers_number))
-    logging.info("Using {} workers and {} scores per worker".format(workers_number, scores_per_worker))
-
-    # Load score ids in the pool
-    logging.info("Filling score ids pool")
-    Worker.score_ids_pool.load(recalculator)
+    setup_scores_loggers()
+
+    # No need to spawn workers that would never get a chunk
+    workers_number = max(min(workers_number, int(math.ceil(total_scores / chunk_size))), 1)
+    logging.info("Using {} workers and {} scores per chunk".format(workers_number, chunk_size))
+
+    if write_batch_size is not None:
+        Worker.write_batch_size = write_batch_size
+    if commit_interval is not None:
+        Worker.commit_interval = commit_interval
+
+    # Scores are fetched by the workers, one chunk at a time, from one pool per table
+    Worker.scores_pools = []
+    for recalculator in recalculators:
+        pool_checkpoint = checkpoint.get(recalculator.table.name) if checkpoint is not None else None
+        pool = ScoresPool()
+        pool.load(recalculator, chunk_size, pool_checkpoint)
+        Worker.scores_pools.append(pool)
+        if pool_checkpoint is not None:
+            logging.info("Resuming {} scores from score id {} ({} unsaved batches)".format(
+                recalculator.table.name, pool_checkpoint["next_id"], len(pool_checkpoint["batches"])
+            ))
 
     # Spawn the workers and start them
     for i in range(workers_number):
-        workers.append(
-            Worker(
-                chunk_size=chunk_size
-                if chunk_size is not None
-                else len(Worker.score_ids_pool.scores) // workers_number // 3,
-                worker_id=i,
-                start=True
-            )
-        )
+        workers.append(Worker(worker_id=i, start=True))
 
     # Progress bar loop
     steps_text = {
@@ -456,7 +948,7 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
     recycles = 0
     widgets = [
         "[ ", "Starting", " ]",
-        "w_pp:<>", "w_db:<>", "w_done:<>", "rec:0",
+        "w_pp:<>", "w_db:<>", "w_done:<>", "rec:0", "db:0/s",
         progressbar.FormatLabel(" %(value)s/%(max)s "),
         progressbar.Bar(marker="#", left="[", right="]", fill="."),
         progressbar.Percentage(),
@@ -468,6 +960,9 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
         redirect_stdout=True,
         redirect_stderr=True
     ) as bar:
+        # Saved rows per second, measured over the last few seconds
+        rate_samples = [(time.time(), 0)]
+        last_checkpoint = time.time()
         while True:
             lowest_status = min([x.status for x in workers])
 
@@ -481,7 +976,7 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
 
             # Recycle the workers if needed
             workers_done = [x for x in workers if x.status == WorkerStatus.DONE]
-            if workers_done and not Worker.score_ids_pool.is_empty:
+            if workers_done and not Worker.all_pools_empty():
                 logging.info("Recycling workers")
                 recycles += 1
                 for worker in workers_done:
@@ -497,7 +992,17 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
             )
             widgets[5] = " w_done:<{}/{}>".format(len(workers_done), len(workers))
             widgets[6] = " rec:{}".format(recycles)
-            bar.update(total_progress_value)
+            rate_samples.append((time.time(), sum([x.saved_scores_count for x in workers])))
+            rate_samples = rate_samples[-10:]
+            widgets[7] = " db:{:.0f}/s".format(
+                (rate_samples[-1][1] - rate_samples[0][1]) / max(rate_samples[-1][0] - rate_samples[0][0], 0.001)
+            )
+            bar.update(min(total_progress_value, total_scores))
+
+            # Save a checkpoint every few seconds
+            if state is not None and time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                state.save({x.recalculator.table.name: x.checkpoint() for x in Worker.scores_pools})
+                last_checkpoint = time.time()
 
             # Exit from the loop if every worker has finished its work
             if len(workers_done) == len(workers):
@@ -506,24 +1011,273 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
             # Wait 0.5 s and update the progress bar again
             time.sleep(0.5)
 
+    # Delete the state file, or keep it if something hasn't been saved
+    if state is not None:
+        if all([x.is_complete for x in Worker.scores_pools]):
+            state.delete()
+        else:
+            state.save({x.recalculator.table.name: x.checkpoint() for x in Worker.scores_pools})
+            logging.warning("Some scores haven't been saved. Run again with --resume to recalculate them.")
+
     # Recalc done. Print some stats
-    end_time = time.time()
-    failed_scores = sum([x.failed_scores for x in workers])
-    logging.info(
-        "\n\nDone!\n"
-        ":: Recalculated\t{} scores\n"
-        ":: Failed\t{} scores\n"
-        ":: Total\t{} scores\n\n"
-        ":: Took\t{:.2f} seconds".format(
-            total_scores - failed_scores,
-            failed_scores,
-            total_scores,
-            end_time - start_time
+    print_stats(
+        total_scores,
+        sum([x.failed_scores for x in workers]),
+        sum([x.loved_scores for x in workers]),
+        time.time() - start_time
+    )
+    if report is not None:
+        logging.info("Aggregating dry run report")
+        log_report(report.close(), report.path)
+
+
+def init_process(verbose: bool=False):
+    """
+    Initializes a recalculator process (process pool mode). Reads the config files and connects to MySQL and redis.
+
+    :param verbose: verbose/debug mode
+    :return:
+    """
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+    glob.debug = verbose
+    warnings.filterwarnings("ignore", category=MySQLdb.Warning)
+    glob.conf = config.config("config.ini")
+    with open(glob.conf.config["custom"]["config"], "r") as f:
+        glob.conf.extra = json.load(f)
+    glob.db = dbConnector.db(
+        glob.conf.config["db"]["host"],
+        glob.conf.config["db"]["username"],
+        glob.conf.config["db"]["password"],
+        glob.conf.config["db"]["database"],
+        2
+    )
+    # Needed by the difficulty attributes cache of the pp pools
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+
+
+def recalc_beatmap(job: Tuple[List[Recalculator], str, int, int, float, bool]) -> Dict[str, Any]:
+    """
+    Recalculates pp for every score set on a beatmap, in every table, and saves the results in the database.
+    Runs in a recalculator process (process pool mode).
+
+    :param job: (recalculators, beatmap md5, number of scores, write batch size, commit interval, dry run) tuple
+    :return: dict with the number of recalculated, saved, failed and loved 0pp scores, and their log messages.
+    In dry run mode, nothing is saved and the dict contains the report rows of the scores too.
+    """
+    recalculators, beatmap_md5, scores_count, write_batch_size, commit_interval, dry_run = job
+    result = {
+        "beatmap_md5": beatmap_md5, "complete": False, "recalculated": 0, "saved": 0, "failed": 0, "messages": [],
+        "loved": 0, "loved_messages": [], "report_rows": []
+    }
+    try:
+        b: Optional[beatmap.beatmap] = None
+        for table_index, recalculator in enumerate(recalculators):
+            table = recalculator.table
+            query = recalculator.beatmap_scores_query(beatmap_md5)
+            scores_data = glob.db.fetchAll(query.query, query.parameters) or []
+            if not scores_data:
+                continue
+
+            # The beatmap is loaded once for all of its scores, in every table
+            if b is None:
+                b = beatmap.beatmap()
+                b.setDataFromDict(scores_data[0])
+
+            # So are its difficulty attributes, if the pp pool is enabled.
+            # Every score then only runs the performance formula.
+            for game_mode, mods in {(x["play_mode"], x["mods"]) for x in scores_data}:
+                pool_name = pp_pool(table, game_mode)
+                if pool_name is not None and calculatorPool.getPool(pool_name) is not None:
+                    try:
+                        calculatorPool.difficultyAttributes(pool_name, b, game_mode, mods)
+                    except Exception as e:
+                        logging.debug("beatmap {} mode {} mods {}: {}".format(beatmap_md5, game_mode, mods, e))
+
+            updater = None
+            if not dry_run:
+                updater = bulkUpdateHelper.bulkUpdater(
+                    table.table, ("pp", "pp_version"), ("FLOAT", "SMALLINT UNSIGNED"),
+                    batchSize=write_batch_size, commitInterval=commit_interval
+                )
+            try:
+                for score_ in scores_data:
+                    pp = 0
+                    pp_version = 0
+                    try:
+                        pp = Worker.recalc_score(score_, b, table.score_class).pp
+                        pp_version = table.score_class.ppVersion(score_["play_mode"])
+                        if pp == 0:
+                            # PP calculator error
+                            result["failed"] += 1
+                            result["messages"].append(failed_score_message(score_, "0 pp"))
+                    except Exception as e:
+                        result["failed"] += 1
+                        result["messages"].append(failed_score_message(score_, str(e), traceback_=True))
+                    finally:
+                        result["recalculated"] += 1
+                    if pp == 0 and score_["ranked"] == rankedStatuses.LOVED:
+                        # Loved beatmaps may not give pp
+                        result["loved"] += 1
+                        result["loved_messages"].append(failed_score_message(score_, "no pp"))
+                    if updater is not None:
+                        updater.add(score_["id"], pp, pp_version)
+                    else:
+                        result["report_rows"].append(report_row(score_, table_index) + (pp,))
+            finally:
+                if updater is not None:
+                    updater.close()
+                    result["saved"] += updater.updatedRows
+                    if updater.updatedRows:
+                        invalidate_leaderboards(beatmap_md5)
+                else:
+                    result["saved"] += len(scores_data)
+        result["complete"] = True
+    except Exception as e:
+        # Count the scores we couldn't save as failed, and move on to the next beatmap
+        result["failed"] = max(scores_count - result["saved"], result["failed"])
+        result["recalculated"] = scores_count
+        result["messages"].append(
+            "\n\n\nUnhandled exception: {}\n{}beatmap_md5:{} ({})".format(
+                sys.exc_info(), traceback.format_exc(), beatmap_md5, e
+            )
         )
+    return result
+
+
+def mass_recalc_by_beatmap(
+    recalculators: List[Recalculator],
+    processes_number: int,
+    write_batch_size: Optional[int]=None,
+    commit_interval: Optional[float]=None,
+    state: Optional[RecalcState]=None,
+    checkpoint: Optional[Dict[str, Any]]=None,
+    report: Optional[ppDeltaReport.ppDeltaReport]=None
+):
+    """
+    Recalculate performance points for a set of scores, using a pool of processes.
+    Work is split by beatmap, so each process loads a beatmap (and its difficulty attributes) once,
+    recalculates pp for all of its scores, in every table, and then moves on to the next beatmap.
+
+    :param recalculators: the recalculators that will be used (one per table)
+    :param processes_number: the number of processes to spawn
+    :param write_batch_size: number of scores updated with each query. Default: `bulkUpdateHelper.DEFAULT_BATCH_SIZE`.
+    :param commit_interval: seconds between commits of each process. Default:
+    `bulkUpdateHelper.DEFAULT_COMMIT_INTERVAL`.
+    :param state: state file the checkpoints (recalculated beatmaps) will be saved to. Optional.
+    :param checkpoint: checkpoint to resume from. Optional.
+    :param report: dry run report. If set, the new pp are added to it and not saved in the database. Optional.
+    :return:
+    """
+    start_time = time.time()
+
+    # Fetch the beatmaps and their number of scores, in every table
+    scores_per_beatmap = {}
+    for recalculator in recalculators:
+        beatmaps_query = recalculator.beatmaps_query()
+        logging.info("Query: {} ({})".format(beatmaps_query.query, beatmaps_query.parameters))
+        for x in glob.db.fetchAll(beatmaps_query.query, beatmaps_query.parameters) or []:
+            scores_per_beatmap[x["beatmap_md5"]] = scores_per_beatmap.get(x["beatmap_md5"], 0) + x["c"]
+    beatmaps = [{"beatmap_md5": k, "c": v} for k, v in scores_per_beatmap.items()]
+    done_beatmaps = set(checkpoint["done_beatmaps"]) if checkpoint is not None else set()
+    if done_beatmaps:
+        logging.info("Resuming, skipping {} already recalculated beatmaps".format(len(done_beatmaps)))
+        beatmaps = [x for x in beatmaps if x["beatmap_md5"] not in done_beatmaps]
+    total_scores = sum([x["c"] for x in beatmaps])
+    logging.info("Total scores: {} on {} beatmaps".format(total_scores, len(beatmaps)))
+    if total_scores == 0:
+        if state is not None:
+            state.delete()
+        return
+
+    setup_scores_loggers()
+
+    # Biggest beatmaps first, so they don't end up being recalculated alone at the end
+    beatmaps.sort(key=lambda x: x["c"], reverse=True)
+    jobs = (
+        (
+            recalculators,
+            x["beatmap_md5"],
+            x["c"],
+            write_batch_size if write_batch_size is not None else bulkUpdateHelper.DEFAULT_BATCH_SIZE,
+            commit_interval if commit_interval is not None else bulkUpdateHelper.DEFAULT_COMMIT_INTERVAL,
+            report is not None
+        ) for x in beatmaps
     )
+    processes_number = max(min(processes_number, len(beatmaps)), 1)
+    logging.info("Using {} processes".format(processes_number))
+
+    recalculated_scores = 0
+    saved_scores = 0
+    failed_scores = 0
+    loved_scores = 0
+    incomplete_beatmaps = 0
+    last_checkpoint = time.time()
+    widgets = [
+        "[ ", "Recalculating pp", " ]",
+        " proc:<{}>".format(processes_number), " maps:<0/{}>".format(len(beatmaps)), " db:0/s",
+        progressbar.FormatLabel(" %(value)s/%(max)s "),
+        progressbar.Bar(marker="#", left="[", right="]", fill="."),
+        progressbar.Percentage(),
+        " (", progressbar.ETA(), ") "
+    ]
+    # Spawn (not fork) the processes, so they don't share this process' MySQL connections
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes_number, initializer=init_process, initargs=(glob.debug,)) as pool:
+        with progressbar.ProgressBar(
+            widgets=widgets,
+            max_value=total_scores,
+            redirect_stdout=True,
+            redirect_stderr=True
+        ) as bar:
+            for i, result in enumerate(pool.imap_unordered(recalc_beatmap, jobs)):
+                recalculated_scores += result["recalculated"]
+                saved_scores += result["saved"]
+                failed_scores += result["failed"]
+                for msg in result["messages"]:
+                    FAILED_SCORES_LOGGER.error(msg)
+                loved_scores += result["loved"]
+                for msg in result["loved_messages"]:
+                    LOVED_SCORES_LOGGER.error(msg)
+                if report is not None:
+                    report.addMany(result["report_rows"])
+                if result["complete"]:
+                    done_beatmaps.add(result["beatmap_md5"])
+                else:
+                    incomplete_beatmaps += 1
+
+                # Output total status information
+                widgets[4] = " maps:<{}/{}>".format(i + 1, len(beatmaps))
+                widgets[5] = " db:{:.0f}/s".format(saved_scores / max(time.time() - start_time, 0.001))
+                bar.update(min(recalculated_scores, total_scores))
+
+                # Save a checkpoint every few seconds
+                if state is not None and time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    state.save({"done_beatmaps": list(done_beatmaps)})
+                    last_checkpoint = time.time()
+
+    # Delete the state file, or keep it if some beatmaps haven't been saved
+    if state is not None:
+        if incomplete_beatmaps == 0:
+            state.delete()
+        else:
+            state.save({"done_beatmaps": list(done_beatmaps)})
+            logging.warning("{} beatmaps haven't been saved. Run again with --resume to recalculate them.".format(
+                incomplete_beatmaps
+            ))
 
+    # Recalc done. Print some stats
+    print_stats(total_scores, failed_scores, loved_scores, time.time() - start_time)
+    if report is not None:
+        logging.info("Aggregating dry run report")
+        log_report(report.close(), report.path)
 
-def main():
+
+def main(default_table: str="std"):
     # CLI stuff
     parser = argparse.ArgumentParser(description="pp recalc tool for ripple, new version.")
     recalc_group = parser.add_mutually_exclusive_group(required=False)
@@ -547,14 +1301,48 @@ def main():
     recalc_group.add_argument(
         "-b", "--beatmapid", help="calculates pp for high scores played on a specific beatmap (beatmap_id)", required=False
     )
+    recalc_group.add_argument(
+        "-o", "--outdated", help="calculates pp for high scores calculated by an older version of the pp calculator "
+        "of their game mode ({})".format(", ".join(
+            "{} {}: pp_version < {}".format(k, mode, version) for k, v in TABLES.items() for mode, version in pp_versions(v)
+        )),
+        required=False, action="store_true"
+    )
     recalc_group.add_argument(
         "-fhd", "--fixstdhd", help="calculates pp for std hd high scores (14/05/2018 pp algorithm changes)",
         required=False, action="store_true"
     )
+    parser.add_argument(
+        "-t", "--table", help="scores table to recalculate: {}, or both to recalculate them in one run. "
+        "{} by default".format(", ".join(TABLES), default_table), choices=list(TABLES) + ["both"],
+        default=default_table, required=False
+    )
     parser.add_argument("-w", "--workers", help="number of workers. {} by default. Max {}".format(
         MAX_WORKERS // 2, MAX_WORKERS
     ), required=False)
-    parser.add_argument("-cs", "--chunksize", help="score chunks size", required=False)
+    parser.add_argument("-p", "--processes", help="number of processes. Recalculates with a process pool, "
+        "splitting scores by beatmap, instead of threads", required=False)
+    parser.add_argument("-cs", "--chunksize", help="number of scores fetched with each query. {} by default".format(
+        DEFAULT_BATCH_SIZE
+    ), required=False)
+    parser.add_argument("-wb", "--writebatch", help="number of scores updated with each query. {} by default".format(
+        bulkUpdateHelper.DEFAULT_BATCH_SIZE
+    ), required=False)
+    parser.add_argument("-ci", "--commitinterval", help="seconds between db commits. {} by default".format(
+        bulkUpdateHelper.DEFAULT_COMMIT_INTERVAL
+    ), required=False)
+    parser.add_argument(
+        "-d", "--dryrun", help="calculates pp without saving them, and writes a pp delta report instead",
+        required=False, action="store_true"
+    )
+    parser.add_argument("--report", help="dry run report directory. {} by default".format(DEFAULT_REPORT_DIR),
+        default=DEFAULT_REPORT_DIR, required=False)
+    parser.add_argument(
+        "--resume", help="resumes the last interrupted recalculation, from its state file", required=False,
+        action="store_true"
+    )
+    parser.add_argument("--state", help="state file (checkpoints). {} by default".format(DEFAULT_STATE_FILE),
+        default=DEFAULT_STATE_FILE, required=False)
     parser.add_argument("-v", "--verbose", help="verbose/debug mode", required=False, action="store_true")
     args = parser.parse_args()
 
@@ -583,8 +1371,12 @@ def main():
     if args.chunksize is not None:
         chunk_size = int(args.chunksize)
 
+    # Get bulk update options from arguments if set
+    write_batch_size = int(args.writebatch) if args.writebatch is not None else None
+    commit_interval = float(args.commitinterval) if args.commitinterval is not None else None
+
     # Disable MySQL db warnings (it spams 'Unsafe statement written to the binary log using statement...'
-    # because we use UPDATE with LIMIT 1 when updating performance points after recalculation
+    # because we update performance points with a joined UPDATE on a temporary table after recalculation
     warnings.filterwarnings("ignore", category=MySQLdb.Warning)
 
     # Connect to MySQL
@@ -597,30 +1389,75 @@ def main():
         max(workers_number, MAX_WORKERS)
     )
 
+    # Connect to redis (difficulty attributes cache, shared by every table and worker)
+    logging.info("Connecting to redis")
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+
     # Set verbose
     glob.debug = args.verbose
 
-    # Get recalculator
+    # Get recalculators (one per table)
     recalculators_gen = {
-        "zero": lambda: SimpleRecalculator(("scores.completed = 3", "pp = 0")),
-        "recalc": lambda: SimpleRecalculator(("scores.completed = 3",)),
-        "mods": lambda: SimpleRecalculator(("scores.completed = 3", "mods & %s > 0"), (args.mods,)),
-        "id": lambda: SimpleRecalculator(("scores.id = %s",), (args.id,)),
-        "gamemode": lambda: SimpleRecalculator(("scores.completed = 3", "scores.play_mode = %s",), (args.gamemode,)),
-        "userid": lambda: SimpleRecalculator(("scores.completed = 3", "scores.userid = %s",), (args.userid,)),
-        "beatmapid": lambda: SimpleRecalculator(("scores.completed = 3", "beatmaps.beatmap_id = %s",), (args.beatmapid,)),
-        "fixstdhd": lambda: SimpleRecalculator(("scores.completed = 3", "scores.play_mode = 0", "scores.mods & 8 > 0"))
+        "zero": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "pp = 0")),
+        "recalc": lambda t: SimpleRecalculator(t, ("{t}.completed = 3",)),
+        "mods": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "mods & %s > 0"), (args.mods,)),
+        "id": lambda t: SimpleRecalculator(t, ("{t}.id = %s",), (args.id,)),
+        "gamemode": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "{t}.play_mode = %s",), (args.gamemode,)),
+        "userid": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "{t}.userid = %s",), (args.userid,)),
+        "beatmapid": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "beatmaps.beatmap_id = %s",), (args.beatmapid,)),
+        "outdated": lambda t: SimpleRecalculator(
+            t,
+            (
+                "{t}.completed = 3",
+                "({})".format(" OR ".join(["({t}.play_mode = %s AND {t}.pp_version < %s)"] * len(pp_versions(t))))
+            ),
+            [x for mode_version in pp_versions(t) for x in mode_version]
+        ),
+        "fixstdhd": lambda t: SimpleRecalculator(t, ("{t}.completed = 3", "{t}.play_mode = 0", "{t}.mods & 8 > 0"))
     }
-    recalculator = None
+    tables = list(TABLES.values()) if args.table == "both" else [TABLES[args.table]]
+    recalculators = []
     for k, v in vars(args).items():
         if v is not None and ((type(v) is bool and v) or type(v) is not bool):
             if k in recalculators_gen:
-                recalculator = recalculators_gen[k]()
+                recalculators = [recalculators_gen[k](x) for x in tables]
                 break
 
+    # Load the checkpoint of the same recalculation, if resuming
+    state = None
+    checkpoint = None
+    report = None
+    if recalculators and args.dryrun:
+        # The report is written from scratch every time, so dry runs aren't resumable
+        if args.resume:
+            logging.warning("Dry runs can't be resumed, starting from scratch")
+        report = ppDeltaReport.ppDeltaReport(args.report, [x.table.table for x in recalculators])
+    elif recalculators:
+        state = RecalcState(args.state, json.dumps([
+            [[x.table.table, x.count_query.query, x.count_query.parameters] for x in recalculators],
+            "processes" if args.processes is not None else "threads"
+        ], default=str))
+        if args.resume:
+            checkpoint = state.load()
+            if checkpoint is None:
+                logging.warning("No state file found in {}, starting from scratch".format(args.state))
+        elif os.path.isfile(args.state):
+            logging.warning("Overwriting state file {}".format(args.state))
+
     # Execute mass recalc
-    if recalculator is not None:
-        mass_recalc(recalculator, workers_number, chunk_size)
+    if recalculators and args.processes is not None:
+        mass_recalc_by_beatmap(
+            recalculators, int(args.processes), write_batch_size, commit_interval, state, checkpoint, report
+        )
+    elif recalculators:
+        mass_recalc(
+            recalculators, workers_number, chunk_size, write_batch_size, commit_interval, state, checkpoint, report
+        )
     else:
         logging.warning("No recalc option specified")
         parser.print_help()
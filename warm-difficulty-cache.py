@@ -0,0 +1,159 @@
+#!/usr/bin/env python3.6
+import argparse
+import json
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+import progressbar
+import redis
+
+from common.constants import gameModes
+from common.constants import mods as PlayMods
+from common.db import dbConnector
+from constants import rankedStatuses
+from helpers import config
+from objects import beatmap
+from objects import glob
+from pp import calculatorPool
+
+# No mod, EZ, HR, DT, HT
+DEFAULT_MODS = "0,2,16,64,256"
+# The relax pool only calculates std relax scores: RX, RX+EZ, RX+HR, RX+DT, RX+HT
+RELAX_POOL = "relax"
+DEFAULT_RELAX_MODS = "128,130,144,192,384"
+
+
+def warm(beatmap_data, modes, mods_list, pool_name):
+    """
+    Calculates and caches the difficulty attributes of a beatmap
+
+    :param beatmap_data: beatmap row from db
+    :param modes: game modes to warm
+    :param mods_list: mods combinations to warm
+    :param pool_name: pp pool that will calculate the attributes
+    :return: number of failed calculations
+    """
+    b = beatmap.beatmap()
+    b.setDataFromDict(beatmap_data)
+    failed = 0
+    for mode in modes:
+        for mods in mods_list:
+            try:
+                if calculatorPool.difficultyAttributes(pool_name, b, mode, mods) is None:
+                    failed += 1
+            except Exception as e:
+                logging.warning("beatmap {} mode {} mods {}: {}".format(b.beatmapID, mode, mods, e))
+                failed += 1
+    return failed
+
+
+def main():
+    # CLI stuff
+    parser = argparse.ArgumentParser(description="Difficulty attributes cache warmer for ranked beatmaps")
+    parser.add_argument(
+        "-m", "--mods",
+        help="comma separated mods combinations to warm (flags). Default: {} ({} with the {} pool)".format(
+            DEFAULT_MODS, DEFAULT_RELAX_MODS, RELAX_POOL
+        ),
+        required=False
+    )
+    parser.add_argument(
+        "-c", "--converts", help="warm taiko, ctb and mania converts of std beatmaps too",
+        required=False, action="store_true"
+    )
+    parser.add_argument(
+        "-l", "--loved", help="warm loved beatmaps too", required=False, action="store_true"
+    )
+    parser.add_argument("-p", "--pool", help="pp pool name. Default: performance", default="performance", required=False)
+    parser.add_argument("-w", "--workers", help="number of threads. Default: pool size", required=False)
+    parser.add_argument("-v", "--verbose", help="verbose/debug mode", required=False, action="store_true")
+    args = parser.parse_args()
+    relax = args.pool == RELAX_POOL
+    if args.mods is None:
+        args.mods = DEFAULT_RELAX_MODS if relax else DEFAULT_MODS
+    try:
+        mods_list = [int(x) for x in args.mods.split(",") if x.strip()]
+    except ValueError:
+        parser.error("invalid mods: {}".format(args.mods))
+    if relax:
+        # Relax pool attributes are only read by std relax scores, anything else would just waste calculations
+        if any(not x & PlayMods.RELAX for x in mods_list):
+            parser.error("every mods combination must include relax ({}) with the {} pool".format(PlayMods.RELAX, RELAX_POOL))
+        if args.converts:
+            parser.error("the {} pool only calculates std scores, --converts can't be used".format(RELAX_POOL))
+
+    # Logging
+    progressbar.streams.wrap_stderr()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    glob.debug = args.verbose
+
+    # Load config
+    logging.info("Reading config file")
+    glob.conf = config.config("config.ini")
+    with open(glob.conf.config["custom"]["config"], "r") as f:
+        glob.conf.extra = json.load(f)
+
+    # Connect to MySQL and redis
+    logging.info("Connecting to MySQL db")
+    glob.db = dbConnector.db(
+        glob.conf.config["db"]["host"],
+        glob.conf.config["db"]["username"],
+        glob.conf.config["db"]["password"],
+        glob.conf.config["db"]["database"],
+        int(glob.conf.config["db"]["workers"])
+    )
+    logging.info("Connecting to redis")
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+    glob.redis.ping()
+
+    # The attributes are computed by the persistent pp calculators
+    pool = calculatorPool.getPool(args.pool)
+    if pool is None:
+        logging.error("pp pool '{}' is disabled. Enable it in the additional config file.".format(args.pool))
+        return
+    workers_number = int(args.workers) if args.workers is not None else pool.size
+
+    statuses = [rankedStatuses.RANKED, rankedStatuses.APPROVED]
+    if args.loved:
+        statuses.append(rankedStatuses.LOVED)
+    beatmaps = glob.db.fetchAll(
+        "SELECT * FROM beatmaps WHERE ranked IN ({}){}".format(
+            ", ".join(["%s"] * len(statuses)),
+            " AND mode = {}".format(gameModes.STD) if relax else ""
+        ),
+        statuses
+    )
+    logging.info("Warming {} beatmaps with mods {}".format(len(beatmaps), mods_list))
+
+    start_time = time.time()
+    failed = 0
+    thread_pool = ThreadPool(workers_number)
+    jobs = (
+        (x, list(range(4)) if args.converts and x["mode"] == 0 else [x["mode"]], mods_list, args.pool)
+        for x in beatmaps
+    )
+    try:
+        with progressbar.ProgressBar(max_value=len(beatmaps), redirect_stdout=True) as bar:
+            for i, result in enumerate(thread_pool.imap_unordered(lambda x: warm(*x), jobs)):
+                failed += result
+                bar.update(i + 1)
+    finally:
+        thread_pool.close()
+        calculatorPool.shutdownAll()
+
+    logging.info(
+        "\n\nDone!\n"
+        ":: Beatmaps\t{}\n"
+        ":: Failed\t{} calculations\n\n"
+        ":: Took\t{:.2f} seconds".format(len(beatmaps), failed, time.time() - start_time)
+    )
+
+
+if __name__ == "__main__":
+    main()